@@ -1,11 +1,30 @@
-from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
-from sqlalchemy import create_engine, delete, select, text
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, aliased, mapped_column
+from sqlalchemy import (
+    Index,
+    and_,
+    String,
+    create_engine,
+    delete,
+    exists,
+    inspect,
+    or_,
+    select,
+    text,
+    tuple_,
+)
 from sqlalchemy.dialects.sqlite import insert
 from datetime import datetime
 import subprocess
+import threading
+
+import numpy as np
+
+from lib.log_setup import logger
 
 DB_FILENAME = "key2play.sqlite"
 CONNECTION_STRING = f"sqlite:///{DB_FILENAME}"
+NUM_MIDI_NOTES = 128
+SONG_SORT_COLUMNS = ("title", "composer", "difficulty", "duration", "bpm")
 defaults = {
     "num_leds_on_strip": 200,
     "num_leds_per_meter": 160,
@@ -160,11 +179,63 @@ class MidiLedMap(Base):
         )
 
 
+def _midi_led_values(led_index, r, g, b, time_on, time_off):
+    """The values of a midi_led_map row as ints, checked against the array types."""
+    values = [int(value) for value in (led_index, r, g, b, time_on, time_off)]
+    int32, int64 = np.iinfo(np.int32), np.iinfo(np.int64)
+    if not int32.min <= values[0] <= int32.max:
+        raise ValueError(f"invalid led index {values[0]}")
+    for value in values[1:4]:
+        if not 0 <= value <= 255:
+            raise ValueError(f"invalid color value {value}")
+    for value in values[4:]:
+        if not int64.min <= value <= int64.max:
+            raise ValueError(f"invalid time {value}")
+    return values
+
+
 class MidiToLedMapping:
+    """The midi_led_map table, held in memory.
+
+    The table is read once at startup into arrays indexed by MIDI note
+    (led_index is -1 for notes without a row). Writes go to SQLite and to
+    the arrays, so the lighting path reads calibration without a query.
+    """
+
     def __init__(self):
         self._engine = create_engine(
             CONNECTION_STRING
         )  # shared engine — created once, reused for all queries
+        self._lock = threading.Lock()
+        Base.metadata.create_all(self._engine)
+        self.load()
+
+    def load(self):
+        led_index = np.full(NUM_MIDI_NOTES, -1, dtype=np.int32)
+        rgb = np.zeros((NUM_MIDI_NOTES, 3), dtype=np.uint8)
+        time_on = np.zeros(NUM_MIDI_NOTES, dtype=np.int64)
+        time_off = np.zeros(NUM_MIDI_NOTES, dtype=np.int64)
+        with Session(self._engine) as session:
+            for row in session.scalars(select(MidiLedMap)):
+                if not 0 <= row.midi_note < NUM_MIDI_NOTES:
+                    continue
+                try:
+                    values = _midi_led_values(
+                        row.led_index, row.r, row.g, row.b, row.time_on, row.time_off
+                    )
+                except (TypeError, ValueError) as e:
+                    # written before the values were checked
+                    logger.warning(f"Skipping midi_led_map row {row.midi_note}: {e}")
+                    continue
+                led_index[row.midi_note] = values[0]
+                rgb[row.midi_note] = values[1:4]
+                time_on[row.midi_note] = values[4]
+                time_off[row.midi_note] = values[5]
+        with self._lock:
+            self.led_index = led_index
+            self.rgb = rgb
+            self.time_on = time_on
+            self.time_off = time_off
 
     def set_midi_led_row(
         self,
@@ -176,6 +247,12 @@ class MidiToLedMapping:
         time_on: int,
         time_off: int,
     ):
+        midi_note = int(midi_note)
+        if not 0 <= midi_note < NUM_MIDI_NOTES:
+            raise ValueError(f"invalid midi note {midi_note}")
+        led_index, r, g, b, time_on, time_off = _midi_led_values(
+            led_index, r, g, b, time_on, time_off
+        )
         with Session(self._engine) as session:
             stmt = (
                 insert(MidiLedMap)
@@ -202,28 +279,281 @@ class MidiToLedMapping:
             )
             session.execute(stmt)
             session.commit()
+        with self._lock:
+            self.led_index[midi_note] = led_index
+            self.rgb[midi_note] = (r, g, b)
+            self.time_on[midi_note] = time_on
+            self.time_off[midi_note] = time_off
 
     def get_midi_led_row(self, midi_note: int) -> MidiLedMap | None:
-        with Session(self._engine) as session:
-            stmt = select(MidiLedMap).where(MidiLedMap.midi_note == midi_note)
-            result = session.scalar(stmt)
-
-            return result
+        midi_note = int(midi_note)
+        if not 0 <= midi_note < NUM_MIDI_NOTES:
+            return None
+        with self._lock:
+            if self.led_index[midi_note] < 0:
+                return None
+            return self._row(midi_note)
 
     def delete_midi_led_row(self, midi_note: int):
+        midi_note = int(midi_note)
         with Session(self._engine) as session:
             stmt = delete(MidiLedMap).where(MidiLedMap.midi_note == midi_note)
             session.execute(stmt)
             session.commit()
+        if 0 <= midi_note < NUM_MIDI_NOTES:
+            with self._lock:
+                self.led_index[midi_note] = -1
+                self.rgb[midi_note] = 0
+                self.time_on[midi_note] = 0
+                self.time_off[midi_note] = 0
 
     def get_midi_led_map(self) -> list[MidiLedMap]:
-        with Session(self._engine) as session:
-            stmt = select(MidiLedMap)
-
-            return list(session.scalars(stmt))
+        with self._lock:
+            return [
+                self._row(midi_note)
+                for midi_note in np.flatnonzero(self.led_index >= 0).tolist()
+            ]
 
     def delete_all_maps(self):
         with Session(self._engine) as session:
             stmt = delete(MidiLedMap)
             session.execute(stmt)
             session.commit()
+        self.load()
+
+    def _row(self, midi_note: int) -> MidiLedMap:
+        # detached object, never added to a session
+        r, g, b = self.rgb[midi_note].tolist()
+        return MidiLedMap(
+            midi_note=midi_note,
+            led_index=int(self.led_index[midi_note]),
+            r=r,
+            g=g,
+            b=b,
+            time_on=int(self.time_on[midi_note]),
+            time_off=int(self.time_off[midi_note]),
+        )
+
+
+class SongLibraryEntry(Base):
+    __tablename__ = "song_library"
+    folder: Mapped[str] = mapped_column(primary_key=True)
+    filename: Mapped[str] = mapped_column(primary_key=True)
+    size: Mapped[int] = mapped_column()
+    mtime_ns: Mapped[int] = mapped_column()
+    sha1: Mapped[str] = mapped_column(index=True)
+    analyzed: Mapped[bool] = mapped_column()  # False if analysis failed
+    # from the filename, see lib.song_info.parse_song_name
+    composer: Mapped[str | None] = mapped_column(String(collation="NOCASE"))
+    title: Mapped[str | None] = mapped_column(String(collation="NOCASE"))
+    key: Mapped[str | None] = mapped_column(String(collation="NOCASE"), index=True)
+    # analysis fields, see lib.song_info.analyze_midi
+    file_size: Mapped[int | None] = mapped_column()
+    file_size_str: Mapped[str | None] = mapped_column()
+    duration: Mapped[float | None] = mapped_column()
+    duration_str: Mapped[str | None] = mapped_column()
+    bpm: Mapped[int | None] = mapped_column()
+    bpm_str: Mapped[str | None] = mapped_column()
+    time_signature: Mapped[str | None] = mapped_column()
+    time_signature_str: Mapped[str | None] = mapped_column()
+    track_count: Mapped[int | None] = mapped_column()
+    total_notes: Mapped[int | None] = mapped_column()
+    unique_pitches: Mapped[int | None] = mapped_column()
+    max_polyphony: Mapped[int | None] = mapped_column()
+    notes_per_second: Mapped[float | None] = mapped_column()
+    note_range: Mapped[str | None] = mapped_column()
+    difficulty: Mapped[int | None] = mapped_column()
+    difficulty_stars: Mapped[str | None] = mapped_column()
+    difficulty_word: Mapped[str | None] = mapped_column()
+    right_hand_notes: Mapped[int | None] = mapped_column()
+    right_hand_polyphony: Mapped[int | None] = mapped_column()
+    right_hand_range: Mapped[str | None] = mapped_column()
+    left_hand_notes: Mapped[int | None] = mapped_column()
+    left_hand_polyphony: Mapped[int | None] = mapped_column()
+    left_hand_range: Mapped[str | None] = mapped_column()
+
+    # keyset pagination reads the songs in (sort column, filename) order
+    __table_args__ = tuple(
+        Index(f"ix_song_library_{column}", column, "filename")
+        for column in SONG_SORT_COLUMNS
+    )
+
+    def info(self) -> dict | None:
+        if not self.analyzed:
+            return None
+        return {field: getattr(self, field) for field in SONG_INFO_FIELDS}
+
+    def __repr__(self) -> str:
+        return (
+            f"SongLibraryEntry("
+            f"folder={self.folder}, "
+            f"filename={self.filename}, "
+            f"size={self.size}, "
+            f"mtime_ns={self.mtime_ns}, "
+            f"sha1={self.sha1}"
+            f")"
+        )
+
+
+SONG_INFO_FIELDS = tuple(
+    column.name
+    for column in SongLibraryEntry.__table__.columns
+    if column.name not in ("folder", "filename", "size", "mtime_ns", "sha1", "analyzed")
+)
+
+
+class SongLibrary:
+    """The song_library table: analysis of every song file, one row per file.
+
+    A row is keyed by (folder, filename) and stamped with the size, mtime
+    and SHA-1 of the file it was made from, so a caller compares a fresh
+    stat against the stamp to find the rows to redo. The whole table is
+    read in one query.
+    """
+
+    def __init__(self):
+        self._engine = create_engine(
+            CONNECTION_STRING
+        )  # shared engine — created once, reused for all queries
+        table = SongLibraryEntry.__table__
+        inspector = inspect(self._engine)
+        if inspector.has_table(table.name) and {
+            column["name"] for column in inspector.get_columns(table.name)
+        } != set(table.columns.keys()):
+            # only derived data: a table from another version is rebuilt
+            table.drop(self._engine)
+        Base.metadata.create_all(self._engine)
+
+    def entries(self) -> dict[tuple[str, str], SongLibraryEntry]:
+        with Session(self._engine, expire_on_commit=False) as session:
+            return {
+                (entry.folder, entry.filename): entry
+                for entry in session.scalars(select(SongLibraryEntry))
+            }
+
+    def entry(self, folder: str, filename: str) -> SongLibraryEntry | None:
+        with Session(self._engine) as session:
+            return session.get(SongLibraryEntry, (folder, filename))
+
+    def find_sha1(self, sha1: str) -> SongLibraryEntry | None:
+        """An analyzed row of a file with this content, if any."""
+        with Session(self._engine) as session:
+            stmt = select(SongLibraryEntry).where(
+                SongLibraryEntry.sha1 == sha1, SongLibraryEntry.analyzed
+            )
+            return session.scalars(stmt.limit(1)).first()
+
+    def search(
+        self,
+        user_folder: str,
+        text: str | None = None,
+        prefix: bool = False,
+        difficulty: tuple[int | None, int | None] = (None, None),
+        duration: tuple[float | None, float | None] = (None, None),
+        bpm: tuple[int | None, int | None] = (None, None),
+        key: str | None = None,
+        sort: str = "title",
+        descending: bool = False,
+        after: tuple | None = None,
+        limit: int = 50,
+    ) -> list[SongLibraryEntry]:
+        """Analyzed songs matching the filters, in (sort, filename) order.
+
+        text matches the start (prefix) or any part of the composer or the
+        title, case-insensitively. The ranges are inclusive, None leaves a
+        side open. after is the (sort value, filename) of the last song of
+        the previous page. A song in user_folder hides a song of the same
+        filename in the other folders.
+        """
+        if sort not in SONG_SORT_COLUMNS:
+            raise ValueError(f"invalid sort column {sort}")
+        song = SongLibraryEntry
+        user = aliased(SongLibraryEntry)
+        stmt = select(song).where(
+            song.analyzed,
+            or_(
+                song.folder == user_folder,
+                ~exists().where(
+                    user.folder == user_folder, user.filename == song.filename
+                ),
+            ),
+        )
+        if text:
+            if prefix:
+                matches = [
+                    column.startswith(text, autoescape=True)
+                    for column in (song.composer, song.title)
+                ]
+            else:
+                matches = [
+                    column.contains(text, autoescape=True)
+                    for column in (song.composer, song.title)
+                ]
+            stmt = stmt.where(or_(*matches))
+        for column, (low, high) in (
+            (song.difficulty, difficulty),
+            (song.duration, duration),
+            (song.bpm, bpm),
+        ):
+            if low is not None:
+                stmt = stmt.where(column >= low)
+            if high is not None:
+                stmt = stmt.where(column <= high)
+        if key:
+            stmt = stmt.where(song.key == key)
+
+        order = getattr(song, sort)
+        if after is not None:
+            # SQLite sorts NULL first, so they come before any value going up
+            # and after all of them going down; a comparison with NULL is never true
+            value, filename = after
+            position = tuple_(order, song.filename)
+            if value is None:
+                if descending:
+                    stmt = stmt.where(order.is_(None), song.filename < filename)
+                else:
+                    stmt = stmt.where(
+                        or_(
+                            order.is_not(None),
+                            and_(order.is_(None), song.filename > filename),
+                        )
+                    )
+            elif descending:
+                stmt = stmt.where(or_(position < after, order.is_(None)))
+            else:
+                stmt = stmt.where(position > after)
+        if descending:
+            stmt = stmt.order_by(order.desc(), song.filename.desc())
+        else:
+            stmt = stmt.order_by(order, song.filename)
+
+        with Session(self._engine) as session:
+            return list(session.scalars(stmt.limit(limit)))
+
+    def put_entries(self, entries: list[dict]):
+        """Inserts or replaces rows given as dicts of column values."""
+        if not entries:
+            return
+        with Session(self._engine) as session:
+            for entry in entries:
+                stmt = (
+                    insert(SongLibraryEntry)
+                    .values(entry)
+                    .on_conflict_do_update(
+                        index_elements=["folder", "filename"], set_=entry
+                    )
+                )
+                session.execute(stmt)
+            session.commit()
+
+    def delete_entries(self, keys: list[tuple[str, str]]):
+        if not keys:
+            return
+        with Session(self._engine) as session:
+            for folder, filename in keys:
+                stmt = delete(SongLibraryEntry).where(
+                    SongLibraryEntry.folder == folder,
+                    SongLibraryEntry.filename == filename,
+                )
+                session.execute(stmt)
+            session.commit()
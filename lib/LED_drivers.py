@@ -1,12 +1,14 @@
 import time
 
+import numpy as np
+
 
 class PixelStrip_Emu:
     def __init__(self, numleds=176):
         self.leds = numleds
         self.VIS_FPS = 100
 
-        self.led_state = [0] * self.leds
+        self.led_state = np.zeros(self.leds, dtype=np.uint32)
 
     def numPixels(self):
         return self.leds
@@ -15,11 +17,14 @@ class PixelStrip_Emu:
         pass
 
     def setPixelColor(self, pos, color):
-        if 0 < pos < self.leds:
+        if 0 <= pos < self.leds:
             self.led_state[pos] = color
 
+    def setPixels(self, colors):
+        self.led_state[:] = colors
+
     def getPixels(self):
-        return self.led_state
+        return self.led_state.tolist()
 
     def show(self):
         time.sleep(1 / self.VIS_FPS)
@@ -2,9 +2,11 @@ import random
 import time
 
 import mido
+import numpy as np
 
 import lib.colormaps as cmap
 from lib.functions import get_scale_color, powercurve
+from lib.rate_counter import RateCounter
 
 
 class ColorMode(object):
@@ -69,6 +71,49 @@ class ColorMode(object):
         """
         pass
 
+    def NoteOnBatch(self, notes, velocities, positions, times):
+        """Batch form of NoteOn, for all note-ons of one refresh
+
+        Takes equal length arrays of note, velocity, LED position and midi time.
+        Returns an (N, 3) uint8 array of colors and a bool mask of the entries
+        that got one.  The default calls NoteOn per entry.
+        """
+        colors = np.zeros((len(notes), 3), dtype=np.uint8)
+        valid = np.zeros(len(notes), dtype=bool)
+        for i, (note, velocity, position, midi_time) in enumerate(
+            zip(notes, velocities, positions, times)
+        ):
+            midi_event = mido.Message("note_on", note=int(note), velocity=int(velocity))
+            color = self.NoteOn(midi_event, midi_time, None, int(position))
+            if color is not None:
+                colors[i] = color[:3]
+                valid[i] = True
+        return colors, valid
+
+    def ColorUpdateBatch(self, time_delta, positions, old_colors):
+        """Batch form of ColorUpdate, for all lit LEDs at positions
+
+        Returns an (N, 3) uint8 array of new colors, or None for no change.
+        The default calls ColorUpdate per LED.
+        """
+        colors = np.array(old_colors, dtype=np.uint8)
+        changed = False
+        for i, position in enumerate(positions.tolist()):
+            color = self.ColorUpdate(time_delta, position, tuple(colors[i]))
+            if color is not None:
+                colors[i] = color[:3]
+                changed = True
+        return colors if changed else None
+
+    @property
+    def has_color_update(self):
+        """True if the mode changes lit LEDs on every refresh"""
+        return type(self).ColorUpdate is not ColorMode.ColorUpdate
+
+
+def _repeat_color(color, count):
+    return np.tile(np.asarray(color, dtype=np.uint8), (count, 1))
+
 
 class SingleColor(ColorMode):
     def LoadSettings(self, ledsettings):
@@ -79,6 +124,10 @@ class SingleColor(ColorMode):
     def NoteOn(self, midi_event: mido.Message, midi_time, midi_state, note_position):
         return (self.red, self.green, self.blue)
 
+    def NoteOnBatch(self, notes, velocities, positions, times):
+        colors = _repeat_color((self.red, self.green, self.blue), len(notes))
+        return colors, np.ones(len(notes), dtype=bool)
+
 
 class Multicolor(ColorMode):
     def LoadSettings(self, ledsettings):
@@ -86,61 +135,54 @@ class Multicolor(ColorMode):
         self.multicolor_range = ledsettings.multicolor_range
         self.multicolor_index = 0
         self.multicolor_iteration = ledsettings.multicolor_iteration
+        # ranges containing every note and the color of notes in no range, see
+        # LedSettings.update_multicolor()
+        table = getattr(ledsettings, "multicolor_table", None)
+        if table is None:
+            table = cmap.multicolor_note_table(self.multicolor_range, self.multicolor)
+        self.multicolor_inside, self.multicolor_fallback = table
 
     def NoteOn(self, midi_event: mido.Message, midi_time, midi_state, note_position):
         chosen_color = self.get_random_multicolor_in_range(midi_event.note)
         return chosen_color
 
-    def get_random_multicolor_in_range(self, note):
-        temporary_multicolor = []
-        color_on_the_right = {}
-        color_on_the_left = {}
-
-        for i, range in enumerate(self.multicolor_range):
-            if range[0] <= note <= range[1]:
-                temporary_multicolor.append(self.multicolor[i])
-
-            # get colors on the left and right
-            if range[0] > note:
-                color_on_the_right[range[0]] = self.multicolor[i]
-            if range[1] < note:
-                color_on_the_left[range[1]] = self.multicolor[i]
+    def NoteOnBatch(self, notes, velocities, positions, times):
+        notes = np.asarray(notes)
+        count = len(notes)
+        if self.multicolor_iteration == 1:
+            if not self.multicolor:
+                return np.zeros((count, 3), dtype=np.uint8), np.zeros(count, bool)
+            start = self.multicolor_index
+            if start >= len(self.multicolor):
+                start = 0
+            indexes = (start + np.arange(count)) % len(self.multicolor)
+            if count:
+                self.multicolor_index = int(indexes[-1]) + 1
+            colors = np.asarray(self.multicolor, dtype=np.uint8)[indexes]
+            return colors, np.ones(count, dtype=bool)
+
+        inside = self.multicolor_inside[notes]
+        colors = self.multicolor_fallback[notes]
+        if inside.shape[1]:
+            # random choice among the ranges containing the note
+            pick = np.argmax(np.random.random(inside.shape) * inside, axis=1)
+            chosen = np.asarray(self.multicolor, dtype=np.uint8)[pick]
+            colors = np.where(inside.any(axis=1)[:, None], chosen, colors)
+        return colors, np.ones(count, dtype=bool)
 
+    def get_random_multicolor_in_range(self, note):
         if self.multicolor_iteration == 1:
             if self.multicolor_index >= len(self.multicolor):
                 self.multicolor_index = 0
             chosen_color = self.multicolor[self.multicolor_index]
             self.multicolor_index += 1
-        elif temporary_multicolor:
-            chosen_color = random.choice(temporary_multicolor)
-        else:
-            # mix colors from left and right
-
-            if color_on_the_right and color_on_the_left:
-                right = min(color_on_the_right)
-                left = max(color_on_the_left)
-
-                left_to_right_distance = right - left
-                percent_value = (note - left) / left_to_right_distance
-
-                red = (
-                    percent_value
-                    * (color_on_the_right[right][0] - color_on_the_left[left][0])
-                ) + color_on_the_left[left][0]
-                green = (
-                    percent_value
-                    * (color_on_the_right[right][1] - color_on_the_left[left][1])
-                ) + color_on_the_left[left][1]
-                blue = (
-                    percent_value
-                    * (color_on_the_right[right][2] - color_on_the_left[left][2])
-                ) + color_on_the_left[left][2]
-
-                chosen_color = [int(red), int(green), int(blue)]
-            else:
-                chosen_color = [0, 0, 0]
+            return chosen_color
 
-        return chosen_color
+        candidates = np.flatnonzero(self.multicolor_inside[note])
+        if len(candidates):
+            return self.multicolor[random.choice(candidates.tolist())]
+        # mix of the colors on the left and right, black without both
+        return self.multicolor_fallback[note].tolist()
 
 
 class Rainbow(ColorMode):
@@ -150,8 +192,8 @@ class Rainbow(ColorMode):
         self.timeshift = int(ledsettings.rainbow_timeshift)
         self.timeshift_start = time.time()
         self.colormap = ledsettings.rainbow_colormap
-        if self.colormap not in cmap.colormaps:
-            self.colormaps = "Rainbow"
+        if cmap.get_colormap(self.colormap) is None:
+            self.colormap = "Rainbow"
 
     def NoteOn(self, midi_event: mido.Message, midi_time, midi_state, note_position):
         shift = (time.time() - self.timeshift_start) * self.timeshift
@@ -159,31 +201,38 @@ class Rainbow(ColorMode):
             int((int(note_position) + self.offset + shift) * (float(self.scale) / 100))
             & 255
         )
-        return cmap.colormaps[self.colormap][rainbow_value]
+        return tuple(cmap.get_colormap(self.colormap)[rainbow_value].tolist())
 
     def ColorUpdate(self, time_delta, led_pos, old_color):
         return self.NoteOn(None, None, None, led_pos)
 
+    def NoteOnBatch(self, notes, velocities, positions, times):
+        shift = (time.time() - self.timeshift_start) * self.timeshift
+        positions = np.asarray(positions, dtype=np.int64)
+        rainbow_values = (
+            (positions + self.offset + shift) * (float(self.scale) / 100)
+        ).astype(np.int64) & 255
+        colormap = cmap.get_colormap(self.colormap)
+        return colormap[rainbow_values], np.ones(len(positions), dtype=bool)
+
+    def ColorUpdateBatch(self, time_delta, positions, old_colors):
+        return self.NoteOnBatch(positions, None, positions, None)[0]
+
 
 class SpeedColor(ColorMode):
     def LoadSettings(self, ledsettings):
-        self.notes_in_last_period = []
         self.speed_slowest = ledsettings.speed_slowest
         self.speed_fastest = ledsettings.speed_fastest
         self.speed_period_in_seconds = ledsettings.speed_period_in_seconds
         self.speed_max_notes = ledsettings.speed_max_notes
+        self.notes_in_last_period = RateCounter(self.speed_period_in_seconds)
 
     def NoteOn(self, midi_event: mido.Message, midi_time, midi_state, note_position):
-        current_time = time.time()
-        self.notes_in_last_period.append(current_time)
-        return self.speed_get_colors()
+        return self.speed_get_colors(self.notes_in_last_period.add())
 
-    def speed_get_colors(self):
-        for note_time in self.notes_in_last_period[:]:
-            if (time.time() - self.speed_period_in_seconds) > note_time:
-                self.notes_in_last_period.remove(note_time)
-
-        notes_count = len(self.notes_in_last_period)
+    def speed_get_colors(self, notes_count=None):
+        if notes_count is None:
+            notes_count = self.notes_in_last_period.value()
         max_notes = self.speed_max_notes
         speed_percent = notes_count / float(max_notes)
 
@@ -206,6 +255,19 @@ class SpeedColor(ColorMode):
             ) + self.speed_slowest["blue"]
         return (round(red), round(green), round(blue))
 
+    def NoteOnBatch(self, notes, velocities, positions, times):
+        count = len(notes)
+        total = self.notes_in_last_period.add(count)
+        # every note counts the ones before it in the batch, as with one NoteOn each
+        notes_count = total - count + np.arange(1, count + 1)
+
+        slowest = np.array([self.speed_slowest[c] for c in ("red", "green", "blue")])
+        fastest = np.array([self.speed_fastest[c] for c in ("red", "green", "blue")])
+        speed_percent = (notes_count / float(self.speed_max_notes))[:, None]
+        colors = np.round((fastest - slowest) * speed_percent + slowest)
+        colors[notes_count > self.speed_max_notes] = fastest
+        return colors.astype(np.uint8), np.ones(count, dtype=bool)
+
     def gradient_get_colors(self, position):
         raise Exception("need to replumb config.num_leds_on_strip() to this function")
 
@@ -215,6 +277,16 @@ class ScaleColoring(ColorMode):
         self.scale_key = int(ledsettings.scale_key)
         self.key_in_scale = ledsettings.key_in_scale
         self.key_not_in_scale = ledsettings.key_not_in_scale
+        # color of every pitch class (note % 12)
+        self.pitch_class_colors = np.array(
+            [
+                get_scale_color(
+                    self.scale_key, note, self.key_in_scale, self.key_not_in_scale
+                )
+                for note in range(12)
+            ],
+            dtype=np.uint8,
+        )
 
     def NoteOn(self, midi_event: mido.Message, midi_time, midi_state, note_position):
         scale_colors = get_scale_color(
@@ -222,6 +294,10 @@ class ScaleColoring(ColorMode):
         )
         return scale_colors
 
+    def NoteOnBatch(self, notes, velocities, positions, times):
+        notes = np.asarray(notes, dtype=np.int64)
+        return self.pitch_class_colors[notes % 12], np.ones(len(notes), dtype=bool)
+
 
 class VelocityRainbow(ColorMode):
     def LoadSettings(self, ledsettings):
@@ -229,16 +305,34 @@ class VelocityRainbow(ColorMode):
         self.scale = int(ledsettings.velocityrainbow_scale)
         self.curve = int(ledsettings.velocityrainbow_curve)
         self.colormap = ledsettings.velocityrainbow_colormap
+        # colormap index of every velocity
+        self.velocity_index = np.array(
+            [self.get_colormap_index(velocity) for velocity in range(128)]
+        )
 
     def NoteOn(self, midi_event: mido.Message, midi_time, midi_state, note_position):
-        if self.colormap not in cmap.colormaps:
+        colormap = cmap.get_colormap(self.colormap)
+        if colormap is None:
             return None
 
-        x = int(
+        x = self.get_colormap_index(midi_event.velocity)
+        return tuple(colormap[x].tolist())
+
+    def NoteOnBatch(self, notes, velocities, positions, times):
+        count = len(notes)
+        colormap = cmap.get_colormap(self.colormap)
+        if colormap is None:
+            return np.zeros((count, 3), dtype=np.uint8), np.zeros(count, dtype=bool)
+
+        indexes = self.velocity_index[np.asarray(velocities, dtype=np.int64)]
+        return colormap[indexes], np.ones(count, dtype=bool)
+
+    def get_colormap_index(self, velocity):
+        return int(
             (
                 (
                     255
-                    * powercurve(midi_event.velocity / 127, self.curve / 100)
+                    * powercurve(velocity / 127, self.curve / 100)
                     * (self.scale / 100)
                     % 256
                 )
@@ -246,4 +340,3 @@ class VelocityRainbow(ColorMode):
             )
             % 256
         )
-        return cmap.colormaps[self.colormap][x]
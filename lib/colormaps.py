@@ -1,17 +1,44 @@
 import glob
+import hashlib
+import json
 import os
+import threading
+from functools import lru_cache
 
 import numpy as np
 
 from lib.log_setup import logger
 
-colormaps = {}
-colormaps_preview = {}
-
 # Colormap gradients designed with ws281x gamma = 1
-# These will be converted to colormap lookup tables with 256 entries for use in colormaps dict
+# These are converted on first use to lookup tables with 256 entries, see get_colormap()
 gradients = {}
 
+# gamma of the LED strip, applied to the lookup tables
+led_gamma = 1.0
+# bumped whenever a gradient changes, so cached lookup tables of the old one are not used
+_versions = {}
+# held while changing a gradient, and while rendering the previews so they match their version
+_lock = threading.RLock()
+
+# previews shown in the web interface
+PREVIEW_GAMMA = 2.2
+PREVIEW_ENTRIES = 64
+
+DIR_COLORMAPS = "Colormaps/"
+
+# Colormap cache file layout (same scheme as compiled songs):
+#   magic (8 bytes) | version (u2) | reserved (u2) | header length (u4) | JSON header
+#   zero padding up to a multiple of HEADER_ALIGN | float64 gradient rows of all files
+# The header holds the size and mtime of every source file and the position of each colormap.
+COLORMAP_CACHE_PATH = os.path.join("cache", "colormaps.bin")
+COLORMAP_CACHE_MAGIC = b"K2PCMAP\0"
+COLORMAP_CACHE_VERSION = 1
+HEADER_ALIGN = 64
+
+# file colormaps: name -> [offset, rows, columns] in _file_colormap_data, see load_colormaps()
+_file_colormaps = {}
+_file_colormap_data = None
+
 # Hard-coded gradients:
 
 # Rainbow, as existing in lib/functions.py, equiv to FastLED-HSV Spectrum
@@ -122,57 +149,224 @@ def gradient_to_cmaplut(gradient, gamma=1, entries=256, int_table=True):
         table[i] = np.interp(xpoints, pos, c01) ** (1 / gamma)
 
     if int_table:
-        return [
-            (round(x[0] * 255), round(x[1] * 255), round(x[2] * 255)) for x in table.T
-        ]
+        return np.round(table.T * 255).astype(np.uint8)
     else:
-        return [(x[0], x[1], x[2]) for x in table.T]
+        return table.T
+
 
+@lru_cache(maxsize=32)
+def _colormap_lut(name, gamma, entries, version):
+    lut = gradient_to_cmaplut(get_gradient(name), gamma, entries)
+    lut.flags.writeable = False  # shared by every caller
+    return lut
 
-def update_colormap(name, gamma):
-    global colormaps, colormaps_preview, gradients
 
+def get_colormap(name, gamma=None):
+    """(256, 3) uint8 lookup table of a colormap, at the strip gamma by default.
+
+    Tables are built on first use and kept in an LRU cache per (name, gamma),
+    so a gamma change only rebuilds the maps that are actually used.
+    Returns None for an unknown or invalid colormap.
+    """
+    if name not in gradients:
+        return None
+    if gamma is None:
+        gamma = led_gamma
     try:
-        colormaps[name] = gradient_to_cmaplut(gradients[name], gamma)
-        colormaps_preview[name] = gradient_to_cmaplut(gradients[name], 2.2, 64)
+        return _colormap_lut(name, gamma, 256, _versions.get(name, 0))
     except Exception as e:
         logger.warning(f"Loading colormap {name} failed: {e}")
+        return None
 
 
-def generate_colormaps(gradients, gamma):
-    global colorsmaps, colorsmaps_preview
+def get_colormap_preview(name):
+    """(64, 3) uint8 lookup table of a colormap for the web interface, or None."""
+    if name not in gradients:
+        return None
+    try:
+        return _colormap_lut(
+            name, PREVIEW_GAMMA, PREVIEW_ENTRIES, _versions.get(name, 0)
+        )
+    except Exception as e:
+        logger.warning(f"Loading colormap {name} failed: {e}")
+        return None
 
-    for k, v in gradients.items():
-        update_colormap(k, gamma)
 
+def get_colormap_previews():
+    """Previews of all valid colormaps, as {name: (64, 3) uint8 array}, and
+    their previews_version(). No gradient changes while they are rendered."""
+    with _lock:
+        version = previews_version()
+        previews = {}
+        for name in list(gradients):
+            preview = get_colormap_preview(name)
+            if preview is not None:
+                previews[name] = preview
+    return previews, version
 
-def load_colormaps():
-    gradients = {}
 
-    files = glob.glob("Colormaps/*.led.data")
-    for f in files:
-        try:
-            name_ext = os.path.splitext(os.path.basename(f))[0]
-            name = os.path.splitext(name_ext)[0]
-            gradients[name] = np.loadtxt(f).tolist()
-        except Exception as e:
-            logger.warning(f"Loading colormap datafile {f} failed: {e}")
+def previews_version():
+    """Changes whenever a colormap is added or changed in this process.
 
-    # sRGB files are gamma converted by **2.2 before loading into gradients to keep with ws2812's intensity-based color space
-    files = glob.glob("Colormaps/*.sRGB.data")
-    for f in files:
-        try:
-            name_ext = os.path.splitext(os.path.basename(f))[0]
+    The counters start over on every boot, so this tells whether rendered
+    previews are still current but is no ETag: hash the rendered previews.
+    """
+    key = [[name, _versions.get(name, 0)] for name in list(gradients)]
+    key.append([PREVIEW_GAMMA, PREVIEW_ENTRIES])
+    return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()[:16]
+
+
+def set_gamma(value):
+    """Sets the gamma of the lookup tables. Nothing is rebuilt until used."""
+    global led_gamma
+    led_gamma = float(value)
+
+
+def update_colormap(name):
+    """Call after changing gradients[name]: drops its cached lookup tables."""
+    with _lock:
+        _versions[name] = _versions.get(name, 0) + 1
+
+
+def _colormap_files():
+    """(name, path, is sRGB) of the Colormaps/*.data files."""
+    files = []
+    names = set()
+    for pattern, srgb in (("*.led.data", False), ("*.sRGB.data", True)):
+        for path in sorted(glob.glob(os.path.join(DIR_COLORMAPS, pattern))):
+            name_ext = os.path.splitext(os.path.basename(path))[0]
             name = os.path.splitext(name_ext)[0]
-            if name in gradients:
+            if name in names:
                 name = name + "~"
-            gradients[name] = np.loadtxt(
-                f, converters=lambda x: float(x) ** 2.2
-            ).tolist()
-        except Exception as e:
-            logger.warning(f"Loading colormap datafile {f} failed: {e}")
+            names.add(name)
+            files.append((name, path, srgb))
+    return files
+
+
+def _parse_colormap_file(path, srgb):
+    if srgb:
+        # sRGB files are gamma converted by **2.2 before loading into gradients to keep with ws2812's intensity-based color space
+        return np.loadtxt(path, converters=lambda x: float(x) ** 2.2)
+    return np.loadtxt(path)
+
+
+def _source_stamps(files):
+    stamps = {}
+    for _, path, _ in files:
+        stat = os.stat(path)
+        stamps[path] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
+
+
+def save_colormap_cache(path, stamps, parsed):
+    """Writes parsed colormap files ({name: 2D array}) to a single cache file."""
+    index = {}
+    blocks = []
+    offset = 0
+    for name, data in parsed.items():
+        data = np.asarray(data, dtype="<f8").reshape(len(data), -1)
+        index[name] = [offset, data.shape[0], data.shape[1]]
+        offset += data.size
+        blocks.append(data.ravel())
+    header = {"sources": stamps, "colormaps": index, "count": offset}
+    header_bytes = json.dumps(header).encode("utf-8")
+    preamble = (
+        COLORMAP_CACHE_MAGIC
+        + np.array([COLORMAP_CACHE_VERSION, 0], dtype="<u2").tobytes()
+        + np.array([len(header_bytes)], dtype="<u4").tobytes()
+        + header_bytes
+    )
+    padding = -len(preamble) % HEADER_ALIGN
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as handle:
+        handle.write(preamble + b"\0" * padding)
+        for block in blocks:
+            handle.write(block.tobytes())
+    # atomic swap; a running process that mapped the old file keeps its inode
+    os.replace(tmp_path, path)
+
+
+def load_colormap_cache(path, stamps=None):
+    """Memory-maps a colormap cache as (index, data). None if missing, outdated or stale."""
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, "rb") as handle:
+        if handle.read(len(COLORMAP_CACHE_MAGIC)) != COLORMAP_CACHE_MAGIC:
+            logger.warning(f"Not a colormap cache: {path}")
+            return None
+        version = int(np.frombuffer(handle.read(4), dtype="<u2")[0])
+        if version != COLORMAP_CACHE_VERSION:
+            return None
+        header_len = int(np.frombuffer(handle.read(4), dtype="<u4")[0])
+        header = json.loads(handle.read(header_len).decode("utf-8"))
+
+    # rebuild when a colormap file was added, removed or changed
+    if stamps is not None and header["sources"] != stamps:
+        return None
+
+    data_offset = len(COLORMAP_CACHE_MAGIC) + 8 + header_len
+    data_offset += -data_offset % HEADER_ALIGN
+    if header["count"] > 0:
+        data = np.memmap(
+            path, dtype="<f8", mode="r", offset=data_offset, shape=(header["count"],)
+        )
+    else:
+        data = np.zeros(0)
+    return header["colormaps"], data
+
 
-    return dict(sorted(gradients.items()))
+def load_colormaps():
+    """Adds the Colormaps/*.data files to gradients, without reading them.
+
+    The files are parsed once into cache/colormaps.bin, which is rebuilt when
+    a file is added, removed or changed. At startup only the cache header is
+    read; the gradient of a file colormap is read from the cache on first use
+    (see get_gradient). Returns the names of the file colormaps.
+    """
+    global _file_colormaps, _file_colormap_data
+
+    files = _colormap_files()
+    stamps = _source_stamps(files)
+    cache = load_colormap_cache(COLORMAP_CACHE_PATH, stamps)
+    if cache is None:
+        parsed = {}
+        for name, path, srgb in files:
+            try:
+                parsed[name] = _parse_colormap_file(path, srgb)
+            except Exception as e:
+                logger.warning(f"Loading colormap datafile {path} failed: {e}")
+        try:
+            save_colormap_cache(COLORMAP_CACHE_PATH, stamps, parsed)
+            cache = load_colormap_cache(COLORMAP_CACHE_PATH)
+        except OSError as e:
+            logger.warning(f"Writing colormap cache failed: {e}")
+            with _lock:
+                for name, data in sorted(parsed.items()):
+                    gradients[name] = data.tolist()
+                    update_colormap(name)
+            return sorted(parsed)
+
+    names = sorted(cache[0])
+    with _lock:
+        _file_colormaps, _file_colormap_data = cache
+        for name in names:
+            gradients[name] = None  # read on first use
+            update_colormap(name)
+    return names
+
+
+def get_gradient(name):
+    """The gradient of a colormap, read from the colormap cache on first use."""
+    gradient = gradients[name]
+    if gradient is None:
+        offset, rows, columns = _file_colormaps[name]
+        data = _file_colormap_data[offset : offset + rows * columns]
+        gradient = data.reshape(rows, columns).tolist()
+        gradients[name] = gradient
+    return gradient
 
 
 def multicolor_to_gradient(multicolor_range, multicolor):
@@ -197,10 +391,44 @@ def update_multicolor(multicolor_range, multicolor):
     global gradients
 
     g = multicolor_to_gradient(multicolor_range, multicolor)
-    if g is not None and len(g) >= 2:
-        gradients["^Multicolor"] = g
-    else:
-        # default to some error color
-        gradients["^Multicolor"] = [(15, 5, 5)]
-
-    update_colormap("^Multicolor", 1)
+    with _lock:
+        if g is not None and len(g) >= 2:
+            gradients["^Multicolor"] = g
+        else:
+            # default to some error color
+            gradients["^Multicolor"] = [(15, 5, 5)]
+
+        update_colormap("^Multicolor")
+
+
+def multicolor_note_table(multicolor_range, multicolor):
+    """Per MIDI note lookup for the Multicolor color mode.
+
+    Returns a (128, R) bool array of the multicolor ranges containing each
+    note, and the (128, 3) uint8 color of notes outside every range: the
+    ^Multicolor gradient between the nearest ranges on the left and right,
+    black when there is no range on one side.
+    """
+    notes = np.arange(128)
+    ranges = np.asarray(multicolor_range, dtype=float).reshape(-1, 2)
+    low, high = ranges[:, 0], ranges[:, 1]
+    inside = (low <= notes[:, None]) & (notes[:, None] <= high)
+
+    fallback = np.zeros((128, 3), dtype=np.uint8)
+    gradient = multicolor_to_gradient(multicolor_range, multicolor)
+    if len(gradient) < 2:
+        return inside, fallback
+
+    has_left = (high < notes[:, None]).any(axis=1)
+    has_right = (low > notes[:, None]).any(axis=1)
+    between = has_left & has_right & ~inside.any(axis=1)
+
+    pos, colors = zip(*gradient)
+    # back from gradient positions to notes, so the mix is exact at range bounds
+    pos_notes = np.round(np.asarray(pos) * 88 + 20)
+    colors = np.asarray(colors, dtype=float)
+    for channel in range(3):
+        mixed = np.interp(notes[between], pos_notes, colors[:, channel])
+        # truncated like the left/right mix in get_random_multicolor_in_range
+        fallback[between, channel] = mixed.astype(np.int64)
+    return inside, fallback
@@ -0,0 +1,250 @@
+import json
+import os
+
+import mido
+import numpy as np
+
+from lib.log_setup import logger
+from lib.tempo_map import TempoMap
+
+# Compiled song file layout:
+#   magic (8 bytes) | version (u2) | reserved (u2) | header length (u4) | JSON header
+#   zero padding up to a multiple of HEADER_ALIGN | EVENT_DTYPE records
+# The event block is memory-mapped on load, so switching songs does not parse anything.
+SONG_FORMAT_MAGIC = b"K2PSONG\0"
+SONG_FORMAT_VERSION = 3
+SONG_FORMAT_EXT = ".song"
+HEADER_ALIGN = 64
+
+KIND_NOTE_ON = 1
+KIND_NOTE_OFF = 2
+KIND_CONTROL_CHANGE = 3
+KIND_PROGRAM_CHANGE = 4
+KIND_POLYTOUCH = 5
+KIND_AFTERTOUCH = 6
+KIND_PITCHWHEEL = 7  # the two data bytes: note = LSB, velocity = MSB
+KIND_SYSEX = 8  # note | velocity << 8 is the index of its data in CompiledSong.sysex
+
+EVENT_DTYPE = np.dtype(
+    [
+        ("tick", "<u4"),  # absolute tick from the start of the song
+        ("time", "<f8"),  # absolute seconds from the start of the song
+        ("kind", "u1"),  # one of the KIND_* constants
+        ("note", "u1"),  # note number, control number or program number
+        ("velocity", "u1"),  # velocity, control value or pressure
+        ("channel", "u1"),  # for notes: 1 = right hand, 2 = left hand (track based)
+    ]
+)
+MAX_SYSEX = 1 << 16
+
+
+class CompiledSong:
+    def __init__(self, events, tempo_map, sysex=()):
+        self.events = events
+        self.tempo_map = tempo_map
+        self.sysex = list(sysex)  # data bytes of the sysex messages, as lists
+        self.ticks_per_beat = tempo_map.ticks_per_beat
+        self.song_tempo = tempo_map.initial_tempo
+
+    def __len__(self):
+        return len(self.events)
+
+    def to_message_dicts(self):
+        """Returns the events as mido-like message dicts with delta times in ticks."""
+        result = []
+        prev_tick = 0
+        for tick, _, kind, note, velocity, channel in self.events.tolist():
+            msg = {"type": None, "time": tick - prev_tick, "channel": channel}
+            if kind == KIND_NOTE_ON:
+                msg.update(type="note_on", note=note, velocity=velocity)
+            elif kind == KIND_NOTE_OFF:
+                msg.update(type="note_off", note=note, velocity=velocity)
+            elif kind == KIND_CONTROL_CHANGE:
+                msg.update(type="control_change", control=note, value=velocity)
+            elif kind == KIND_PROGRAM_CHANGE:
+                msg.update(type="program_change", program=note)
+            elif kind == KIND_POLYTOUCH:
+                msg.update(type="polytouch", note=note, value=velocity)
+            elif kind == KIND_AFTERTOUCH:
+                msg.update(type="aftertouch", value=velocity)
+            elif kind == KIND_PITCHWHEEL:
+                msg.update(type="pitchwheel", pitch=(velocity << 7 | note) - 8192)
+            elif kind == KIND_SYSEX:
+                msg.update(type="sysex", data=self.sysex[note | velocity << 8])
+            result.append(msg)
+            prev_tick = tick
+        return result
+
+
+def event_to_message(kind, note, velocity, channel, sysex=()):
+    """Rebuilds a mido message from the fields of a compiled event.
+    sysex is the CompiledSong.sysex of the song."""
+    if kind == KIND_NOTE_ON:
+        return mido.Message("note_on", note=note, velocity=velocity, channel=channel)
+    elif kind == KIND_NOTE_OFF:
+        return mido.Message("note_off", note=note, velocity=velocity, channel=channel)
+    elif kind == KIND_CONTROL_CHANGE:
+        return mido.Message(
+            "control_change", control=note, value=velocity, channel=channel
+        )
+    elif kind == KIND_PROGRAM_CHANGE:
+        return mido.Message("program_change", program=note, channel=channel)
+    elif kind == KIND_POLYTOUCH:
+        return mido.Message("polytouch", note=note, value=velocity, channel=channel)
+    elif kind == KIND_AFTERTOUCH:
+        return mido.Message("aftertouch", value=velocity, channel=channel)
+    elif kind == KIND_PITCHWHEEL:
+        return mido.Message(
+            "pitchwheel", pitch=(velocity << 7 | note) - 8192, channel=channel
+        )
+    elif kind == KIND_SYSEX:
+        return mido.Message("sysex", data=sysex[note | velocity << 8])
+    return None
+
+
+def compile_midi(mid):
+    """Flattens a mido.MidiFile into a CompiledSong.
+
+    Tracks are assigned to channels before merging to know the message origin,
+    the same way learning mode always did: with 2 tracks the first one is the
+    right hand (channel 1) and the second the left hand (channel 2). Every
+    other message that is not meta is kept with its own channel, so Listen
+    mode plays it like the mido messages it replaced.
+    """
+    if len(mid.tracks) == 2:  # check if the midi file has only 2 Tracks
+        offset = 1
+    else:
+        offset = 0
+
+    rows = []
+    tempo_changes = []
+    sysex = []
+    for k, track in enumerate(mid.tracks):
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            if msg.is_meta:
+                if msg.type == "set_tempo":
+                    tempo_changes.append((tick, msg.tempo))
+                continue
+
+            if msg.type == "note_on" and msg.velocity > 0:
+                # clamp to valid MIDI channel range (0-15); songs with 16+ tracks would overflow otherwise
+                rows.append(
+                    (tick, KIND_NOTE_ON, msg.note, msg.velocity, min(k + offset, 15))
+                )
+            elif msg.type in ("note_on", "note_off"):
+                rows.append((tick, KIND_NOTE_OFF, msg.note, 0, min(k + offset, 15)))
+            elif msg.type == "control_change":
+                rows.append(
+                    (tick, KIND_CONTROL_CHANGE, msg.control, msg.value, msg.channel)
+                )
+            elif msg.type == "program_change":
+                rows.append((tick, KIND_PROGRAM_CHANGE, msg.program, 0, msg.channel))
+            elif msg.type == "polytouch":
+                rows.append((tick, KIND_POLYTOUCH, msg.note, msg.value, msg.channel))
+            elif msg.type == "aftertouch":
+                rows.append((tick, KIND_AFTERTOUCH, 0, msg.value, msg.channel))
+            elif msg.type == "pitchwheel":
+                pitch = msg.pitch + 8192
+                rows.append(
+                    (tick, KIND_PITCHWHEEL, pitch & 0x7F, pitch >> 7, msg.channel)
+                )
+            elif msg.type == "sysex":
+                if len(sysex) == MAX_SYSEX:
+                    logger.warning("Too many sysex messages, dropping the rest")
+                    continue
+                index = len(sysex)
+                sysex.append(list(msg.data))
+                rows.append((tick, KIND_SYSEX, index & 0xFF, index >> 8, 0))
+
+    # stable sort keeps track order for simultaneous events, like mido.merge_tracks
+    rows.sort(key=lambda row: row[0])
+    tempo_map = TempoMap(mid.ticks_per_beat, tempo_changes)
+
+    events = np.zeros(len(rows), dtype=EVENT_DTYPE)
+    if rows:
+        ticks, kinds, notes, velocities, channels = zip(*rows)
+        events["tick"] = ticks
+        events["kind"] = kinds
+        events["note"] = notes
+        events["velocity"] = velocities
+        events["channel"] = channels
+        events["time"] = tempo_map.tick2second(events["tick"])
+
+    return CompiledSong(events, tempo_map, sysex)
+
+
+def get_compiled_song_path(song_path):
+    # cache uses just the filename, not the folder path
+    return os.path.join("cache", os.path.basename(song_path) + SONG_FORMAT_EXT)
+
+
+def _source_stamp(song_path):
+    stat = os.stat(song_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def save_compiled_song(song, path, song_path=None):
+    header = {
+        "ticks_per_beat": song.ticks_per_beat,
+        "tempo_changes": song.tempo_map.to_list(),
+        "count": len(song.events),
+        "sysex": [bytes(data).hex() for data in song.sysex],
+        "source": list(_source_stamp(song_path)) if song_path else None,
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    preamble = (
+        SONG_FORMAT_MAGIC
+        + np.array([SONG_FORMAT_VERSION, 0], dtype="<u2").tobytes()
+        + np.array([len(header_bytes)], dtype="<u4").tobytes()
+        + header_bytes
+    )
+    padding = -len(preamble) % HEADER_ALIGN
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as handle:
+        handle.write(preamble + b"\0" * padding)
+        handle.write(np.ascontiguousarray(song.events, dtype=EVENT_DTYPE).tobytes())
+    # atomic swap; readers that already mapped the old file keep their inode
+    os.replace(tmp_path, path)
+
+
+def load_compiled_song(path, song_path=None):
+    """Memory-maps a compiled song. Returns None if missing, outdated or stale."""
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, "rb") as handle:
+        if handle.read(len(SONG_FORMAT_MAGIC)) != SONG_FORMAT_MAGIC:
+            logger.warning(f"Not a compiled song: {path}")
+            return None
+        version = int(np.frombuffer(handle.read(4), dtype="<u2")[0])
+        if version != SONG_FORMAT_VERSION:
+            logger.info(f"Compiled song version {version} is outdated: {path}")
+            return None
+        header_len = int(np.frombuffer(handle.read(4), dtype="<u4")[0])
+        header = json.loads(handle.read(header_len).decode("utf-8"))
+
+    # recompile if the source file was replaced (e.g. uploaded with overwrite)
+    if song_path and header["source"] != list(_source_stamp(song_path)):
+        logger.info(f"Compiled song is stale: {path}")
+        return None
+
+    data_offset = len(SONG_FORMAT_MAGIC) + 8 + header_len
+    data_offset += -data_offset % HEADER_ALIGN
+    if header["count"] > 0:
+        events = np.memmap(
+            path,
+            dtype=EVENT_DTYPE,
+            mode="r",
+            offset=data_offset,
+            shape=(header["count"],),
+        )
+    else:
+        events = np.zeros(0, dtype=EVENT_DTYPE)
+
+    tempo_map = TempoMap(header["ticks_per_beat"], header["tempo_changes"])
+    sysex = [list(bytes.fromhex(data)) for data in header["sysex"]]
+    return CompiledSong(events, tempo_map, sysex)
@@ -0,0 +1,92 @@
+import numpy as np
+
+from lib.frame_compositor import pack_rgb
+from lib.functions import get_backlight_color
+
+FULL_STRENGTH = 1000  # keylist value of a fully lit key
+PEDAL_DEADZONE = 10  # sustain pedal values below this count as released
+FADING_MODES = ("Fading", "Velocity", "Pedal")
+
+
+class FadeEngine:
+    """Afterglow of the lit keys, advanced for the whole strip in one step.
+
+    Per-LED state lives in LedStrip arrays: keylist is the strength
+    (0 - FULL_STRENGTH), keylist_status is 1 while the key is held,
+    keylist_color the base color and keylist_decay the strength lost per
+    second, fixed on note on from fadingspeed. Velocity mode starts a key
+    at a strength proportional to its velocity, so soft notes die out
+    sooner; Pedal mode holds pressed keys and only fades released ones.
+    """
+
+    def __init__(self, ledstrip, ledsettings):
+        self.ledstrip = ledstrip
+        self.ledsettings = ledsettings
+
+    def decay_rate(self):
+        # fadingspeed is the time in milliseconds for a fully lit key to fade out
+        return FULL_STRENGTH * 1000 / max(self.ledsettings.fadingspeed, 1)
+
+    def press(self, positions, colors, velocities):
+        """Lights the keys at positions with (N, 3) colors."""
+        ledstrip = self.ledstrip
+        ledstrip.keylist_color[positions] = colors
+        ledstrip.keylist_status[positions] = 1
+        ledstrip.keylist_decay[positions] = self.decay_rate()
+        if self.ledsettings.mode == "Velocity":
+            ledstrip.keylist[positions] = FULL_STRENGTH * np.asarray(velocities) / 127
+        else:
+            ledstrip.keylist[positions] = FULL_STRENGTH
+
+    def release(self, note_position, sustained):
+        """Key released. Returns True if the key went dark."""
+        ledstrip = self.ledstrip
+        mode = self.ledsettings.mode
+        ledstrip.keylist_status[note_position] = 0
+
+        if mode == "Fading":
+            pass  # keeps fading out
+        elif mode == "Velocity" and sustained:
+            pass
+        elif mode == "Pedal" and sustained:
+            drop = (100 - self.ledsettings.fadepedal_notedrop) / 100
+            ledstrip.keylist[note_position] = ledstrip.keylist[note_position] * drop
+        else:
+            ledstrip.keylist[note_position] = 0
+        return ledstrip.keylist[note_position] <= 0
+
+    def release_sustain(self):
+        """Pedal released: keys only held by the pedal go dark. Returns their positions."""
+        ledstrip = self.ledstrip
+        released = np.flatnonzero(
+            (ledstrip.keylist_status == 0) & (ledstrip.keylist > 0)
+        )
+        ledstrip.keylist[released] = 0
+        return released
+
+    def step(self, time_delta, active):
+        """Fades the active LEDs by time_delta seconds. Returns the ones that went dark."""
+        ledstrip = self.ledstrip
+        mode = self.ledsettings.mode
+        if mode in ("Fading", "Velocity"):
+            fading = active
+        elif mode == "Pedal":
+            fading = active[ledstrip.keylist_status[active] == 0]
+        else:
+            return active[:0]
+
+        decay = np.ceil(time_delta * ledstrip.keylist_decay[fading]).astype(np.int32)
+        strength = np.maximum(0, ledstrip.keylist[fading] - decay)
+        ledstrip.keylist[fading] = strength
+        return fading[strength == 0]
+
+    def colors(self, positions):
+        """Packed colors of the LEDs at positions, scaled by strength, backlight when dark."""
+        ledstrip = self.ledstrip
+        strength = ledstrip.keylist[positions]
+        factor = strength / FULL_STRENGTH
+        # truncate towards zero like int()
+        rgb = (ledstrip.keylist_color[positions] * factor[:, None]).astype(np.uint8)
+        colors = pack_rgb(rgb)
+        colors[strength <= 0] = get_backlight_color(self.ledsettings)
+        return colors
@@ -0,0 +1,177 @@
+import threading
+import time
+
+import numpy as np
+
+from lib.log_setup import logger
+
+
+def pack_rgb(rgb):
+    """(..., 3) array of r, g, b values to packed 0x00RRGGBB colors."""
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def unpack_rgb(colors):
+    """Packed 0x00RRGGBB colors to a (..., 3) uint8 array of r, g, b."""
+    colors = np.asarray(colors, dtype=np.uint32)
+    return np.stack(
+        [(colors >> 16) & 0xFF, (colors >> 8) & 0xFF, colors & 0xFF], axis=-1
+    ).astype(np.uint8)
+
+
+class FrameCompositor:
+    """Frame-batched front of an LED driver, with the same API as PixelStrip.
+
+    Every producer (learning mode, animations, the web API) writes into one
+    pixel buffer. show() only requests a frame; a single flush thread pushes
+    the changed pixels to the driver and calls its show() at most once per
+    frame, and skips frames where nothing changed. On ws281x each driver
+    show() is a full DMA transfer of the strip, so this caps the cost at
+    fps transfers per second no matter how many writers there are.
+
+    The buffer is a uint32 array of packed colors (the rpi_ws281x Color()
+    format), so full-strip updates (fill, range set, fade) are one array op.
+    """
+
+    def __init__(self, driver, fps=60):
+        self.driver = driver
+        self.num_pixels = driver.numPixels()
+        self.pixels = np.zeros(self.num_pixels, dtype=np.uint32)
+        self.fps = fps
+        self.frame_interval = 1.0 / fps
+
+        # last state pushed to the driver, used to only write changed pixels
+        self._shown = None
+        self._brightness = None
+        self._dirty = False
+        self._requested = threading.Event()
+        self._driver_lock = threading.Lock()
+        self._running = True
+
+        self.frames = 0
+        self.skipped = 0
+        # optional callback(started, presented) with perf_counter times of every presented frame
+        self.on_present = None
+
+        self._thread = threading.Thread(
+            target=self._run, name="FrameCompositor", daemon=True
+        )
+        self._thread.start()
+
+    def numPixels(self):
+        return self.num_pixels
+
+    def setPixelColor(self, pos, color):
+        if 0 <= pos < self.num_pixels:
+            self.pixels[pos] = color
+            self._dirty = True
+
+    def getPixelColor(self, pos):
+        return int(self.pixels[pos])
+
+    def getPixels(self):
+        return self.pixels.tolist()
+
+    def fill(self, color, start=0, stop=None):
+        """Sets every pixel in [start, stop) to one packed color."""
+        self.pixels[start:stop] = color
+        self._dirty = True
+
+    def set_pixels(self, colors, start=0):
+        """Copies packed colors (or an (N, 3) array of r, g, b) into the buffer from start."""
+        colors = np.asarray(colors)
+        if colors.ndim == 2:
+            colors = pack_rgb(colors)
+        colors = colors[: max(0, self.num_pixels - start)]
+        self.pixels[start : start + len(colors)] = colors
+        self._dirty = True
+
+    def put(self, positions, colors):
+        """Writes packed colors (or an (N, 3) array of r, g, b) to the pixels at positions."""
+        colors = np.asarray(colors)
+        if colors.ndim == 2:
+            colors = pack_rgb(colors)
+        self.pixels[positions] = colors
+        self._dirty = True
+
+    def get_rgb(self, start=0, stop=None):
+        """(N, 3) uint8 copy of the buffer as r, g, b."""
+        return unpack_rgb(self.pixels[start:stop])
+
+    def fade(self, factor, start=0, stop=None):
+        """Scales the r, g, b of the pixels in [start, stop) by factor (0..1)."""
+        rgb = unpack_rgb(self.pixels[start:stop]).astype(np.float32)
+        rgb *= min(max(factor, 0.0), 1.0)
+        self.pixels[start:stop] = pack_rgb(rgb)
+        self._dirty = True
+
+    def setBrightness(self, brightness):
+        if brightness != self._brightness:
+            self._brightness = brightness
+            self._dirty = True
+
+    def show(self):
+        """Requests a frame. Returns immediately, the flush thread presents it."""
+        self._requested.set()
+
+    def refresh(self):
+        """Re-sends the whole buffer on the next frame (e.g. after a gamma change)."""
+        self._shown = None
+        self._dirty = True
+        self._requested.set()
+
+    def set_fps(self, fps):
+        self.fps = fps
+        self.frame_interval = 1.0 / fps
+
+    def flush(self):
+        """Pushes pending changes to the driver now. Returns False if nothing changed."""
+        with self._driver_lock:
+            if not self._dirty:
+                self.skipped += 1
+                return False
+            # clear first: a write racing with the copy below marks the next frame dirty
+            self._dirty = False
+            started = time.perf_counter()
+            frame = self.pixels.copy()
+            if hasattr(self.driver, "setPixels"):
+                self.driver.setPixels(frame)
+            else:
+                # rpi_ws281x has no bulk setter, so only pay for the pixels that changed
+                if self._shown is None:
+                    changed = range(self.num_pixels)
+                else:
+                    changed = np.flatnonzero(frame != self._shown).tolist()
+                values = frame.tolist()
+                for pos in changed:
+                    self.driver.setPixelColor(pos, values[pos])
+            self._shown = frame
+            if self._brightness is not None:
+                self.driver.setBrightness(self._brightness)
+            self.driver.show()
+            self.frames += 1
+            if self.on_present is not None:
+                self.on_present(started, time.perf_counter())
+            return True
+
+    def stop(self):
+        self._running = False
+        self._requested.set()
+        self._thread.join(timeout=1)
+
+    def _run(self):
+        while self._running:
+            self._requested.wait()
+            self._requested.clear()
+            if not self._running:
+                break
+            started = time.perf_counter()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"LED frame flush failed: {e}")
+            # frame rate cap; show() calls made meanwhile are presented right after
+            remaining = self.frame_interval - (time.perf_counter() - started)
+            if remaining > 0:
+                time.sleep(remaining)
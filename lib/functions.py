@@ -6,6 +6,7 @@ import threading
 import time
 
 import mido
+import numpy as np
 
 from lib.log_setup import logger
 from lib.rpi_drivers import GPIO, Color
@@ -161,24 +162,44 @@ def manage_idle_animation(ledstrip, ledsettings, menu, midiports):
         time.sleep(1)
 
 
-# Get note position on the strip
-def get_note_position(note, ledstrip, ledsettings):
-    note_offsets = ledsettings.note_offsets
-    note_offset = 0
-    for i in range(0, len(note_offsets)):
-        if note > note_offsets[i][0]:
-            note_offset = note_offsets[i][1]
-            # break
-
-    note_offset -= ledstrip.shift
+def build_note_map(
+    note_offsets, shift, reverse, leds_per_meter, num_leds, calibration=None
+):
+    """LED index of all 128 MIDI notes, and the lowest note of every LED (-1 for none).
+
+    Positions follow the key spacing for the strip density, corrected by
+    note_offsets (the last entry whose note is below the key wins), shift and
+    reverse. calibration holds the LED index set by the user for every note
+    (-1 where unset, see config.MidiToLedMapping) and overrides the computed
+    position.
+    """
+    notes = np.arange(128)
+    offsets = np.zeros(128)
+    for threshold, offset in note_offsets:
+        offsets[notes > threshold] = offset
+
+    density = leds_per_meter / 72
+    # astype truncates towards zero like int() did
+    positions = (density * (notes - 20) - (offsets - shift)).astype(np.int64)
+    if reverse:
+        positions = num_leds - positions
+    positions = np.maximum(0, positions)
+
+    if calibration is not None:
+        positions = np.where(calibration >= 0, calibration, positions)
+
+    note_to_led = positions.tolist()
+    led_to_note = [-1] * num_leds
+    # assign high to low so the lowest note wins on shared LEDs
+    for note in range(127, -1, -1):
+        if 0 <= note_to_led[note] < num_leds:
+            led_to_note[note_to_led[note]] = note
+    return note_to_led, led_to_note
 
-    density = ledstrip.leds_per_meter / 72
 
-    note_pos_raw = int(density * (note - 20) - note_offset)
-    if ledstrip.reverse:
-        return max(0, ledstrip.num_leds_on_strip() - note_pos_raw)
-    else:
-        return max(0, note_pos_raw)
+# Get note position on the strip
+def get_note_position(note, ledstrip, ledsettings):
+    return ledstrip.note_to_led[note]
 
 
 # scale: 1 means in C, scale: 2 means in C#, scale: 3 means in D, etc...
@@ -260,17 +281,18 @@ def check_if_led_can_be_overwrite(i, ledstrip, ledsettings):
 
 
 # LED animations
-def fastColorWipe(strip, update, ledsettings):
+def get_backlight_color(ledsettings):
     if ledsettings.backlight_stopped:
-        color = Color(0, 0, 0)
-    else:
-        brightness = ledsettings.backlight_brightness_percent / 100
-        red = int(ledsettings.get_backlight_color("Red") * brightness)
-        green = int(ledsettings.get_backlight_color("Green") * brightness)
-        blue = int(ledsettings.get_backlight_color("Blue") * brightness)
-        color = Color(red, green, blue)
-    for i in range(strip.numPixels()):
-        strip.setPixelColor(i, color)
+        return Color(0, 0, 0)
+    brightness = ledsettings.backlight_brightness_percent / 100
+    red = int(ledsettings.get_backlight_color("Red") * brightness)
+    green = int(ledsettings.get_backlight_color("Green") * brightness)
+    blue = int(ledsettings.get_backlight_color("Blue") * brightness)
+    return Color(red, green, blue)
+
+
+def fastColorWipe(strip, update, ledsettings):
+    strip.fill(get_backlight_color(ledsettings))
     if update:
         strip.show()
 
@@ -556,6 +578,5 @@ def startup_animation(ledstrip, ledsettings, appconfig=None):
     else:
         _startup_sweep(strip, num_leds, brightness, duration, timing)
 
-    for i in range(num_leds):
-        strip.setPixelColor(i, Color(0, 0, 0))
+    strip.fill(Color(0, 0, 0))
     strip.show()
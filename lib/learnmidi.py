@@ -1,6 +1,5 @@
 import ast
 import os
-import pickle
 import subprocess
 import threading
 import time
@@ -8,9 +7,21 @@ import time
 import mido
 import numpy as np
 
+from lib.compiled_song import (
+    KIND_NOTE_OFF,
+    KIND_NOTE_ON,
+    compile_midi,
+    event_to_message,
+    get_compiled_song_path,
+    load_compiled_song,
+    save_compiled_song,
+)
 from lib.functions import clamp, fastColorWipe, get_note_position
 from lib.log_setup import logger
+from lib.pubsub import EventStream
 from lib.rpi_drivers import Color
+from lib.scheduler import DeadlineScheduler
+from lib.step_index import StepIndex
 
 
 def find_nearest(array, target):
@@ -19,14 +30,6 @@ def find_nearest(array, target):
     return idx
 
 
-# Get midi song tempo
-def get_tempo(mid):
-    for msg in mid:  # Search for tempo
-        if msg.type == "set_tempo":
-            return msg.tempo
-    return 500000  # If not found return default tempo
-
-
 class LearnMIDI:
     def __init__(self, usersettings, ledsettings, midiports, ledstrip):
         self.usersettings = usersettings
@@ -50,7 +53,8 @@ class LearnMIDI:
         )
 
         self.notes_time = []
-        self.socket_send = []
+        # song time of every played event, followed by the /learning websocket
+        self.progress = EventStream(maxlen=256)
 
         self.is_loop_active = int(usersettings.get_setting_value("is_loop_active"))
 
@@ -64,7 +68,11 @@ class LearnMIDI:
         )
 
         self.song_tempo = 500000
+        self.song = None
         self.song_tracks = []
+        self.schedule = []
+        self.steps = None
+        self.scheduler = DeadlineScheduler()
         self.ticks_per_beat = 240
         self.is_loaded_midi = {}
         self.is_started_midi = False
@@ -95,13 +103,18 @@ class LearnMIDI:
 
     def restart_learning(self):
         if self.is_started_midi:
-            self.is_started_midi = False
+            self.stop_learning()
             self.t.join()
             self.t = threading.Thread(target=self.learn_midi)
             self.t.start()
 
+    def stop_learning(self):
+        self.is_started_midi = False
+        self.midiports.wake()  # release the learning thread if it waits for keys
+
     def restart_loop(self):
         self.awaiting_restart_loop = True
+        self.midiports.wake()
 
     def change_start_point(self, value):
         self.start_point += 5 * value
@@ -151,28 +164,32 @@ class LearnMIDI:
             self.hand_colorL = clamp(self.hand_colorL, 0, len(self.hand_colorList) - 1)
             self.usersettings.change_setting_value("hand_colorL", self.hand_colorL)
 
+    def set_song(self, song):
+        self.song = song
+        self.song_tempo = song.song_tempo
+        self.ticks_per_beat = song.ticks_per_beat
+        self.song_tracks = song.events
+        self.notes_time = song.events["time"]
+        # absolute event times from the tempo map; set_tempo only rescales the scheduler
+        self.schedule = song.events["time"]
+        self.steps = StepIndex(song.events)
+
+    def get_timing_stats(self):
+        return self.scheduler.stats()
+
     def load_song_from_cache(self, song_path):
         # Load song from cache
         try:
-            cache_path = (
-                "cache/" + os.path.basename(song_path) + ".p"
-            )  # cache uses just the filename, not the folder path
-            if os.path.isfile(cache_path):
-                logger.info("Loading song from cache")
-                with open(cache_path, "rb") as handle:
-                    cache = pickle.load(
-                        handle
-                    )  # deserialization holds GIL but only for CPU work, not disk wait
-                    self.song_tempo = cache["song_tempo"]
-                    self.ticks_per_beat = cache["ticks_per_beat"]
-                    self.song_tracks = cache["song_tracks"]
-                    self.notes_time = cache["notes_time"]
-                    self.loading = 4
-                    return True
-            else:
+            song = load_compiled_song(get_compiled_song_path(song_path), song_path)
+            if song is None:
                 return False
+            logger.info("Loading song from cache")
+            self.set_song(song)
+            self.loading = 4
+            return True
         except Exception as e:
             logger.warning(e)
+            return False
 
     def load_midi(self, song_path):
         while 4 > self.loading > 0:
@@ -184,7 +201,7 @@ class LearnMIDI:
         self.is_loaded_midi.clear()
         self.is_loaded_midi[song_path] = True
         self.loading = 1  # 1 = Load..
-        self.is_started_midi = False  # Stop current learning song
+        self.stop_learning()  # Stop current learning song
         self.t = threading.current_thread()
 
         # Load song from cache
@@ -199,50 +216,17 @@ class LearnMIDI:
                 clip=True,  # song_path is now the full resolved path from the caller
             )  # clip=True fixes some midi files
 
-            # Get tempo and Ticks per beat
-            self.song_tempo = get_tempo(mid)
-            self.ticks_per_beat = mid.ticks_per_beat
-
-            # Assign Tracks to different channels before merging to know the message origin
+            # Assign tracks to hands, merge them and compute absolute times
             self.loading = 2  # 2 = Proces
-            if len(mid.tracks) == 2:  # check if the midi file has only 2 Tracks
-                offset = 1
-            else:
-                offset = 0
-            for k in range(len(mid.tracks)):
-                for msg in mid.tracks[k]:
-                    if not msg.is_meta and msg.type in ["note_on", "note_off"]:
-                        msg.channel = min(
-                            k + offset, 15
-                        )  # clamp to valid MIDI channel range (0-15); songs with 16+ tracks would overflow otherwise
-                        if msg.type == "note_off":
-                            msg.velocity = 0
-
-            # Merge tracks
+            song = compile_midi(mid)
+
             self.loading = 3  # 3 = Merge
-            self.song_tracks = mido.merge_tracks(mid.tracks)
-            time_passed = 0
-            self.notes_time.clear()
-            for msg in mid:
-                if not msg.is_meta:
-                    time_passed += msg.time
-                    self.notes_time.append(time_passed)
+            self.set_song(song)
 
             fastColorWipe(self.ledstrip.strip, True, self.ledsettings)
 
             # Save to cache
-            os.makedirs("cache", exist_ok=True)  # ensure cache folder exists
-            cache_path = (
-                "cache/" + os.path.basename(song_path) + ".p"
-            )  # just the filename for cache key
-            with open(cache_path, "wb") as handle:
-                cache = {
-                    "song_tempo": self.song_tempo,
-                    "ticks_per_beat": self.ticks_per_beat,
-                    "notes_time": self.notes_time,
-                    "song_tracks": self.song_tracks,
-                }
-                pickle.dump(cache, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            save_compiled_song(song, get_compiled_song_path(song_path), song_path)
 
             self.loading = 4  # 4 = Done
         except Exception as e:
@@ -250,71 +234,40 @@ class LearnMIDI:
             self.loading = 5  # 5 = Error!
             self.is_loaded_midi.clear()
 
-    # predict future notes in MIDI messages
-    def predict_future_notes(self, starting_note, ending_note, notes_to_press):
+    # predict future notes: the chord of the step after the one being waited for
+    def predict_future_notes(self, step, end_idx, chord):
         if self.show_future_notes != 1:
             return
 
-        predicted_future_notes = []
-        current_note = starting_note
-        for msg in self.song_tracks[starting_note:ending_note]:
-            # Get time delay
-            tDelay = mido.tick2second(
-                msg.time, self.ticks_per_beat, self.song_tempo * 100 / self.set_tempo
-            )
-
-            if (
-                not msg.is_meta
-                and tDelay > 0
-                and (msg.type == "note_on" or msg.type == "note_off")
-                and predicted_future_notes
-                and self.practice == 0
-            ):
-                self.light_up_predicted_future_notes(predicted_future_notes)
-                return
-
-            if msg.type == "note_on" and msg.velocity > 0:
-                # make sure msg.note is not in notes_to_press list
-                if msg.note not in notes_to_press:
-                    predicted_future_notes.append(msg)
-
-            current_note += 1
+        predicted_future_notes = [
+            (note, channel)
+            for note, channel in self.steps.next_notes(step, end_idx)
+            if not chord >> note & 1  # make sure note is not in the chord to press
+        ]
+        if predicted_future_notes and self.practice == 0:
+            self.light_up_predicted_future_notes(predicted_future_notes)
 
     def light_up_predicted_future_notes(self, notes):
         dim = 10
-        for msg in notes:
+        for note, channel in notes:
             # Light-up LEDs with the notes to press
-            if not msg.is_meta:
-                # Calculate note position on the strip and display
-                if msg.type == "note_on" or msg.type == "note_off":
-                    note_position = get_note_position(
-                        msg.note, self.ledstrip, self.ledsettings
-                    )
+            # Calculate note position on the strip and display
+            note_position = get_note_position(note, self.ledstrip, self.ledsettings)
 
-                    brightness = 0.5
-                    brightness /= dim
-                    red, green, blue = [0, 0, 0]
-                    if msg.channel == 1:
-                        # red = int(self.hand_colorList[self.hand_colorR][0] * brightness)
-                        # green = int(self.hand_colorList[self.hand_colorR][1] * brightness)
-                        # blue = int(self.hand_colorList[self.hand_colorR][2] * brightness)
-                        red, green, blue = [
-                            int(c * brightness)
-                            for c in self.hand_colorList[self.hand_colorR]
-                        ]
-                    if msg.channel == 2:
-                        # red = int(self.hand_colorList[self.hand_colorL][0] * brightness)
-                        # green = int(self.hand_colorList[self.hand_colorL][1] * brightness)
-                        # blue = int(self.hand_colorList[self.hand_colorL][2] * brightness)
-                        red, green, blue = [
-                            int(c * brightness)
-                            for c in self.hand_colorList[self.hand_colorL]
-                        ]
-
-                    self.ledstrip.strip.setPixelColor(
-                        note_position, Color(red, green, blue)
-                    )
-                    self.ledstrip.strip.show()
+            brightness = 0.5
+            brightness /= dim
+            red, green, blue = [0, 0, 0]
+            if channel == 1:
+                red, green, blue = [
+                    int(c * brightness) for c in self.hand_colorList[self.hand_colorR]
+                ]
+            if channel == 2:
+                red, green, blue = [
+                    int(c * brightness) for c in self.hand_colorList[self.hand_colorL]
+                ]
+
+            self.ledstrip.strip.setPixelColor(note_position, Color(red, green, blue))
+        self.ledstrip.strip.show()
 
     def handle_wrong_notes(self, wrong_notes):
         if self.show_wrong_notes != 1:
@@ -342,6 +295,45 @@ class LearnMIDI:
 
         self.ledstrip.strip.show()
 
+    def wait_for_chord(self, step, end_idx, chord):
+        notes_pressed = 0
+        wrong_notes = []
+        self.predict_future_notes(step, end_idx, chord)
+        while notes_pressed & chord != chord and self.is_started_midi:
+            if self.awaiting_restart_loop:
+                break
+            # sleep until a key event arrives; stop/restart wake us up as well,
+            # the timeout only guards against flags changed without a wake()
+            if not self.midiports.wait_for_midi(timeout=0.5):
+                continue
+            while self.midiports.midi_queue:
+                msg_in, msg_timestamp = self.midiports.midi_queue.popleft()
+                if msg_in.type not in ("note_on", "note_off"):
+                    continue
+
+                bit = 1 << msg_in.note
+
+                if "note_off" in str(msg_in):
+                    velocity = 0
+                else:
+                    velocity = msg_in.velocity
+
+                # check if note is in the chord to press
+                if not chord & bit:
+                    wrong_notes.append(msg_in)
+
+                if velocity > 0:
+                    notes_pressed |= bit
+                else:
+                    notes_pressed &= ~bit
+
+            self.handle_wrong_notes(wrong_notes)
+            wrong_notes.clear()
+
+            # light up predicted future notes again in case the future note was pressed
+            # and color was overwritten
+            self.predict_future_notes(step, end_idx, chord)
+
     def learn_midi(self):
         # Preliminary checks
         if self.is_started_midi:
@@ -363,168 +355,105 @@ class LearnMIDI:
             time.sleep(1)
             try:
                 fastColorWipe(self.ledstrip.strip, True, self.ledsettings)
-                time_prev = time.time()
-                notes_to_press = []
 
                 start_idx = int(self.start_point * len(self.song_tracks) / 100)
                 end_idx = int(self.end_point * len(self.song_tracks) / 100)
 
-                # self.current_idx does not count meta messages (used for sheet music sync in web interface)
-                # absolute_idx counts all messages (used for predicting messages)
+                # self.current_idx is the index of the processed event (used for sheet music sync in web interface)
 
                 self.current_idx = start_idx
-                absolute_idx = start_idx
-
-                for msg in self.song_tracks[start_idx:end_idx]:
+                if start_idx > 0:
+                    self.scheduler.start(
+                        float(self.schedule[start_idx - 1]), self.set_tempo / 100
+                    )
+                else:
+                    self.scheduler.start(0.0, self.set_tempo / 100)
+
+                # only wait for chords that were lit completely since the loop start
+                first_step = self.steps.step_at(start_idx)
+
+                events = self.song_tracks[start_idx:end_idx].tolist()
+                event_times = self.schedule[start_idx:end_idx].tolist()
+                wait_steps = self.steps.wait_step[start_idx:end_idx].tolist()
+                for event, event_time, wait_step in zip(
+                    events, event_times, wait_steps
+                ):
+                    tick, note_time, kind, note, velocity, channel = event
                     self.midiports.last_activity = time.time()
                     # Exit thread if learning is stopped
                     if not self.is_started_midi:
                         break
 
-                    # Get time delay
-                    tDelay = mido.tick2second(
-                        msg.time,
-                        self.ticks_per_beat,
-                        self.song_tempo * 100 / self.set_tempo,
-                    )
+                    # Tempo slider only moves the scheduler anchor
+                    self.scheduler.set_speed(self.set_tempo / 100)
+
+                    is_note = kind in (KIND_NOTE_ON, KIND_NOTE_OFF)
+
+                    self.progress.publish(note_time)
 
                     # Check notes to press
-                    if not msg.is_meta:
-                        try:
-                            self.socket_send.append(self.notes_time[self.current_idx])
-                        except Exception as e:
-                            logger.warning(e)
-
-                        self.current_idx += 1
-
-                        if (
-                            tDelay > 0
-                            and (msg.type == "note_on" or msg.type == "note_off")
-                            and notes_to_press
-                            and self.practice == 0
-                        ):
-                            notes_pressed = []
-                            wrong_notes = []
-                            self.predict_future_notes(
-                                absolute_idx, end_idx, notes_to_press
-                            )
-                            while (
-                                not set(notes_to_press).issubset(notes_pressed)
-                                and self.is_started_midi
-                            ):
-                                if self.awaiting_restart_loop:
-                                    break
-                                while self.midiports.midi_queue:
-                                    msg_in, msg_timestamp = (
-                                        self.midiports.midi_queue.popleft()
-                                    )
-                                    if msg_in.type not in ("note_on", "note_off"):
-                                        continue
-
-                                    note = msg_in.note
-
-                                    if "note_off" in str(msg_in):
-                                        velocity = 0
-                                    else:
-                                        velocity = msg_in.velocity
-
-                                    # check if note is in the list of notes to press
-                                    if note not in notes_to_press:
-                                        wrong_notes.append(msg_in)
-
-                                    if velocity > 0:
-                                        if note not in notes_pressed:
-                                            notes_pressed.append(note)
-                                    else:
-                                        try:
-                                            notes_pressed.remove(note)
-                                        except ValueError:
-                                            pass  # do nothing
-
-                                self.handle_wrong_notes(wrong_notes)
-                                wrong_notes.clear()
-
-                                # light up predicted future notes again in case the future note was pressed
-                                # and color was overwritten
-                                self.predict_future_notes(
-                                    absolute_idx, end_idx, notes_to_press
-                                )
-
-                            # Turn off the pressed LEDs
-                            fastColorWipe(
-                                self.ledstrip.strip, True, self.ledsettings
-                            )  # ideally clear only pressed notes!
-                            notes_to_press.clear()
-
-                    # Realize time delay, consider also the time lost during computation
-                    delay = max(
-                        0, tDelay - (time.time() - time_prev) - 0.003
-                    )  # 0.003 sec calibratable to acount for extra time loss
-                    time.sleep(delay)
-                    time_prev = time.time()
+                    if wait_step >= first_step and self.practice == 0:
+                        chord = self.steps.chord(wait_step, self.hands)
+                    else:
+                        chord = 0
+
+                    if chord:
+                        self.wait_for_chord(wait_step, end_idx, chord)
+
+                        # Turn off the pressed LEDs
+                        fastColorWipe(
+                            self.ledstrip.strip, True, self.ledsettings
+                        )  # ideally clear only pressed notes!
+
+                        # the song continues from here once the keys are pressed
+                        self.scheduler.resync(event_time)
+
+                    # Sleep to the absolute deadline of this event
+                    self.scheduler.wait_until(event_time)
 
                     # Light-up LEDs with the notes to press
-                    if not msg.is_meta:
-                        # Calculate note position on the strip and display
-                        if msg.type == "note_on" or msg.type == "note_off":
-                            note_position = get_note_position(
-                                msg.note, self.ledstrip, self.ledsettings
-                            )
-                            if msg.velocity == 0:
-                                brightness = 0
-                            else:
-                                brightness = 0.5
-
-                            red, green, blue = [0, 0, 0]
-                            if msg.channel == 1:
-                                # red = int(self.hand_colorList[self.hand_colorR][0] * brightness)
-                                # green = int(self.hand_colorList[self.hand_colorR][1] * brightness)
-                                # blue = int(self.hand_colorList[self.hand_colorR][2] * brightness)
-                                red, green, blue = [
-                                    int(c * brightness)
-                                    for c in self.hand_colorList[self.hand_colorR]
-                                ]
-                            if msg.channel == 2:
-                                # red = int(self.hand_colorList[self.hand_colorL][0] * brightness)
-                                # green = int(self.hand_colorList[self.hand_colorL][1] * brightness)
-                                # blue = int(self.hand_colorList[self.hand_colorL][2] * brightness)
-                                red, green, blue = [
-                                    int(c * brightness)
-                                    for c in self.hand_colorList[self.hand_colorL]
-                                ]
-                            self.ledstrip.strip.setPixelColor(
-                                note_position, Color(red, green, blue)
-                            )
-                            self.ledstrip.strip.show()
-
-                        # Save notes to press
-                        if (
-                            msg.type == "note_on"
-                            and msg.velocity > 0
-                            and (msg.channel == self.hands or self.hands == 0)
-                        ):
-                            notes_to_press.append(msg.note)
-
-                        # Play selected Track
-                        if (
-                            (
-                                self.hands == 1
-                                and self.mute_hand != 2
-                                and msg.channel == 2
-                            )
-                            or
-                            # send midi sound for Left hand
-                            (
-                                self.hands == 2
-                                and self.mute_hand != 1
-                                and msg.channel == 1
+                    # Calculate note position on the strip and display
+                    if is_note:
+                        note_position = get_note_position(
+                            note, self.ledstrip, self.ledsettings
+                        )
+                        if velocity == 0:
+                            brightness = 0
+                        else:
+                            brightness = 0.5
+
+                        red, green, blue = [0, 0, 0]
+                        if channel == 1:
+                            red, green, blue = [
+                                int(c * brightness)
+                                for c in self.hand_colorList[self.hand_colorR]
+                            ]
+                        if channel == 2:
+                            red, green, blue = [
+                                int(c * brightness)
+                                for c in self.hand_colorList[self.hand_colorL]
+                            ]
+                        self.ledstrip.strip.setPixelColor(
+                            note_position, Color(red, green, blue)
+                        )
+                        self.ledstrip.strip.show()
+
+                    # Play selected Track
+                    if (
+                        (self.hands == 1 and self.mute_hand != 2 and channel == 2)
+                        or
+                        # send midi sound for Left hand
+                        (self.hands == 2 and self.mute_hand != 1 and channel == 1)
+                        or
+                        # send midi sound for Right hand
+                        self.practice == 2
+                    ):  # send midi sound for Listen only
+                        self.midiports.playport.send(
+                            event_to_message(
+                                kind, note, velocity, channel, self.song.sysex
                             )
-                            or
-                            # send midi sound for Right hand
-                            self.practice == 2
-                        ):  # send midi sound for Listen only
-                            self.midiports.playport.send(msg)
-                    absolute_idx += 1
+                        )
+                    self.current_idx += 1
 
                     if self.awaiting_restart_loop:
                         self.awaiting_restart_loop = False
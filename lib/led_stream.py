@@ -0,0 +1,64 @@
+import struct
+
+import numpy as np
+
+# Binary LED emulator protocol (/ledemu?format=binary), little-endian:
+#   keyframe: u8 FRAME_KEY   | u16 pixel count | count * (r, g, b)
+#   delta:    u8 FRAME_DELTA | u16 run count   | runs of u16 start, u16 length, length * (r, g, b)
+# A client gets a keyframe on connect; afterwards only deltas against the last
+# frame it received, or a keyframe when that is smaller than the delta.
+FRAME_KEY = 1
+FRAME_DELTA = 2
+
+_HEADER = struct.Struct("<BH")
+_RUN = struct.Struct("<HH")
+# a run header costs 4 bytes, so gaps of one unchanged pixel (3 bytes) are cheaper to resend
+_MAX_GAP = 1
+
+
+def encode_keyframe(rgb):
+    """(N, 3) uint8 frame to a keyframe message."""
+    return _HEADER.pack(FRAME_KEY, len(rgb)) + np.ascontiguousarray(rgb).tobytes()
+
+
+def encode_delta(prev, rgb):
+    """Smallest message turning frame prev into rgb, or None if nothing changed."""
+    if prev is None or len(prev) != len(rgb):
+        return encode_keyframe(rgb)
+
+    changed = np.flatnonzero((prev != rgb).any(axis=1))
+    if len(changed) == 0:
+        return None
+
+    # split the changed pixels into runs wherever the gap is too large to bridge
+    breaks = np.flatnonzero(np.diff(changed) > _MAX_GAP + 1)
+    starts = changed[np.concatenate(([0], breaks + 1))].tolist()
+    stops = (changed[np.concatenate((breaks, [len(changed) - 1]))] + 1).tolist()
+
+    parts = [_HEADER.pack(FRAME_DELTA, len(starts))]
+    for start, stop in zip(starts, stops):
+        parts.append(_RUN.pack(start, stop - start))
+        parts.append(rgb[start:stop].tobytes())
+    message = b"".join(parts)
+
+    keyframe_size = _HEADER.size + rgb.size
+    if len(message) >= keyframe_size:
+        return encode_keyframe(rgb)
+    return message
+
+
+def apply_frame(rgb, message):
+    """Decodes a message onto frame rgb (modified in place, or replaced by a keyframe)."""
+    kind, count = _HEADER.unpack_from(message)
+    data = memoryview(message)[_HEADER.size :]
+    if kind == FRAME_KEY:
+        return np.frombuffer(data, dtype=np.uint8).reshape(count, 3).copy()
+
+    offset = 0
+    for _ in range(count):
+        start, length = _RUN.unpack_from(data, offset)
+        offset += _RUN.size
+        run = np.frombuffer(data[offset : offset + length * 3], dtype=np.uint8)
+        rgb[start : start + length] = run.reshape(length, 3)
+        offset += length * 3
+    return rgb
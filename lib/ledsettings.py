@@ -1,5 +1,6 @@
 import ast
 
+import lib.colormaps as cmap
 from lib.functions import clamp, fastColorWipe, find_between
 from lib.rpi_drivers import Color
 from lib.usersettings import UserSettings
@@ -53,6 +54,7 @@ class LedSettings:
         self.multicolor_iteration = ast.literal_eval(
             usersettings.get_setting_value("multicolor_iteration")
         )
+        self.multicolor_table = None
 
         self.sequence_active = usersettings.get_setting_value("sequence_active")
 
@@ -165,23 +167,39 @@ class LedSettings:
         # if self.mode == "Disabled" and self.color_mode != "disabled":
         #    usersettings.change_setting_value("color_mode", "disabled")
 
+    def update_note_map(self):
+        if self.ledstrip is not None:
+            self.ledstrip.update_note_map()
+
+    def update_multicolor(self):
+        """Rebuilds the ^Multicolor gradient and the per note Multicolor table."""
+        cmap.update_multicolor(self.multicolor_range, self.multicolor)
+        self.multicolor_table = cmap.multicolor_note_table(
+            self.multicolor_range, self.multicolor
+        )
+        self.incoming_setting_change = True
+
     def add_note_offset(self):
         self.note_offsets.insert(0, [100, 1])
         self.usersettings.change_setting_value("note_offsets", self.note_offsets)
+        self.update_note_map()
 
     def append_note_offset(self):
         self.note_offsets.append([1, 1])
         self.usersettings.change_setting_value("note_offsets", self.note_offsets)
+        self.update_note_map()
 
     def del_note_offset(self, slot):
         del self.note_offsets[int(slot) - 1]
         self.usersettings.change_setting_value("note_offsets", self.note_offsets)
+        self.update_note_map()
 
     def update_note_offset(self, slot, data):
         pair = data.split(",")
         self.note_offsets[int(slot) - 1][0] = int(pair[0])
         self.note_offsets[int(slot) - 1][1] = int(pair[1])
         self.usersettings.change_setting_value("note_offsets", self.note_offsets)
+        self.update_note_map()
 
     def update_note_offset_lcd(self, current_choice, currentlocation, value):
         slot = int(currentlocation.replace("Offset", "")) - 1
@@ -190,6 +208,7 @@ class LedSettings:
         else:
             self.note_offsets[slot][1] += value
         self.usersettings.change_setting_value("note_offsets", self.note_offsets)
+        self.update_note_map()
 
     def addcolor(self):
         self.multicolor.append([0, 255, 0])
@@ -200,7 +219,7 @@ class LedSettings:
             "multicolor_range", self.multicolor_range
         )
 
-        self.incoming_setting_change = True
+        self.update_multicolor()
 
     def deletecolor(self, key):
         del self.multicolor[int(key) - 1]
@@ -211,7 +230,7 @@ class LedSettings:
             "multicolor_range", self.multicolor_range
         )
 
-        self.incoming_setting_change = True
+        self.update_multicolor()
 
     def change_multicolor(self, choice, location, value):
         self.sequence_active = False
@@ -229,7 +248,7 @@ class LedSettings:
         )
 
         self.usersettings.change_setting_value("multicolor", self.multicolor)
-        self.incoming_setting_change = True
+        self.update_multicolor()
 
     def change_multicolor_range(self, choice, location, value):
         location = location.replace("Key_range", "")
@@ -243,7 +262,7 @@ class LedSettings:
         self.usersettings.change_setting_value(
             "multicolor_range", self.multicolor_range
         )
-        self.incoming_setting_change = True
+        self.update_multicolor()
 
     def get_multicolors(self, number):
         number = int(number) - 1
@@ -1,5 +1,8 @@
+import numpy as np
+
 import lib.colormaps as cmap
-from lib.functions import clamp
+from lib.frame_compositor import FrameCompositor
+from lib.functions import build_note_map, clamp
 from lib.LED_drivers import PixelStrip_Emu
 from lib.log_setup import logger
 from lib.rpi_drivers import Color, PixelStrip, ws
@@ -21,11 +24,13 @@ class LedStrip:
 
         self.brightness = 255 * self.brightness_percent / 100
         self.led_gamma = float(usersettings.get_setting_value("led_gamma"))
+        self.led_fps = int(usersettings.get_setting_value("led_fps"))
 
         # Hold individual led state information, initialized in init_strip()
         self.keylist = None
         self.keylist_status = None
         self.keylist_color = None
+        self.keylist_decay = None
 
         # LED strip configuration:
         self.LED_PIN = 18  # GPIO pin connected to the pixels (18 uses PWM!).
@@ -40,18 +45,32 @@ class LedStrip:
 
         self.WEBEMU_FPS = 10
 
+        # note -> LED index and LED index -> note (-1 for none), see update_note_map()
+        self.note_to_led = None
+        self.led_to_note = None
+        self.midi_led_mapping = None
+
+        # driver_strip is the ws281x (or emu) driver; strip is the FrameCompositor every producer draws to
+        self.driver_strip = None
+        self.strip = None
+
         self.init_strip()
+        self.update_note_map()
 
     def init_strip(self):
         num_leds_on_strip = self.config.num_leds_on_strip()
-        self.keylist = [0] * num_leds_on_strip
-        self.keylist_status = [0] * num_leds_on_strip
-        self.keylist_color = [0] * num_leds_on_strip
+        self.keylist = np.zeros(num_leds_on_strip, dtype=np.int32)
+        self.keylist_status = np.zeros(num_leds_on_strip, dtype=np.int32)
+        self.keylist_color = np.zeros((num_leds_on_strip, 3), dtype=np.uint8)
+        self.keylist_decay = np.zeros(num_leds_on_strip, dtype=np.float32)
+
+        if self.strip is not None:
+            self.strip.stop()
 
         if self.driver == "rpi_ws281x":
             try:
                 # Create NeoPixel object with appropriate configuration.
-                self.strip = PixelStrip(
+                self.driver_strip = PixelStrip(
                     num_leds_on_strip,
                     self.LED_PIN,
                     self.LED_FREQ_HZ,
@@ -62,9 +81,9 @@ class LedStrip:
                     ws.WS2811_STRIP_GRB,
                 )
                 # Intialize the library (must be called once before other functions).
-                self.strip.begin()
-                if "releaseGIL" in dir(self.strip):
-                    self.strip.releaseGIL()
+                self.driver_strip.begin()
+                if "releaseGIL" in dir(self.driver_strip):
+                    self.driver_strip.releaseGIL()
                 self.change_gamma(self.led_gamma)
             except Exception as e:
                 logger.warning(e)
@@ -73,24 +92,64 @@ class LedStrip:
                     # rpi_ws281x registers _cleanup() atexit, but if it's not initialized ws2811_fini will segfault.
                     # Manually clean up memory, then bypass _cleanup() using knowledge that _cleanup() checks _leds first
                     logger.info("Cleaning up ws281x instance.")
-                    ws.delete_ws2811_t(self.strip._leds)
-                    self.strip._leds = None
+                    ws.delete_ws2811_t(self.driver_strip._leds)
+                    self.driver_strip._leds = None
 
                 logger.info("Failed to load LED strip.  Using emu driver.")
-                self.strip = PixelStrip_Emu(num_leds_on_strip)
+                self.driver_strip = PixelStrip_Emu(num_leds_on_strip)
                 self.driver = "emu"
         elif self.driver == "emu":
-            self.strip = PixelStrip_Emu(num_leds_on_strip)
+            self.driver_strip = PixelStrip_Emu(num_leds_on_strip)
+
+        self.strip = FrameCompositor(self.driver_strip, self.led_fps)
+        self.strip.setBrightness(int(self.brightness))
+
+    def set_midi_led_mapping(self, midi_led_mapping):
+        """Uses the calibration table (config.MidiToLedMapping) for note positions."""
+        self.midi_led_mapping = midi_led_mapping
+        self.update_note_map()
+
+    def update_note_map(self):
+        """Rebuilds the note <-> LED lookup tables.
+
+        Called whenever shift, reverse, note offsets, strip density or the
+        calibration table change, so lighting a key is a list lookup.
+        """
+        calibration = None
+        if self.midi_led_mapping is not None:
+            calibration = self.midi_led_mapping.led_index
+        self.note_to_led, self.led_to_note = build_note_map(
+            self.ledsettings.note_offsets,
+            self.shift,
+            self.reverse,
+            self.leds_per_meter,
+            self.config.num_leds_on_strip(),
+            calibration,
+        )
+
+    def change_leds_per_meter(self):
+        self.leds_per_meter = self.config.num_leds_per_meter()
+        self.update_note_map()
 
     def change_gamma(self, value):
         self.led_gamma = float(value)
         if 0.01 <= self.led_gamma <= 10.0:
             if self.driver == "rpi_ws281x":
                 # rpi_ws281x.py interface has no ported method to set gamma by factor, using direct ws
-                ws.ws2811_set_custom_gamma_factor(self.strip._leds, self.led_gamma)
+                ws.ws2811_set_custom_gamma_factor(
+                    self.driver_strip._leds, self.led_gamma
+                )
+                # gamma is applied when the driver renders, so present the frame again
+                if self.strip is not None:
+                    self.strip.refresh()
+
+            # colormaps in use are rebuilt for the new gamma on their next lookup
+            cmap.set_gamma(self.led_gamma)
 
-            # Rebuild colormaps
-            cmap.generate_colormaps(cmap.gradients, self.led_gamma)
+    def change_fps(self, value):
+        self.led_fps = clamp(int(value), 1, 200)
+        self.usersettings.change_setting_value("led_fps", self.led_fps)
+        self.strip.set_fps(self.led_fps)
 
     def change_brightness(self, value, ispercent=False):
         if ispercent:
@@ -112,6 +171,7 @@ class LedStrip:
         else:
             self.shift += value
         self.usersettings.change_setting_value("shift", self.shift)
+        self.update_note_map()
 
     def change_reverse(self, value, fixed_number=False):
         if fixed_number:
@@ -120,6 +180,7 @@ class LedStrip:
             self.reverse += value
         self.reverse = clamp(self.reverse, 0, 1)
         self.usersettings.change_setting_value("reverse", self.reverse)
+        self.update_note_map()
 
     def set_adjacent_colors(self, note, color, led_turn_off, fading=1):
         if (
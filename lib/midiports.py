@@ -6,6 +6,7 @@ import mido
 
 from lib import connectall
 from lib.log_setup import logger
+from lib.pubsub import EventStream
 
 
 class MidiPorts:
@@ -16,13 +17,16 @@ class MidiPorts:
             deque()
         )  # midi queue will contain a tuple (midi_msg, timestamp)
         self.midi_queue = deque()
+        # notified on every queued key event so consumers can sleep instead of polling
+        self.midi_event = threading.Condition()
         self.last_activity = 0
         self.inport = None
         self.playport = None
         self.midipending = None
         self.currently_pressed_keys = []
         self._keys_lock = threading.Lock()
-        self.frontend_events = deque()  # drained by /api/drain_midi_events on each poll
+        # key events for the frontend: pushed on the /midi_events websocket, polled via /api/drain_midi_events
+        self.frontend_events = EventStream(maxlen=1024)
 
         # mido backend python-rtmidi has a bug on some (debian-based) systems
         # involving the library location of alsa plugins
@@ -85,6 +89,21 @@ class MidiPorts:
 
         self.portname = "inport"
 
+    def wait_for_midi(self, timeout=None):
+        """Blocks until midi_queue has a message, wake() is called or timeout expires.
+
+        Returns True if there is something to read from midi_queue.
+        """
+        with self.midi_event:
+            if not self.midi_queue:
+                self.midi_event.wait(timeout)
+            return bool(self.midi_queue)
+
+    def wake(self):
+        """Wakes up every thread blocked in wait_for_midi."""
+        with self.midi_event:
+            self.midi_event.notify_all()
+
     def connectall(self):
         self.reconnect_ports()
         connectall.connectall()
@@ -126,6 +145,13 @@ class MidiPorts:
             logger.info("Can't reconnect play port: " + port)
 
     def msg_callback(self, msg):
+        if msg.type == "control_change" and msg.control == 64:
+            # sustain pedal, used by the fade modes of the render engine
+            self.midi_queue.append((msg, time.perf_counter()))
+            with self.midi_event:
+                self.midi_event.notify_all()
+            return
+
         if msg.type not in (
             "note_on",
             "note_off",
@@ -156,6 +182,13 @@ class MidiPorts:
                 ]
 
         self.midi_queue.append((msg, time.perf_counter()))
+        with self.midi_event:
+            self.midi_event.notify_all()
 
         Event = {"type": msg.type, "note": msg.note, "velocity": msg.velocity}
-        self.frontend_events.append(Event)
+        self.frontend_events.publish(Event)
+
+    def get_pressed_keys(self):
+        with self._keys_lock:
+            snapshot = list(self.currently_pressed_keys)
+        return [{"note": msg.note, "velocity": msg.velocity} for msg in snapshot]
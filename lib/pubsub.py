@@ -0,0 +1,105 @@
+import asyncio
+import threading
+from collections import deque
+from itertools import islice
+
+
+class EventStream:
+    """Bounded, thread-safe event log with sequence numbers.
+
+    Producers (MIDI callbacks, the learning thread) publish from any thread.
+    Every reader keeps its own cursor, the sequence number of the last event
+    it has seen, so any number of readers can follow the stream without
+    removing anything from it. Once maxlen events are buffered the oldest
+    are dropped; readers that fall that far behind are told how many they
+    missed instead of blocking the producer.
+    """
+
+    def __init__(self, maxlen=1024):
+        self._buffer = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self.seq = 0
+
+    def publish(self, item):
+        with self._lock:
+            self.seq += 1
+            self._buffer.append((self.seq, item))
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.notify()
+
+    def read(self, cursor):
+        """Events published after cursor, as (items, new cursor, dropped count)."""
+        with self._lock:
+            seq = self.seq
+            if cursor >= seq:
+                return [], seq, 0
+            oldest = self._buffer[0][0] if self._buffer else seq + 1
+            dropped = max(0, oldest - cursor - 1)
+            count = seq - max(cursor, oldest - 1)
+            # newest events are at the right, walk only the part the reader is missing
+            items = [item for _, item in islice(reversed(self._buffer), count)]
+        items.reverse()
+        return items, seq, dropped
+
+    def latest(self):
+        """The last published event, or None."""
+        with self._lock:
+            return self._buffer[-1][1] if self._buffer else None
+
+    def subscribe(self, loop=None, cursor=None):
+        """Follows the stream from an asyncio event loop, starting after cursor (default: now)."""
+        subscription = Subscription(self, loop or asyncio.get_running_loop(), cursor)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+
+class Subscription:
+    """Async reader of an EventStream, woken by publishers through call_soon_threadsafe."""
+
+    def __init__(self, stream, loop, cursor=None):
+        self.stream = stream
+        self.loop = loop
+        self.cursor = stream.seq if cursor is None else cursor
+        self._event = asyncio.Event()
+        # one pending wake-up per batch, however many events are published meanwhile
+        self._scheduled = False
+
+    def notify(self):
+        if self._scheduled:
+            return
+        self._scheduled = True
+        try:
+            self.loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            # event loop closed, nobody is listening anymore
+            self.close()
+
+    def _wake(self):
+        self._scheduled = False
+        self._event.set()
+
+    async def next_batch(self):
+        """Waits for new events and returns all of them as (items, dropped count)."""
+        while True:
+            # clear before reading: a publish after the read sets the event again
+            self._event.clear()
+            items, self.cursor, dropped = self.stream.read(self.cursor)
+            if items or dropped:
+                return items, dropped
+            await self._event.wait()
+
+    def close(self):
+        self.stream.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,69 @@
+import math
+import time
+from collections import deque
+
+
+class RateCounter:
+    """Number of events in the last period seconds, on the monotonic clock.
+
+    Events are kept as (timestamp, count) in arrival order, so expiring the
+    old ones pops from the left of a deque: O(1) amortized per event however
+    fast they come. With a smoothing time constant (seconds) value() is an
+    exponential moving average of the count instead of the raw count, which
+    steadies it at the edges of a passage.
+    """
+
+    def __init__(self, period, smoothing=0.0, clock=time.monotonic):
+        self.period = period
+        self.smoothing = smoothing
+        self.clock = clock
+        self._events = deque()
+        self._total = 0
+        self._smoothed = 0.0
+        self._smoothed_at = None
+
+    def add(self, count=1, now=None):
+        """Records count events, returns the number of events in the period."""
+        if now is None:
+            now = self.clock()
+        self._expire(now)
+        self._events.append((now, count))
+        self._total += count
+        return self._total
+
+    def count(self, now=None):
+        if now is None:
+            now = self.clock()
+        self._expire(now)
+        return self._total
+
+    def rate(self, now=None):
+        """Events per second over the period."""
+        return self.count(now) / self.period
+
+    def value(self, now=None):
+        """count(), smoothed when a smoothing time constant is set."""
+        if now is None:
+            now = self.clock()
+        count = self.count(now)
+        if self.smoothing <= 0:
+            return count
+        if self._smoothed_at is None:
+            self._smoothed = count
+        else:
+            alpha = 1 - math.exp(-(now - self._smoothed_at) / self.smoothing)
+            self._smoothed += (count - self._smoothed) * alpha
+        self._smoothed_at = now
+        return self._smoothed
+
+    def reset(self):
+        self._events.clear()
+        self._total = 0
+        self._smoothed = 0.0
+        self._smoothed_at = None
+
+    def _expire(self, now):
+        events = self._events
+        oldest = now - self.period
+        while events and events[0][0] < oldest:
+            self._total -= events.popleft()[1]
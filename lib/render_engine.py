@@ -0,0 +1,302 @@
+import threading
+import time
+
+import numpy as np
+
+from lib.color_mode import ColorMode
+from lib.fade_engine import FADING_MODES, PEDAL_DEADZONE, FadeEngine
+from lib.functions import get_backlight_color, get_note_position
+from lib.log_setup import logger
+
+
+class LatencyStats:
+    """Running mean / max of input-to-photon latency (seconds in, milliseconds out)."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, latency):
+        self.count += 1
+        self.mean += (latency - self.mean) / self.count
+        self.max = max(self.max, latency)
+        self.last = latency
+
+    def stats(self):
+        return {
+            "events": self.count,
+            "mean_ms": round(self.mean * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "last_ms": round(self.last * 1000, 3),
+        }
+
+
+class RenderEngine:
+    """Lights the keys played on the piano.
+
+    Runs on its own thread at the LED frame rate. Every tick advances the
+    fade of lit keys, drains midiports.midipending into the active
+    ColorMode and requests a single frame from the strip. With nothing
+    left to animate it sleeps on the MIDI input condition, so a key press
+    is rendered as soon as it arrives instead of at the next tick.
+
+    Per-LED state lives in LedStrip and is updated by the FadeEngine;
+    keylist_color is the color given by the ColorMode on note on.
+    """
+
+    def __init__(self, ledstrip, ledsettings, midiports, learning, config):
+        self.ledstrip = ledstrip
+        self.ledsettings = ledsettings
+        self.midiports = midiports
+        self.learning = learning
+        self.config = config
+        self.fade = FadeEngine(ledstrip, ledsettings)
+
+        self.color_mode = None
+        self.color_mode_name = None
+        self.has_color_update = False
+        self.last_sustain = 0
+        self.animating = False
+
+        self.latency = LatencyStats()
+        # perf_counter of the oldest input not presented yet, and of the frame request showing it
+        self._pending_input = None
+        self._pending_request = None
+
+        self._last_tick = time.perf_counter()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self.ledstrip.strip.on_present = self._on_present
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="RenderEngine", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self.midiports.wake()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    def _run(self):
+        while self._running:
+            started = time.perf_counter()
+            try:
+                self.tick(started)
+            except Exception as e:
+                logger.warning(f"Render tick failed: {e}")
+            self._wait(started)
+
+    def _wait(self, started):
+        if self.midiports.midipending is not self.midiports.midi_queue:
+            # song file events are not signalled, poll them once per frame
+            remaining = 1 / self.ledstrip.led_fps - (time.perf_counter() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+        elif self.animating:
+            # next fade step at the next frame, or earlier when a key event arrives
+            remaining = 1 / self.ledstrip.led_fps - (time.perf_counter() - started)
+            if remaining > 0:
+                self.midiports.wait_for_midi(timeout=remaining)
+        else:
+            # nothing to animate: sleep until a key event arrives
+            self.midiports.wait_for_midi(timeout=0.5)
+
+    def tick(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+        time_delta = now - self._last_tick
+        self._last_tick = now
+
+        self.select_queue()
+        self.update_color_mode()
+
+        # fade first: keys pressed in this tick start at full strength
+        changed = self.process_leds(time_delta)
+        changed = self.process_midi() or changed
+        self.animating = self.is_animating()
+
+        if changed:
+            if self._pending_input is not None and self._pending_request is None:
+                self._pending_request = time.perf_counter()
+            self.ledstrip.strip.show()
+        elif self._pending_request is None:
+            self._pending_input = None
+        return changed
+
+    def select_queue(self):
+        # learning mode reads the keyboard itself; show the played song file instead
+        if self.learning.is_started_midi:
+            self.midiports.midipending = self.midiports.midifile_queue
+        else:
+            self.midiports.midipending = self.midiports.midi_queue
+
+    def update_color_mode(self):
+        ledsettings = self.ledsettings
+        if (
+            ledsettings.color_mode != self.color_mode_name
+            or ledsettings.incoming_setting_change
+        ):
+            ledsettings.incoming_setting_change = False
+            self.color_mode = ColorMode(
+                ledsettings.color_mode, self.config, ledsettings
+            )
+            self.color_mode_name = ledsettings.color_mode
+            self.has_color_update = self.color_mode.has_color_update
+
+    def process_midi(self):
+        queue = self.midiports.midipending
+        changed = False
+        # consecutive note-ons (chords, fast runs) are colored in one batch
+        note_ons = []
+        while queue:
+            msg, msg_timestamp = queue.popleft()
+            if self._pending_input is None:
+                self._pending_input = msg_timestamp
+            if msg.type == "note_on" and msg.velocity > 0:
+                note_ons.append((msg, msg_timestamp))
+                continue
+            changed = self.notes_on(note_ons) or changed
+            note_ons = []
+            changed = self.handle_message(msg, msg_timestamp) or changed
+        return self.notes_on(note_ons) or changed
+
+    def handle_message(self, msg, msg_timestamp):
+        if msg.type == "control_change" and msg.control == 64:
+            return self.set_sustain(msg.value)
+        if msg.type not in ("note_on", "note_off"):
+            return False
+
+        if msg.type == "note_on" and msg.velocity > 0:
+            return self.notes_on([(msg, msg_timestamp)])
+
+        self.midiports.last_activity = time.time()
+        note_position = get_note_position(msg.note, self.ledstrip, self.ledsettings)
+        if not 0 <= note_position < len(self.ledstrip.keylist):
+            return False
+        self.note_off(note_position)
+        return True
+
+    def notes_on(self, events):
+        """Lights the keys of a list of (note_on message, timestamp)."""
+        if not events:
+            return False
+        self.midiports.last_activity = time.time()
+
+        notes = np.array([msg.note for msg, _ in events])
+        velocities = np.array([msg.velocity for msg, _ in events])
+        times = np.array([msg_timestamp for _, msg_timestamp in events])
+        positions = np.array(
+            [get_note_position(note, self.ledstrip, self.ledsettings) for note in notes]
+        )
+        on_strip = (positions >= 0) & (positions < len(self.ledstrip.keylist))
+        if not on_strip.all():
+            notes, velocities, times, positions = (
+                notes[on_strip],
+                velocities[on_strip],
+                times[on_strip],
+                positions[on_strip],
+            )
+        if len(positions) == 0:
+            return False
+
+        colors, has_color = self.color_mode.NoteOnBatch(
+            notes, velocities, positions, times
+        )
+        positions = positions[has_color]
+        self.fade.press(positions, colors[has_color], velocities[has_color])
+        for note_position, color in zip(
+            positions.tolist(), self.draw_many(positions).tolist()
+        ):
+            self.ledstrip.set_adjacent_colors(note_position, color, False)
+        return True
+
+    def note_off(self, note_position):
+        went_dark = self.fade.release(
+            note_position, self.last_sustain >= PEDAL_DEADZONE
+        )
+        color = self.draw(note_position)
+        if went_dark:
+            self.ledstrip.set_adjacent_colors(note_position, color, True)
+
+    def set_sustain(self, value):
+        was_sustained = self.last_sustain >= PEDAL_DEADZONE
+        self.last_sustain = value
+        if not was_sustained or value >= PEDAL_DEADZONE:
+            return False
+        if self.ledsettings.mode not in ("Velocity", "Pedal"):
+            return False
+
+        released = self.fade.release_sustain()
+        self.draw_many(released)
+        backlight = get_backlight_color(self.ledsettings)
+        for note_position in released.tolist():
+            self.ledstrip.set_adjacent_colors(note_position, backlight, True)
+        return len(released) > 0
+
+    def is_animating(self):
+        """True while some lit key still fades or changes color every frame."""
+        if self.ledsettings.mode not in FADING_MODES and not self.has_color_update:
+            return False
+        return bool((self.ledstrip.keylist > 0).any())
+
+    def process_leds(self, time_delta):
+        ledstrip = self.ledstrip
+        fading = self.ledsettings.mode in FADING_MODES
+        if not (fading or self.has_color_update):
+            return False
+
+        active = np.flatnonzero(ledstrip.keylist > 0)
+        if len(active) == 0:
+            return False
+
+        if self.has_color_update:
+            colors = self.color_mode.ColorUpdateBatch(
+                time_delta, active, ledstrip.keylist_color[active]
+            )
+            if colors is not None:
+                ledstrip.keylist_color[active] = colors
+
+        if fading:
+            backlight = get_backlight_color(self.ledsettings)
+            for note_position in self.fade.step(time_delta, active).tolist():
+                ledstrip.set_adjacent_colors(note_position, backlight, True)
+
+        self.draw_many(active)
+        return True
+
+    def draw(self, note_position):
+        """Writes the LED of a key from its strength and color, returns the packed color."""
+        color = int(self.fade.colors([note_position])[0])
+        self.ledstrip.strip.setPixelColor(note_position, color)
+        return color
+
+    def draw_many(self, positions):
+        """Writes the LEDs at positions, returns their packed colors."""
+        colors = self.fade.colors(positions)
+        if len(positions):
+            self.ledstrip.strip.put(positions, colors)
+        return colors
+
+    def _on_present(self, started, presented):
+        # called on the compositor thread for every frame sent to the driver
+        request = self._pending_request
+        if request is not None and started >= request:
+            self.latency.record(presented - self._pending_input)
+            self._pending_input = None
+            self._pending_request = None
+
+    def stats(self):
+        return {
+            "fps": self.ledstrip.led_fps,
+            "frames": self.ledstrip.strip.frames,
+            "latency": self.latency.stats(),
+        }
@@ -0,0 +1,83 @@
+import math
+import time
+
+
+class DeadlineScheduler:
+    """Plays a song schedule (absolute song seconds) against perf_counter deadlines.
+
+    Each event is slept to its own absolute deadline, so time spent lighting LEDs
+    or sending MIDI never accumulates into drift. Tempo changes only move the
+    anchor point, the schedule itself is never recomputed.
+    """
+
+    def __init__(self):
+        self.speed = 1.0
+        self._origin_song = 0.0
+        self._origin_clock = time.perf_counter()
+        self.reset_stats()
+
+    def start(self, song_time, speed=1.0):
+        self.speed = speed
+        self.resync(song_time)
+        self.reset_stats()
+
+    def resync(self, song_time):
+        """Makes song_time happen now (e.g. after waiting for the user to press keys)."""
+        self._origin_song = song_time
+        self._origin_clock = time.perf_counter()
+
+    def set_speed(self, speed):
+        if speed == self.speed:
+            return
+        # keep the current song position, only the pace from here on changes
+        now = time.perf_counter()
+        self._origin_song = self.song_position(now)
+        self._origin_clock = now
+        self.speed = speed
+
+    def song_position(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+        return self._origin_song + (now - self._origin_clock) * self.speed
+
+    def deadline(self, song_time):
+        return self._origin_clock + (song_time - self._origin_song) / self.speed
+
+    def wait_until(self, song_time):
+        """Sleeps until the deadline of song_time and returns the lateness in seconds."""
+        deadline = self.deadline(song_time)
+        remaining = deadline - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+            lateness = time.perf_counter() - deadline
+            self._record(lateness)
+        else:
+            # already late: processing took longer than the gap between events
+            lateness = -remaining
+            self._record(lateness)
+        return lateness
+
+    def reset_stats(self):
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._max = 0.0
+
+    def _record(self, lateness):
+        # Welford's running mean/variance
+        self._count += 1
+        delta = lateness - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (lateness - self._mean)
+        self._max = max(self._max, lateness)
+
+    def stats(self):
+        """Drift is the mean lateness, jitter its standard deviation (milliseconds)."""
+        jitter = math.sqrt(self._m2 / self._count) if self._count > 1 else 0.0
+        return {
+            "events": self._count,
+            "drift_ms": round(self._mean * 1000, 3),
+            "jitter_ms": round(jitter * 1000, 3),
+            "max_late_ms": round(self._max * 1000, 3),
+            "speed": self.speed,
+        }
@@ -0,0 +1,216 @@
+import numpy as np
+
+HAND_RIGHT = 1
+HAND_LEFT = 2
+
+# data bytes after a status byte, for the statuses that are not meta or sysex
+_CHANNEL_DATA_LENGTH = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+_SYSTEM_DATA_LENGTH = {
+    0xF1: 1,
+    0xF2: 2,
+    0xF3: 1,
+    0xF6: 0,
+    0xF8: 0,
+    0xFA: 0,
+    0xFB: 0,
+    0xFC: 0,
+    0xFE: 0,
+}
+
+# data bytes mido needs to decode the meta events read here: set_tempo, time_signature
+_META_MIN_LENGTH = {0x51: 3, 0x58: 4}
+
+
+def _read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def read_smf(data):
+    """Reads the events analyze_smf needs from the bytes of a Standard MIDI File.
+
+    A single pass over the chunks, decoding running status like mido with
+    clip=True but without building a message object per event. Returns
+    (ticks_per_beat, track_count, end_tick, tempo_changes, time_signature,
+    note_ticks, note_codes): end_tick is the last tick of the longest track,
+    tempo_changes the (tick, tempo) of every set_tempo, time_signature the
+    first one in merged order or None, and every note on or off is a tick
+    and a code note | on << 7 | track << 8, in file order.
+    """
+    if data[:4] != b"MThd":
+        raise ValueError("MThd not found. Probably not a MIDI file")
+    header_length = int.from_bytes(data[4:8], "big")
+    if header_length < 6 or len(data) < 8 + header_length:
+        raise EOFError
+    num_tracks = int.from_bytes(data[10:12], "big", signed=True)
+    ticks_per_beat = int.from_bytes(data[12:14], "big", signed=True)
+    pos = 8 + header_length
+
+    end_tick = 0
+    tempo_changes = []
+    time_signature = None  # (tick, text) of the earliest one
+    note_ticks = []
+    note_codes = []
+    append_tick = note_ticks.append
+    append_code = note_codes.append
+
+    track = 0
+    while track < num_tracks:
+        if len(data) < pos + 8:
+            raise EOFError
+        chunk_end = pos + 8 + int.from_bytes(data[pos + 4 : pos + 8], "big")
+        if data[pos : pos + 4] != b"MTrk":
+            pos = chunk_end  # skip unknown chunks
+            continue
+        pos += 8
+        track_code = track << 8
+        tick = 0
+        last_status = None
+
+        while pos < chunk_end:
+            # delta time, nearly always a single byte
+            byte = data[pos]
+            pos += 1
+            if byte < 0x80:
+                tick += byte
+            else:
+                delta, pos = _read_varlen(data, pos - 1)
+                tick += delta
+
+            status = data[pos]
+            pos += 1
+            if status < 0x80:
+                if last_status is None:
+                    raise ValueError("running status without last_status")
+                status = last_status
+                pos -= 1  # the byte was the first data byte
+            elif status != 0xFF:
+                # meta events don't set running status
+                last_status = status
+
+            if status == 0xFF:
+                meta_type = data[pos]
+                length, pos = _read_varlen(data, pos + 1)
+                if length < _META_MIN_LENGTH.get(meta_type, 0):
+                    # mido fails on these too
+                    raise ValueError(f"meta event 0x{meta_type:02x} too short")
+                if meta_type == 0x51:
+                    tempo_changes.append(
+                        (tick, int.from_bytes(data[pos : pos + 3], "big"))
+                    )
+                elif meta_type == 0x58 and (
+                    time_signature is None or tick < time_signature[0]
+                ):
+                    time_signature = (tick, f"{data[pos]}/{2 ** data[pos + 1]}")
+                pos += length
+            elif status == 0xF0 or status == 0xF7:
+                length, pos = _read_varlen(data, pos)
+                pos += length
+            elif status < 0xF0:
+                kind = status >> 4
+                if kind == 0x9 or kind == 0x8:
+                    note = min(data[pos], 127)
+                    on = kind == 0x9 and data[pos + 1] > 0
+                    append_tick(tick)
+                    append_code(note | on << 7 | track_code)
+                pos += _CHANNEL_DATA_LENGTH[kind]
+            elif status in _SYSTEM_DATA_LENGTH:
+                pos += _SYSTEM_DATA_LENGTH[status]
+            else:
+                raise ValueError(f"undefined status byte 0x{status:02x}")
+
+        if pos > len(data):
+            raise EOFError
+        end_tick = max(end_tick, tick)
+        pos = chunk_end
+        track += 1
+
+    return (
+        ticks_per_beat,
+        num_tracks,
+        end_tick,
+        tempo_changes,
+        time_signature[1] if time_signature is not None else None,
+        note_ticks,
+        note_codes,
+    )
+
+
+def _note_stats(notes, on):
+    """(total notes, unique pitches, max polyphony, lowest, highest) of a merged note stream."""
+    pressed = notes[on]
+    if len(pressed) == 0:
+        return 0, 0, 0, None, None
+
+    # a note counts once while held: pressing it again changes nothing,
+    # so each event moves the count by its state minus the note's previous state
+    state = on.astype(np.int32)
+    by_note = np.argsort(notes, kind="stable")
+    previous = np.zeros_like(state)
+    same_note = notes[by_note[1:]] == notes[by_note[:-1]]
+    previous[by_note[1:]] = np.where(same_note, state[by_note[:-1]], 0)
+    max_polyphony = int(np.cumsum(state - previous).max())
+
+    return (
+        len(pressed),
+        len(np.unique(pressed)),
+        max_polyphony,
+        int(pressed.min()),
+        int(pressed.max()),
+    )
+
+
+def analyze_smf(data):
+    """Statistics of the bytes of a Standard MIDI File, see read_smf.
+
+    Notes are counted on the merged tracks, simultaneous events in track
+    order like mido.merge_tracks. Hands are assigned the way compiled songs
+    do it: with 2 tracks the first one is the right hand and the second the
+    left hand, otherwise tracks 1 and 2 are.
+    """
+    (
+        ticks_per_beat,
+        track_count,
+        end_tick,
+        tempo_changes,
+        time_signature,
+        note_ticks,
+        note_codes,
+    ) = read_smf(data)
+
+    codes = np.asarray(note_codes, dtype=np.int64)
+    merged = np.argsort(np.asarray(note_ticks, dtype=np.int64), kind="stable")
+    codes = codes[merged]
+    notes = codes & 0x7F
+    on = (codes & 0x80) != 0
+    hands = (codes >> 8) + (1 if track_count == 2 else 0)
+
+    stats = {
+        "ticks_per_beat": ticks_per_beat,
+        "track_count": track_count,
+        "end_tick": end_tick,
+        "tempo_changes": tempo_changes,
+        "time_signature": time_signature,
+    }
+    (
+        stats["total_notes"],
+        stats["unique_pitches"],
+        stats["max_polyphony"],
+        stats["lowest_note"],
+        stats["highest_note"],
+    ) = _note_stats(notes, on)
+    for hand, name in ((HAND_RIGHT, "right"), (HAND_LEFT, "left")):
+        in_hand = hands == hand
+        total, _, polyphony, lowest, highest = _note_stats(notes[in_hand], on[in_hand])
+        stats[name] = {
+            "total_notes": total,
+            "max_polyphony": polyphony,
+            "lowest_note": lowest,
+            "highest_note": highest,
+        }
+    return stats
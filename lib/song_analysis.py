@@ -0,0 +1,134 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from lib.log_setup import logger
+
+PRIORITY_UPLOAD = 0  # a song just uploaded, the user is waiting for it
+PRIORITY_SCAN = 1  # found changed while listing the folders
+
+
+class SongAnalysisService:
+    """Analyzes song files in a pool of worker processes.
+
+    analyze(folder, filename) runs in a worker and returns the column values
+    of the song's library row, which are written to the library when it
+    finishes. Files wait in a priority queue and only as many as there are
+    workers are handed to the pool at a time, so a new upload overtakes the
+    backlog of a first scan. A file is analyzed by one worker at a time: an
+    upload replacing a file being analyzed is queued again when it ends,
+    and the stale result is dropped. The pool is started on demand and shut
+    down when the queue runs dry, leaving no idle processes on the Pi.
+    """
+
+    def __init__(self, library, analyze, max_workers=None):
+        self.library = library
+        self.analyze = analyze
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (priority, sequence, key)
+        self._queued = {}  # key -> priority of its live heap entry
+        self._running = set()
+        self._rerun = set()  # running keys replaced by an upload meanwhile
+        self._sequence = itertools.count()
+        self._executor = None
+
+    def submit(self, folder, filename, priority=PRIORITY_SCAN):
+        key = (folder, filename)
+        with self._cond:
+            if key in self._running:
+                if priority == PRIORITY_UPLOAD:
+                    self._rerun.add(key)  # redone once the running job ends
+                return
+            if self._queued.get(key, priority + 1) <= priority:
+                return
+            # the old heap entry, if any, is skipped when popped
+            self._queued[key] = priority
+            heapq.heappush(self._queue, (priority, next(self._sequence), key))
+            self._dispatch()
+
+    def pending(self):
+        """(folder, filename) of the files queued or being analyzed."""
+        with self._cond:
+            return set(self._queued) | self._running
+
+    def wait(self, keys=None, timeout=None):
+        """Waits until keys (default: all files) are analyzed. Returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not (
+                    set(self._queued) | self._running
+                    if keys is None
+                    else set(keys) & (set(self._queued) | self._running)
+                ),
+                timeout,
+            )
+
+    def _dispatch(self):
+        # called with the lock held
+        while self._queue and len(self._running) < self.max_workers:
+            priority, _, key = heapq.heappop(self._queue)
+            if self._queued.get(key) != priority:
+                continue
+            del self._queued[key]
+            try:
+                executor = self._pool()
+                future = executor.submit(self.analyze, *key)
+            except BrokenProcessPool:
+                self._executor = None
+                executor = self._pool()
+                future = executor.submit(self.analyze, *key)
+            except RuntimeError as e:
+                # the interpreter is shutting down
+                logger.warning(f"Song analysis stopped: {e}")
+                self._queue.clear()
+                self._queued.clear()
+                self._cond.notify_all()
+                return
+            self._running.add(key)
+            future.add_done_callback(
+                lambda future, key=key, executor=executor: self._done(
+                    key, future, executor
+                )
+            )
+
+    def _pool(self):
+        if self._executor is None:
+            # fork: spawned workers would re-run visualizer.py, which has no main guard
+            self._executor = ProcessPoolExecutor(
+                self.max_workers, mp_context=multiprocessing.get_context("fork")
+            )
+        return self._executor
+
+    def _done(self, key, future, executor):
+        with self._cond:
+            stale = key in self._rerun
+        try:
+            row = future.result()
+            if not stale:
+                self.library.put_entries([row])
+        except BrokenProcessPool as e:
+            logger.warning(f"Song analysis worker died on {key[1]}: {e}")
+            with self._cond:
+                if self._executor is executor:
+                    self._executor = None
+        except Exception as e:
+            logger.warning(f"Failed to analyze {key[1]}: {e}")
+
+        with self._cond:
+            self._running.discard(key)
+            if key in self._rerun:
+                self._rerun.discard(key)
+                self._queued[key] = PRIORITY_UPLOAD
+                heapq.heappush(
+                    self._queue, (PRIORITY_UPLOAD, next(self._sequence), key)
+                )
+            self._dispatch()
+            if not self._running and self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self._cond.notify_all()
@@ -1,12 +1,36 @@
+import base64
+import hashlib
 import json
 import os
+import re
+import threading
+import unicodedata
 import mido
 
+import config
 from lib.log_setup import logger
+from lib.smf_analyzer import analyze_smf, read_smf
+from lib.song_analysis import PRIORITY_SCAN, PRIORITY_UPLOAD, SongAnalysisService
+from lib.song_watcher import SongFolderWatcher
+from lib.tempo_map import TempoMap
 
 DIR_SONGS_DEFAULT = "Songs_Default/"
 DIR_SONGS_USER = "Songs_User_Upload/"
-DIR_CACHE = "cache/"
+# a user upload shadows a default song of the same name
+SONG_FOLDERS = (DIR_SONGS_USER, DIR_SONGS_DEFAULT)
+MIDI_EXTENSIONS = (".mid", ".midi")
+# the files listed as songs, see ALLOWED_EXTENSIONS in webinterface/views.py
+SONG_EXTENSIONS = MIDI_EXTENSIONS + (".musicxml", ".mxl", ".xml", ".abc")
+
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 200
+# "(C♯ minor)" at the end of a song name
+_KEY_PATTERN = re.compile(r"\s*\(([A-G][♯♭]? (?:major|minor))\)$")
+
+_library = None
+_analysis_service = None
+_song_watcher = None
+_library_lock = threading.Lock()
 
 
 def resolve_song_path(filename):
@@ -36,93 +60,65 @@ def get_note_name(midi_note):
 def has_playable_notes(file_path):
     """Returns True if the MIDI file contains at least one note_on with velocity > 0."""
     try:
-        mid = mido.MidiFile(file_path, clip=True)
-
-        for track in mid.tracks:
-            for msg in track:
-                if msg.type == "note_on" and msg.velocity > 0:
-                    return True
-
-        return False
+        with open(file_path, "rb") as f:
+            note_codes = read_smf(f.read())[-1]
+        return any(code & 0x80 for code in note_codes)
     except Exception:
         return False
 
 
-def get_tempo(mid):
-    """Extracts the first tempo marker from a MIDI file. Returns 500000 (120 BPM) if none found."""
-    for track in mid.tracks:
-        for msg in track:
-            if msg.type == "set_tempo":
-                return msg.tempo
-    return 500000
+def parse_song_name(filename):
+    """(composer, title, key) of a song named like the bundled ones:
+    "Composer, First - Title (Key major).mid". Missing parts are None."""
+    # names on disk may be decomposed, searches are composed
+    name = unicodedata.normalize("NFC", os.path.splitext(filename)[0])
+    composer, separator, title = name.partition(" - ")
+    if not separator:
+        composer, title = None, name
+    match = _KEY_PATTERN.search(title)
+    if match is None:
+        return composer, title, None
+    return composer, title[: match.start()], match.group(1)
+
 
+def normalize_key(key):
+    """Key as written in song names: "c# minor" becomes "C♯ minor"."""
+    tonic, _, mode = key.strip().partition(" ")
+    tonic = tonic[:1].upper() + tonic[1:].replace("#", "♯").replace("b", "♭")
+    return f"{tonic} {mode.strip().lower()}"
 
-def get_time_signature(mid):
-    """Extracts the first time signature from a MIDI file. Returns '4/4' if none found."""
-    for track in mid.tracks:
-        for msg in track:
-            if msg.type == "time_signature":
-                return f"{msg.numerator}/{msg.denominator}"
-    return "4/4"
+
+def _note_range(lowest_note, highest_note):
+    """Note range as a human-readable string."""
+    if lowest_note is None:
+        return "—"
+    return f"{get_note_name(lowest_note)}→{get_note_name(highest_note)}"
 
 
 def analyze_midi(filepath):
     """Parses a MIDI file and returns a dict of metadata.
-    Single pass through merged tracks extracts everything we need."""
+    A single streaming pass over the file extracts everything we need."""
     try:
-        mid = mido.MidiFile(filepath, clip=True)
-
-        tempo = get_tempo(mid)
-        bpm = round(mido.tempo2bpm(tempo))
-        time_sig = get_time_signature(mid)
-        ticks_per_beat = mid.ticks_per_beat
-        track_count = len(mid.tracks)
-
-        # merge all tracks for a single pass
-        merged = mido.merge_tracks(mid.tracks)
-
-        total_notes = 0
-        active_notes = set()  # currently held notes at any point in time
-        max_polyphony = 0  # highest number of simultaneous notes
-        lowest_note = 127
-        highest_note = 0
-        unique_pitches = set()
-        time_elapsed = 0.0
-
-        for msg in merged:
-            time_elapsed += mido.tick2second(msg.time, ticks_per_beat, tempo)
+        with open(filepath, "rb") as f:
+            stats = analyze_smf(f.read())
 
-            if msg.type == "note_on" and msg.velocity > 0:
-                total_notes += 1
-                active_notes.add(msg.note)
-                unique_pitches.add(msg.note)
+        total_notes = stats["total_notes"]
+        max_polyphony = stats["max_polyphony"]
+        time_sig = stats["time_signature"] or "4/4"
 
-                if len(active_notes) > max_polyphony:
-                    max_polyphony = len(active_notes)
-
-                if msg.note < lowest_note:
-                    lowest_note = msg.note
-
-                if msg.note > highest_note:
-                    highest_note = msg.note
-
-            elif msg.type == "note_off" or (
-                msg.type == "note_on" and msg.velocity == 0
-            ):
-                active_notes.discard(msg.note)
-
-        # duration from mido's built-in calculation (accounts for tempo changes)
-        duration = mid.length
+        # duration and average tempo from the tempo map (accounts for tempo changes)
+        tick = stats["end_tick"]
+        tempo_map = TempoMap(stats["ticks_per_beat"], stats["tempo_changes"])
+        duration = tempo_map.tick2second(tick)
+        bpm = round(mido.tempo2bpm(tempo_map.average_tempo(tick)))
 
         # notes per second — how busy the song is
         notes_per_second = round(total_notes / duration, 1) if duration > 0 else 0
 
-        # note range as human-readable string
-        if lowest_note <= highest_note:
-            note_range = f"{get_note_name(lowest_note)}→{get_note_name(highest_note)}"
-            range_semitones = highest_note - lowest_note
+        note_range = _note_range(stats["lowest_note"], stats["highest_note"])
+        if stats["lowest_note"] is not None:
+            range_semitones = stats["highest_note"] - stats["lowest_note"]
         else:
-            note_range = "—"
             range_semitones = 0
 
         # difficulty score 1-5
@@ -160,15 +156,25 @@ def analyze_midi(filepath):
             "bpm_str": f"{bpm} bpm",
             "time_signature": time_sig,
             "time_signature_str": f"{time_sig} time",
-            "track_count": track_count,
+            "track_count": stats["track_count"],
             "total_notes": total_notes,
-            "unique_pitches": len(unique_pitches),
+            "unique_pitches": stats["unique_pitches"],
             "max_polyphony": max_polyphony,
             "notes_per_second": notes_per_second,
             "note_range": note_range,
             "difficulty": difficulty,
             "difficulty_stars": "★" * difficulty + "☆" * (5 - difficulty),
             "difficulty_word": difficulty_word,
+            "right_hand_notes": stats["right"]["total_notes"],
+            "right_hand_polyphony": stats["right"]["max_polyphony"],
+            "right_hand_range": _note_range(
+                stats["right"]["lowest_note"], stats["right"]["highest_note"]
+            ),
+            "left_hand_notes": stats["left"]["total_notes"],
+            "left_hand_polyphony": stats["left"]["max_polyphony"],
+            "left_hand_range": _note_range(
+                stats["left"]["lowest_note"], stats["left"]["highest_note"]
+            ),
         }
 
     except Exception as e:
@@ -220,57 +226,266 @@ def calculate_difficulty(polyphony, notes_per_second, range_semitones):
     return max(1, min(5, round(score / 3)))
 
 
-def get_cache_path(filename):
-    """Returns the path to the cached analysis JSON for a given song filename."""
-    os.makedirs(DIR_CACHE, exist_ok=True)
-    return os.path.join(DIR_CACHE, filename + ".info.json")
+def file_sha1(filepath):
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_library():
+    """The song library table, opened on first use."""
+    global _library
+    with _library_lock:
+        if _library is None:
+            _library = config.SongLibrary()
+        return _library
+
+
+def get_analysis_service():
+    """The background song analysis service, created on first use."""
+    global _analysis_service
+    library = get_library()
+    with _library_lock:
+        if _analysis_service is None:
+            _analysis_service = SongAnalysisService(library, analyze_song_file)
+        return _analysis_service
+
+
+def get_song_watcher():
+    """The index of both song folders, started on first use."""
+    global _song_watcher
+    with _library_lock:
+        if _song_watcher is None:
+            _song_watcher = SongFolderWatcher(SONG_FOLDERS, SONG_EXTENSIONS)
+            _song_watcher.start()
+            # files already there are checked by scan_songs_info in one query
+            _song_watcher.listeners.append(_song_file_changed)
+        return _song_watcher
+
+
+def notify_song_changed(path):
+    """Updates the song index right after a song file was written or removed."""
+    get_song_watcher().refresh(path)
+
+
+def list_song_files():
+    """Yields (folder, filename, stat) of the MIDI files in both song folders."""
+    watcher = get_song_watcher()
+    for folder in SONG_FOLDERS:
+        for filename, stat in watcher.files(folder).items():
+            if filename.lower().endswith(MIDI_EXTENSIONS):
+                yield folder, filename, stat
+
+
+def get_song_names():
+    """Sorted filenames of the songs in both folders."""
+    return get_song_watcher().names()
+
+
+def get_songs_storage(folders=SONG_FOLDERS):
+    """(count, bytes) of the MIDI files in folders."""
+    return get_song_watcher().totals(folders, MIDI_EXTENSIONS)
+
+
+def library_row(folder, filename, stat, sha1, info):
+    """Column values of the library row of a file with the given analysis."""
+    row = {
+        "folder": folder,
+        "filename": filename,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1": sha1,
+        "analyzed": info is not None,
+    }
+    # not from the analysis, which may be reused from another file
+    row["composer"], row["title"], row["key"] = parse_song_name(filename)
+    for field in config.SONG_INFO_FIELDS:
+        if field not in row:
+            row[field] = info[field] if info is not None else None
+    return row
+
+
+def analyze_song_file(folder, filename):
+    """Library row of a song file. Runs in the analysis worker processes."""
+    filepath = os.path.join(folder, filename)
+    stat = os.stat(filepath)
+    return library_row(
+        folder, filename, stat, file_sha1(filepath), analyze_midi(filepath)
+    )
+
+
+def _is_current(entry, stat):
+    return (
+        entry is not None
+        and entry.size == stat.st_size
+        and entry.mtime_ns == stat.st_mtime_ns
+    )
+
+
+def _reuse_analysis(folder, filename, stat, previous, by_sha1=None):
+    """Library row of a changed file whose content is already known, else None.
+    by_sha1 maps hashes to analyzed rows, the library is queried without it."""
+    sha1 = file_sha1(os.path.join(folder, filename))
+    # touched, copied or renamed files keep their analysis
+    if previous is not None and previous.sha1 == sha1:
+        known = previous
+    elif by_sha1 is not None:
+        known = by_sha1.get(sha1)
+    else:
+        known = get_library().find_sha1(sha1)
+    if known is None:
+        return None
+    return library_row(folder, filename, stat, sha1, known.info())
+
+
+def _song_file_changed(folder, filename, stat):
+    # called by the song watcher when a file is added, modified or removed
+    if not filename.lower().endswith(MIDI_EXTENSIONS):
+        return
+    library = get_library()
+    if stat is None:
+        library.delete_entries([(folder, filename)])
+        return
+    entry = library.entry(folder, filename)
+    if _is_current(entry, stat):
+        return
+    row = _reuse_analysis(folder, filename, stat, entry)
+    if row is not None:
+        library.put_entries([row])
+    else:
+        get_analysis_service().submit(folder, filename, PRIORITY_SCAN)
+
+
+def scan_songs_info(priority=PRIORITY_SCAN):
+    """Analysis of the songs in both folders, without waiting for new files.
+
+    Returns the info of the analyzed songs keyed by filename, and the
+    filenames still being analyzed. Rows whose size or mtime no longer
+    match the file are queued for analysis, so a song replaced by an
+    upload is redone; rows of deleted files are dropped.
+    """
+    library = get_library()
+    service = get_analysis_service()
+    entries = library.entries()
+    by_sha1 = {entry.sha1: entry for entry in entries.values() if entry.analyzed}
+    result = {}
+    pending = set()
+    changed = []
+
+    for folder, filename, stat in list_song_files():
+        entry = entries.pop((folder, filename), None)
+        if not _is_current(entry, stat):
+            try:
+                row = _reuse_analysis(folder, filename, stat, entry, by_sha1)
+            except OSError as e:
+                logger.warning(f"Failed to read {filename}: {e}")
+                continue
+            if row is None:
+                service.submit(folder, filename, priority)
+                pending.add(filename)
+                continue
+            changed.append(row)
+            entry = config.SongLibraryEntry(**row)
+        info = entry.info()
+        if info and filename not in result:
+            # the user folder comes first, like in resolve_song_path
+            result[filename] = info
+
+    library.put_entries(changed)
+    library.delete_entries(list(entries))
+    return result, sorted(pending - set(result))
+
+
+def get_all_songs_info():
+    """Returns the analysis of all songs in both folders, keyed by filename.
+    Waits for the songs not analyzed yet."""
+    result, _ = scan_songs_info()
+    # an upload replacing a default song is not in pending, the default
+    # one stands in for it meanwhile
+    service = get_analysis_service()
+    if service.pending():
+        service.wait()
+        result, _ = scan_songs_info()
+    return result
+
+
+def queue_song_analysis(filename):
+    """Analyzes an uploaded song ahead of the other queued files."""
+    get_analysis_service().submit(DIR_SONGS_USER, filename, PRIORITY_UPLOAD)
 
 
 def get_song_info(filename):
-    """Returns cached analysis for a song. If no cache exists, analyzes and caches it."""
-    cache_path = get_cache_path(filename)
-
-    # check cache first
-    if os.path.isfile(cache_path):
-        try:
-            with open(cache_path, "r") as f:
-                return json.load(f)
-        except Exception:
-            pass  # cache corrupt — re-analyze
-
-    # no cache — analyze
+    """Returns the analysis of one song, or None if it is missing or unreadable."""
     filepath = resolve_song_path(filename)
     if not filepath:
         return None
-
-    info = analyze_midi(filepath)
-    if not info:
-        return None
-
-    # save to cache
+    folder = (
+        DIR_SONGS_USER if filepath.startswith(DIR_SONGS_USER) else DIR_SONGS_DEFAULT
+    )
+    library = get_library()
     try:
-        with open(cache_path, "w") as f:
-            json.dump(info, f)
-    except Exception as e:
-        logger.warning(f"Failed to cache song info for {filename}: {e}")
-
-    return info
+        stat = os.stat(filepath)
+        entry = library.entry(folder, filename)
+        if _is_current(entry, stat):
+            return entry.info()
+        row = _reuse_analysis(folder, filename, stat, entry)
+        if row is not None:
+            library.put_entries([row])
+            return config.SongLibraryEntry(**row).info()
+
+        service = get_analysis_service()
+        service.submit(folder, filename, PRIORITY_UPLOAD)
+        service.wait([(folder, filename)])
+        entry = library.entry(folder, filename)
+        return entry.info() if _is_current(entry, os.stat(filepath)) else None
+    except OSError as e:
+        logger.warning(f"Failed to read {filename}: {e}")
+        return None
 
 
-def get_all_songs_info():
-    """Analyzes all songs in both folders and returns a dict keyed by filename."""
-    result = {}
+def _encode_cursor(entry, sort):
+    position = [getattr(entry, sort), entry.filename]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
 
-    for d in [DIR_SONGS_DEFAULT, DIR_SONGS_USER]:
-        if not os.path.isdir(d):
-            continue
-        for filename in os.listdir(d):
-            if not filename.lower().endswith((".mid", ".midi")):
-                continue
-            if filename in result:
-                continue  # user folder version already processed
-            info = get_song_info(filename)
-            if info:
-                result[filename] = info
 
-    return result
+def _decode_cursor(cursor):
+    try:
+        value, filename = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("invalid cursor") from e
+    # decoded, but not something _encode_cursor writes
+    if not isinstance(value, (str, int, float, type(None))) or not isinstance(
+        filename, str
+    ):
+        raise ValueError("invalid cursor")
+    return value, filename
+
+
+def search_songs(sort="title", descending=False, cursor=None, limit=None, **filters):
+    """One page of the analyzed songs matching filters, see SongLibrary.search.
+
+    Returns the song infos with their filename, and the cursor of the next
+    page or None on the last one. Raises ValueError on invalid arguments.
+    """
+    limit = min(max(1, int(limit or SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+    if filters.get("text"):
+        filters["text"] = unicodedata.normalize("NFC", filters["text"])
+    if filters.get("key"):
+        filters["key"] = normalize_key(filters["key"])
+    after = _decode_cursor(cursor) if cursor else None
+    # one more than asked to know if there is a next page
+    entries = get_library().search(
+        DIR_SONGS_USER,
+        sort=sort,
+        descending=descending,
+        after=after,
+        limit=limit + 1,
+        **filters,
+    )
+    songs = [{"filename": entry.filename, **entry.info()} for entry in entries[:limit]]
+    next_cursor = (
+        _encode_cursor(entries[limit - 1], sort) if len(entries) > limit else None
+    )
+    return songs, next_cursor
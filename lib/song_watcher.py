@@ -0,0 +1,285 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from lib.log_setup import logger
+
+# inotify(7) event bits
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+
+class Inotify:
+    """Minimal inotify(7) binding over libc. Raises OSError where it is not available."""
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1
+        except (AttributeError, TypeError) as e:
+            raise OSError(f"inotify not available: {e}") from e
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # written to by wake() to interrupt a read
+        self._wake_read, self._wake_write = os.pipe()
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """(wd, mask, name) of the pending events, waits up to timeout seconds for one."""
+        ready, _, _ = select.select([self.fd, self._wake_read], [], [], timeout)
+        if self.fd not in ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            events.append(
+                (wd, mask, os.fsdecode(data[pos : pos + length].rstrip(b"\0")))
+            )
+            pos += length
+        return events
+
+    def wake(self):
+        os.write(self._wake_write, b"\0")
+
+    def close(self):
+        for fd in (self.fd, self._wake_read, self._wake_write):
+            os.close(fd)
+
+
+class SongFolderWatcher:
+    """In-memory index of the song files in a few folders: names, sizes and mtimes.
+
+    The index is built once by listing the folders and then kept up to
+    date on a thread from inotify events. Where inotify is not available
+    the folders are listed again every poll_interval seconds instead, as
+    are folders that don't exist yet. Readers never touch the disk: the
+    sorted names and per-extension totals are kept alongside the index.
+
+    Listeners are called on the watcher thread as listener(folder,
+    filename, stat) for new and modified files, with stat None for
+    removed ones.
+    """
+
+    def __init__(self, folders, extensions, poll_interval=2.0):
+        self.folders = tuple(folders)
+        self.extensions = tuple(extensions)
+        self.poll_interval = poll_interval
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._files = {folder: {} for folder in self.folders}  # filename -> stat
+        # extension -> [count, bytes], per folder
+        self._totals = {folder: {} for folder in self.folders}
+        self._names = None  # sorted filenames of all folders, rebuilt on change
+        self._by_path = {os.path.abspath(folder): folder for folder in self.folders}
+        self._inotify = None
+        self._watches = {}  # wd -> folder
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        for folder in self.folders:
+            self.scan(folder)
+        try:
+            self._inotify = Inotify()
+        except OSError as e:
+            logger.info(f"Polling song folders, {e}")
+        self._add_watches()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="SongFolderWatcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._inotify is not None:
+            self._inotify.wake()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval + 1)
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._watches = {}
+
+    def files(self, folder):
+        """{filename: stat} of a folder, a snapshot."""
+        with self._lock:
+            return dict(self._files[folder])
+
+    def names(self):
+        """Sorted filenames of all folders, once each."""
+        with self._lock:
+            if self._names is None:
+                names = set()
+                for files in self._files.values():
+                    names.update(files)
+                self._names = sorted(names)
+            return self._names
+
+    def totals(self, folders=None, extensions=None):
+        """(count, bytes) of the files with extensions in folders (default: all)."""
+        count = size = 0
+        with self._lock:
+            for folder in folders or self.folders:
+                for extension, (n, nbytes) in self._totals[folder].items():
+                    if extensions is None or extension in extensions:
+                        count += n
+                        size += nbytes
+        return count, size
+
+    def refresh(self, path):
+        """Re-reads one file of the index, e.g. right after writing or removing it."""
+        folder = self._by_path.get(os.path.dirname(os.path.abspath(path)))
+        filename = os.path.basename(path)
+        if folder is None or not filename.lower().endswith(self.extensions):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        self._update(folder, filename, stat)
+
+    def scan(self, folder):
+        """Lists a folder again and applies the differences to the index."""
+        found = {}
+        if os.path.isdir(folder):
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.name.lower().endswith(self.extensions):
+                        try:
+                            found[entry.name] = entry.stat()
+                        except OSError:
+                            pass  # removed while listing
+        with self._lock:
+            known = list(self._files[folder])
+        for filename in known:
+            if filename not in found:
+                self._update(folder, filename, None)
+        for filename, stat in found.items():
+            self._update(folder, filename, stat)
+
+    def _update(self, folder, filename, stat):
+        extension = os.path.splitext(filename)[1].lower()
+        with self._lock:
+            files = self._files[folder]
+            old = files.get(filename)
+            if old is None and stat is None:
+                return
+            if (
+                old is not None
+                and stat is not None
+                and (old.st_size, old.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+            ):
+                return
+            totals = self._totals[folder].setdefault(extension, [0, 0])
+            if old is not None:
+                totals[0] -= 1
+                totals[1] -= old.st_size
+                del files[filename]
+            if stat is not None:
+                totals[0] += 1
+                totals[1] += stat.st_size
+                files[filename] = stat
+            if old is None or stat is None:
+                self._names = None
+
+        for listener in self.listeners:
+            try:
+                listener(folder, filename, stat)
+            except Exception as e:
+                logger.warning(f"Song folder listener failed on {filename}: {e}")
+
+    def _add_watches(self):
+        if self._inotify is None:
+            return
+        watched = set(self._watches.values())
+        for folder in self.folders:
+            if folder in watched or not os.path.isdir(folder):
+                continue
+            try:
+                self._watches[self._inotify.add_watch(folder, WATCH_MASK)] = folder
+            except OSError as e:
+                logger.warning(f"Can't watch {folder}: {e}")
+                continue
+            self.scan(folder)  # changes made before the watch was added
+
+    def _run(self):
+        next_poll = time.monotonic() + self.poll_interval
+        while not self._stopped.is_set():
+            try:
+                if self._inotify is None:
+                    events = []
+                    self._stopped.wait(max(0, next_poll - time.monotonic()))
+                else:
+                    events = self._inotify.read(max(0, next_poll - time.monotonic()))
+                for wd, mask, name in events:
+                    self._handle(wd, mask, name)
+
+                if time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + self.poll_interval
+                    self._add_watches()
+                    watched = set(self._watches.values())
+                    for folder in self.folders:
+                        if folder not in watched:
+                            self.scan(folder)
+            except Exception as e:
+                logger.warning(f"Song folder watcher failed: {e}")
+                self._stopped.wait(self.poll_interval)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost
+            for folder in self.folders:
+                self.scan(folder)
+            return
+        folder = self._watches.get(wd)
+        if folder is None:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            # the folder is gone, it is polled until it comes back
+            del self._watches[wd]
+            if mask & IN_MOVE_SELF:
+                self._inotify.rm_watch(wd)
+            self.scan(folder)
+            return
+        if name:
+            self.refresh(os.path.join(folder, name))
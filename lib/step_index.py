@@ -0,0 +1,83 @@
+import numpy as np
+
+from lib.compiled_song import KIND_NOTE_OFF, KIND_NOTE_ON
+
+
+def mask_to_notes(mask):
+    """Lists the note numbers set in a 128-bit note mask."""
+    notes = []
+    while mask:
+        low = mask & -mask
+        notes.append(low.bit_length() - 1)
+        mask ^= low
+    return notes
+
+
+class StepIndex:
+    """Chord steps of a compiled song, used by the Melody practice mode.
+
+    A step is the set of note_on events sharing one tick. Each step keeps its
+    chord as 128-bit note masks (both hands, right hand, left hand), the event
+    rows it spans and the notes it contains, so waiting for keys, lighting the
+    next chord and restarting a loop are lookups instead of song scans.
+    """
+
+    def __init__(self, events):
+        ticks = events["tick"]
+        kinds = events["kind"]
+        note_on_rows = np.flatnonzero(kinds == KIND_NOTE_ON)
+        note_rows = np.flatnonzero((kinds == KIND_NOTE_ON) | (kinds == KIND_NOTE_OFF))
+
+        self.ticks, first = np.unique(ticks[note_on_rows], return_index=True)
+        # row of the first note_on of every step
+        self.starts = note_on_rows[first]
+        # a step ends (and Melody mode waits) at the next note event on a later tick
+        next_note_row = np.searchsorted(ticks[note_rows], self.ticks, side="right")
+        self.ends = np.append(note_rows, len(events))[next_note_row]
+
+        count = len(self.ticks)
+        self.masks = [0] * count
+        self.right_masks = [0] * count
+        self.left_masks = [0] * count
+        self.notes = [[] for _ in range(count)]
+
+        steps = np.searchsorted(self.ticks, ticks[note_on_rows]).tolist()
+        notes = events["note"][note_on_rows].tolist()
+        channels = events["channel"][note_on_rows].tolist()
+        for step, note, channel in zip(steps, notes, channels):
+            bit = 1 << note
+            self.masks[step] |= bit
+            if channel == 1:
+                self.right_masks[step] |= bit
+            elif channel == 2:
+                self.left_masks[step] |= bit
+            self.notes[step].append((note, channel))
+
+        # for every event row: the step whose chord has to be pressed before it plays, or -1
+        self.wait_step = np.full(len(events), -1, dtype=np.int32)
+        waiting = np.flatnonzero(self.ends < len(events))
+        self.wait_step[self.ends[waiting]] = waiting
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def chord(self, step, hands=0):
+        """Chord mask of a step for the practiced hands (0 = both, 1 = right, 2 = left)."""
+        if hands == 1:
+            return self.right_masks[step]
+        elif hands == 2:
+            return self.left_masks[step]
+        return self.masks[step]
+
+    def step_at(self, row):
+        """Index of the first step starting at or after the given event row."""
+        return int(np.searchsorted(self.starts, row))
+
+    def next_notes(self, step, end_row=None):
+        """(note, channel) pairs of the step after the given one, if it starts before end_row."""
+        step += 1
+        if step >= len(self.ticks):
+            return []
+        if end_row is not None and self.starts[step] >= end_row:
+            return []
+        return self.notes[step]
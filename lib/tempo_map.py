@@ -0,0 +1,81 @@
+import numpy as np
+
+DEFAULT_TEMPO = 500000  # 120 BPM, the MIDI default when a file has no set_tempo
+
+
+class TempoMap:
+    """Tick to seconds conversion for songs with any number of tempo changes.
+
+    Built once per song from all set_tempo events. Each breakpoint stores the
+    tick where a tempo starts and the cumulative seconds at that tick, so a
+    lookup is a binary search plus one multiply-add.
+    """
+
+    def __init__(self, ticks_per_beat, tempo_changes=()):
+        self.ticks_per_beat = ticks_per_beat
+
+        # stable sort keeps file order for tempo changes on the same tick;
+        # the last one wins because its segment starts later in the arrays
+        changes = sorted(tempo_changes, key=lambda change: change[0])
+        ticks = [0]
+        tempos = [DEFAULT_TEMPO]
+        seconds = [0.0]
+        for tick, tempo in changes:
+            seconds.append(
+                seconds[-1] + (tick - ticks[-1]) * tempos[-1] / 1e6 / ticks_per_beat
+            )
+            ticks.append(tick)
+            tempos.append(tempo)
+
+        self.ticks = np.asarray(ticks, dtype=np.int64)
+        self.tempos = np.asarray(tempos, dtype=np.float64)
+        self.seconds = np.asarray(seconds, dtype=np.float64)
+        # first tempo of the song, used where a single tempo is displayed
+        self.initial_tempo = int(changes[0][1]) if changes else DEFAULT_TEMPO
+
+    @classmethod
+    def from_midi(cls, mid):
+        changes = []
+        for track in mid.tracks:
+            tick = 0
+            for msg in track:
+                tick += msg.time
+                if msg.type == "set_tempo":
+                    changes.append((tick, msg.tempo))
+        return cls(mid.ticks_per_beat, changes)
+
+    def to_list(self):
+        """Tempo changes as [tick, tempo] pairs, suitable for JSON."""
+        return [
+            [int(tick), int(tempo)]
+            for tick, tempo in zip(self.ticks[1:].tolist(), self.tempos[1:].tolist())
+        ]
+
+    def _segment(self, ticks):
+        return np.searchsorted(self.ticks, ticks, side="right") - 1
+
+    def tick2second(self, ticks):
+        """Absolute tick(s) to absolute seconds. Accepts scalars or arrays."""
+        ticks = np.asarray(ticks, dtype=np.int64)
+        seg = self._segment(ticks)
+        result = (
+            self.seconds[seg]
+            + (ticks - self.ticks[seg]) * self.tempos[seg] / 1e6 / self.ticks_per_beat
+        )
+        return float(result) if result.ndim == 0 else result
+
+    def second2tick(self, seconds):
+        """Absolute seconds to the (fractional) absolute tick."""
+        seg = np.searchsorted(self.seconds, seconds, side="right") - 1
+        return self.ticks[seg] + (seconds - self.seconds[seg]) * 1e6 * (
+            self.ticks_per_beat / self.tempos[seg]
+        )
+
+    def tempo_at(self, tick):
+        return int(self.tempos[self._segment(tick)])
+
+    def average_tempo(self, end_tick):
+        """Time-weighted tempo between the start and end_tick (microseconds per beat)."""
+        if end_tick <= 0:
+            return self.initial_tempo
+        return self.tick2second(end_tick) * 1e6 * self.ticks_per_beat / end_tick
@@ -0,0 +1,104 @@
+##########################################################################
+#
+# INFO:
+# - Compares the streaming MIDI analyzer (lib/smf_analyzer.py) with the
+#   mido based analysis it replaced, over the songs in Songs_Default/.
+# - Run from the repository root: python tests/bench_song_info.py
+#
+##########################################################################
+
+import os
+import sys
+import time
+
+sys.path.append("./")
+
+import mido
+
+from lib.smf_analyzer import analyze_smf
+
+SONGS = "Songs_Default/"
+KEYS = (
+    "track_count",
+    "end_tick",
+    "tempo_changes",
+    "time_signature",
+    "total_notes",
+    "unique_pitches",
+    "max_polyphony",
+    "lowest_note",
+    "highest_note",
+)
+
+
+def analyze_mido(filepath):
+    """The statistics analyze_midi used to take from mido."""
+    mid = mido.MidiFile(filepath, clip=True)
+    active_notes = set()
+    pressed = []
+    tempo_changes = []
+    time_signature = None
+    max_polyphony = 0
+    tick = 0
+    for msg in mido.merge_tracks(mid.tracks):
+        tick += msg.time
+        if msg.type == "set_tempo":
+            tempo_changes.append((tick, msg.tempo))
+        elif msg.type == "time_signature" and time_signature is None:
+            time_signature = f"{msg.numerator}/{msg.denominator}"
+        elif msg.type == "note_on" and msg.velocity > 0:
+            active_notes.add(msg.note)
+            pressed.append(msg.note)
+            max_polyphony = max(max_polyphony, len(active_notes))
+        elif msg.type in ("note_on", "note_off"):
+            active_notes.discard(msg.note)
+    return {
+        "track_count": len(mid.tracks),
+        "end_tick": tick,
+        "tempo_changes": tempo_changes,
+        "time_signature": time_signature,
+        "total_notes": len(pressed),
+        "unique_pitches": len(set(pressed)),
+        "max_polyphony": max_polyphony,
+        "lowest_note": min(pressed, default=None),
+        "highest_note": max(pressed, default=None),
+    }
+
+
+def analyze_stream(filepath):
+    with open(filepath, "rb") as f:
+        return analyze_smf(f.read())
+
+
+def main():
+    files = sorted(
+        os.path.join(SONGS, name)
+        for name in os.listdir(SONGS)
+        if name.lower().endswith((".mid", ".midi"))
+    )
+    timings = {}
+    results = {}
+    for analyze in (analyze_mido, analyze_stream):
+        started = time.perf_counter()
+        results[analyze] = [analyze(filepath) for filepath in files]
+        timings[analyze] = time.perf_counter() - started
+
+    mismatches = 0
+    for filepath, old, new in zip(
+        files, results[analyze_mido], results[analyze_stream]
+    ):
+        differences = [key for key in KEYS if old[key] != new[key]]
+        if differences:
+            mismatches += 1
+            print(f"{filepath}: {differences}")
+
+    print(f"{len(files)} songs, {mismatches} mismatches")
+    for analyze, seconds in timings.items():
+        print(
+            f"{analyze.__name__}: {seconds:.3f} s ({seconds / len(files) * 1000:.1f} ms/song)"
+        )
+    print(f"speedup: {timings[analyze_mido] / timings[analyze_stream]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
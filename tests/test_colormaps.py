@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append("./")
+sys.path.append("../")
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import lib.colormaps as cmap
+from webinterface import webinterface
+
+
+class TestColormaps(unittest.TestCase):
+    def test_01_lookup_table(self):
+        lut = cmap.get_colormap("Rainbow", 1.0)
+        self.assertEqual(lut.shape, (256, 3))
+        self.assertEqual(lut[0].tolist(), [255, 0, 0])
+        # cached per (name, gamma)
+        self.assertIs(cmap.get_colormap("Rainbow", 1.0), lut)
+        self.assertIsNot(cmap.get_colormap("Rainbow", 2.0), lut)
+        self.assertIsNone(cmap.get_colormap("no such colormap"))
+
+    def test_02_gradient_change(self):
+        cmap.update_multicolor([[20, 60]], [[0, 0, 255]])
+        self.assertEqual(cmap.get_colormap("^Multicolor")[0].tolist(), [0, 0, 255])
+        cmap.update_multicolor([[20, 60]], [[255, 0, 0]])
+        self.assertEqual(cmap.get_colormap("^Multicolor")[0].tolist(), [255, 0, 0])
+
+    def test_03_file_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            data_path = os.path.join(folder, "test_map.led.data")
+            with open(data_path, "w") as handle:
+                handle.write("1.0 0.0 0.0\n0.0 0.0 1.0\n")
+            cache_path = os.path.join(folder, "colormaps.bin")
+
+            with mock.patch.multiple(
+                cmap,
+                DIR_COLORMAPS=folder,
+                COLORMAP_CACHE_PATH=cache_path,
+                gradients={},
+            ):
+                self.assertEqual(cmap.load_colormaps(), ["test_map"])
+                self.assertTrue(os.path.isfile(cache_path))
+                # listed, read on first use
+                self.assertIsNone(cmap.gradients["test_map"])
+                self.assertEqual(
+                    cmap.get_colormap("test_map", 1.0)[0].tolist(), [255, 0, 0]
+                )
+
+                with open(data_path, "w") as handle:
+                    handle.write("0.0 1.0 0.0\n0.0 0.0 1.0\n")
+                os.utime(data_path, ns=(0, 0))
+                cmap.load_colormaps()  # stale cache is rebuilt
+                self.assertEqual(cmap.get_gradient("test_map")[0], [0.0, 1.0, 0.0])
+                self.assertEqual(
+                    cmap.get_colormap("test_map", 1.0)[0].tolist(), [0, 255, 0]
+                )
+
+    def test_04_previews_etag(self):
+        client = webinterface.test_client()
+        url = "/api/get_colormap_gradients"
+        cmap.update_multicolor([[20, 60]], [[255, 0, 0]])
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        self.assertIn("Rainbow", response.get_json())
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+        cmap.update_multicolor([[20, 60]], [[0, 255, 0]])
+        response = client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        # the ETag follows the content, not how often it changed, so it
+        # means the same after a restart
+        cmap.update_multicolor([[20, 60]], [[255, 0, 0]])
+        response = client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+
+if __name__ == "__main__":
+    unittest.main()
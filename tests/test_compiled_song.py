@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append("./")
+sys.path.append("../")
+import os
+import tempfile
+import unittest
+
+import mido
+
+from lib.compiled_song import (
+    KIND_CONTROL_CHANGE,
+    KIND_NOTE_OFF,
+    KIND_NOTE_ON,
+    compile_midi,
+    event_to_message,
+    load_compiled_song,
+    save_compiled_song,
+)
+from lib.step_index import StepIndex, mask_to_notes
+from lib.tempo_map import TempoMap
+
+
+def make_song():
+    mid = mido.MidiFile(ticks_per_beat=480)
+    right = mido.MidiTrack()
+    left = mido.MidiTrack()
+    mid.tracks.extend([right, left])
+
+    right.append(mido.MetaMessage("set_tempo", tempo=500000, time=0))
+    right.append(mido.Message("note_on", note=60, velocity=80, time=0))
+    right.append(mido.Message("note_off", note=60, velocity=64, time=480))
+    # halve the tempo after the first beat
+    right.append(mido.MetaMessage("set_tempo", tempo=1000000, time=0))
+    right.append(mido.Message("note_on", note=62, velocity=90, time=0))
+    right.append(mido.Message("note_on", note=62, velocity=0, time=480))
+
+    left.append(mido.Message("note_on", note=48, velocity=70, time=0))
+    left.append(mido.Message("control_change", control=64, value=127, time=240))
+    left.append(mido.Message("note_off", note=48, velocity=0, time=720))
+    return mid
+
+
+class TestCompiledSong(unittest.TestCase):
+    def setUp(self):
+        self.mid = make_song()
+        self.song = compile_midi(self.mid)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.song_path = os.path.join(self.tmpdir.name, "test.mid")
+        self.mid.save(self.song_path)
+        self.path = os.path.join(self.tmpdir.name, "test.mid.song")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_compile(self):
+        events = self.song.events
+        self.assertEqual(len(self.song), 7)
+        self.assertEqual(self.song.song_tempo, 500000)
+        self.assertEqual(events["tick"].tolist(), [0, 0, 240, 480, 480, 960, 960])
+        self.assertEqual(
+            events["kind"].tolist(),
+            [
+                KIND_NOTE_ON,
+                KIND_NOTE_ON,
+                KIND_CONTROL_CHANGE,
+                KIND_NOTE_OFF,
+                KIND_NOTE_ON,
+                KIND_NOTE_OFF,
+                KIND_NOTE_OFF,
+            ],
+        )
+        # two tracks: first one is the right hand, second one the left hand
+        self.assertEqual(events["channel"][:2].tolist(), [1, 2])
+
+    def test_02_times_follow_tempo_changes(self):
+        expected = []
+        now = 0
+        for msg in self.mid:
+            now += msg.time
+            if not msg.is_meta:
+                expected.append(now)
+        for a, b in zip(self.song.events["time"].tolist(), expected):
+            self.assertAlmostEqual(a, b)
+        self.assertAlmostEqual(self.song.events["time"][-1], 1.5)
+
+    def test_03_roundtrip(self):
+        save_compiled_song(self.song, self.path, self.song_path)
+        loaded = load_compiled_song(self.path, self.song_path)
+
+        self.assertIsNotNone(loaded)
+        self.assertEqual(loaded.ticks_per_beat, 480)
+        self.assertEqual(loaded.events.tolist(), self.song.events.tolist())
+        self.assertEqual(loaded.to_message_dicts(), self.song.to_message_dicts())
+
+    def test_04_stale_source(self):
+        save_compiled_song(self.song, self.path, self.song_path)
+        self.mid.tracks[0].append(mido.Message("note_on", note=64, time=10))
+        self.mid.save(self.song_path)
+
+        self.assertIsNone(load_compiled_song(self.path, self.song_path))
+
+    def test_05_empty_song(self):
+        song = compile_midi(mido.MidiFile())
+        save_compiled_song(song, self.path)
+
+        self.assertEqual(len(load_compiled_song(self.path)), 0)
+
+    def test_06_other_messages(self):
+        # played as they are in Listen mode
+        messages = [
+            mido.Message("pitchwheel", pitch=-8192, channel=3),
+            mido.Message("pitchwheel", pitch=1234, channel=3),
+            mido.Message("aftertouch", value=50, channel=4),
+            mido.Message("polytouch", note=60, value=70, channel=5),
+            mido.Message("sysex", data=[0x7E, 0x7F, 0x09, 0x01]),
+        ]
+        mid = mido.MidiFile()
+        mid.tracks.append(mido.MidiTrack(messages))
+        save_compiled_song(compile_midi(mid), self.path)
+        song = load_compiled_song(self.path)
+
+        rebuilt = [
+            event_to_message(kind, note, velocity, channel, song.sysex)
+            for _, _, kind, note, velocity, channel in song.events.tolist()
+        ]
+        self.assertEqual(rebuilt, messages)
+        self.assertEqual(song.to_message_dicts()[-1]["data"], [0x7E, 0x7F, 0x09, 0x01])
+
+
+class TestTempoMap(unittest.TestCase):
+    def setUp(self):
+        # 120 BPM for 2 beats, 60 BPM for 1 beat, then 240 BPM
+        self.tempo_map = TempoMap(480, [(960, 1000000), (1440, 250000)])
+
+    def test_01_tick2second(self):
+        self.assertAlmostEqual(self.tempo_map.tick2second(0), 0.0)
+        self.assertAlmostEqual(self.tempo_map.tick2second(960), 1.0)
+        self.assertAlmostEqual(self.tempo_map.tick2second(1200), 1.5)
+        self.assertAlmostEqual(self.tempo_map.tick2second(1920), 2.25)
+        self.assertEqual(
+            self.tempo_map.tick2second([0, 960, 1440]).tolist(), [0.0, 1.0, 2.0]
+        )
+
+    def test_02_second2tick(self):
+        for tick in (0, 480, 960, 1200, 1440, 2000):
+            seconds = self.tempo_map.tick2second(tick)
+            self.assertAlmostEqual(self.tempo_map.second2tick(seconds), tick)
+
+    def test_03_tempo(self):
+        self.assertEqual(self.tempo_map.initial_tempo, 1000000)
+        self.assertEqual(self.tempo_map.tempo_at(0), 500000)
+        self.assertEqual(self.tempo_map.tempo_at(1000), 1000000)
+        self.assertAlmostEqual(self.tempo_map.average_tempo(1440), 2000000 / 3)
+
+    def test_04_matches_mido(self):
+        mid = make_song()
+        tempo_map = TempoMap.from_midi(mid)
+        last_tick = max(sum(msg.time for msg in track) for track in mid.tracks)
+        self.assertAlmostEqual(tempo_map.tick2second(last_tick), mid.length)
+
+
+class TestStepIndex(unittest.TestCase):
+    def setUp(self):
+        self.song = compile_midi(make_song())
+        self.steps = StepIndex(self.song.events)
+
+    def test_01_steps(self):
+        self.assertEqual(len(self.steps), 2)
+        self.assertEqual(mask_to_notes(self.steps.chord(0)), [48, 60])
+        self.assertEqual(mask_to_notes(self.steps.chord(0, hands=1)), [60])
+        self.assertEqual(mask_to_notes(self.steps.chord(0, hands=2)), [48])
+        self.assertEqual(mask_to_notes(self.steps.chord(1)), [62])
+
+    def test_02_spans(self):
+        # the control change on tick 240 does not end the first step
+        self.assertEqual(self.steps.starts.tolist(), [0, 4])
+        self.assertEqual(self.steps.ends.tolist(), [3, 5])
+        self.assertEqual(self.steps.wait_step.tolist(), [-1, -1, -1, 0, -1, 1, -1])
+
+    def test_03_lookups(self):
+        self.assertEqual(self.steps.next_notes(0), [(62, 1)])
+        self.assertEqual(self.steps.next_notes(0, end_row=4), [])
+        self.assertEqual(self.steps.next_notes(1), [])
+        self.assertEqual(self.steps.step_at(0), 0)
+        self.assertEqual(self.steps.step_at(1), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append("./")
+sys.path.append("../")
+import unittest
+
+import numpy as np
+
+from lib.frame_compositor import FrameCompositor, pack_rgb, unpack_rgb
+from lib.led_stream import FRAME_DELTA, FRAME_KEY, apply_frame, encode_delta
+from lib.LED_drivers import PixelStrip_Emu
+from lib.null_drivers import Color
+
+
+class CountingStrip:
+    """Driver without a bulk setter, like rpi_ws281x."""
+
+    def __init__(self, numleds):
+        self.leds = [0] * numleds
+        self.writes = 0
+        self.shows = 0
+
+    def numPixels(self):
+        return len(self.leds)
+
+    def setPixelColor(self, pos, color):
+        self.leds[pos] = color
+        self.writes += 1
+
+    def setBrightness(self, brightness):
+        pass
+
+    def show(self):
+        self.shows += 1
+
+
+class TestFrameCompositor(unittest.TestCase):
+    def setUp(self):
+        self.driver = PixelStrip_Emu(10)
+        self.strip = FrameCompositor(self.driver, fps=60)
+
+    def tearDown(self):
+        self.strip.stop()
+
+    def test_01_pack(self):
+        rgb = [[255, 128, 0], [1, 2, 3]]
+        packed = pack_rgb(rgb)
+        self.assertEqual(packed.tolist(), [Color(255, 128, 0), Color(1, 2, 3)])
+        self.assertEqual(unpack_rgb(packed).tolist(), rgb)
+
+    def test_02_buffer_ops(self):
+        self.strip.fill(Color(200, 100, 50))
+        self.strip.fill(Color(0, 0, 0), 8)
+        self.strip.set_pixels([[10, 20, 30]], start=9)
+        self.strip.fade(0.5, 0, 2)
+        self.strip.put([4, 6], [[1, 2, 3], [4, 5, 6]])
+
+        self.assertEqual(self.strip.getPixelColor(0), Color(100, 50, 25))
+        self.assertEqual(self.strip.getPixelColor(2), Color(200, 100, 50))
+        self.assertEqual(self.strip.getPixelColor(6), Color(4, 5, 6))
+        self.assertEqual(self.strip.getPixelColor(8), 0)
+        self.assertEqual(self.strip.get_rgb(9).tolist(), [[10, 20, 30]])
+
+    def test_03_flush(self):
+        self.strip.setPixelColor(0, Color(1, 2, 3))
+        self.strip.setPixelColor(10, Color(1, 2, 3))  # out of range, ignored
+        self.assertTrue(self.strip.flush())
+        self.assertEqual(self.driver.getPixels()[0], Color(1, 2, 3))
+        # nothing changed since the last frame
+        self.assertFalse(self.strip.flush())
+
+    def test_04_only_changed_pixels(self):
+        driver = CountingStrip(10)
+        strip = FrameCompositor(driver)
+        try:
+            strip.fill(Color(0, 0, 255))
+            strip.flush()
+            strip.setPixelColor(3, Color(255, 0, 0))
+            strip.flush()
+            self.assertEqual(driver.writes, 11)
+            self.assertEqual(driver.shows, 2)
+        finally:
+            strip.stop()
+
+
+class TestLedStream(unittest.TestCase):
+    def test_01_keyframe_then_delta(self):
+        prev = np.zeros((100, 3), dtype=np.uint8)
+        message = encode_delta(None, prev)
+        self.assertEqual(message[0], FRAME_KEY)
+        self.assertEqual(len(message), 3 + 300)
+
+        rgb = prev.copy()
+        rgb[[5, 6, 8, 50]] = [255, 0, 10]
+        message = encode_delta(prev, rgb)
+        self.assertEqual(message[0], FRAME_DELTA)
+        # pixels 5-8 (gap of one bridged) and 50
+        self.assertEqual(len(message), 3 + 4 + 12 + 4 + 3)
+        self.assertEqual(apply_frame(prev.copy(), message).tolist(), rgb.tolist())
+
+    def test_02_unchanged_and_full_change(self):
+        prev = np.zeros((10, 3), dtype=np.uint8)
+        self.assertIsNone(encode_delta(prev, prev.copy()))
+        # a delta bigger than a keyframe is sent as keyframe
+        message = encode_delta(prev, prev + 1)
+        self.assertEqual(message[0], FRAME_KEY)
+        self.assertEqual(apply_frame(prev, message).tolist(), (prev + 1).tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
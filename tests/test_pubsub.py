@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append("./")
+sys.path.append("../")
+import asyncio
+import threading
+import unittest
+
+from lib.pubsub import EventStream
+
+
+class TestEventStream(unittest.TestCase):
+    def test_01_cursors(self):
+        stream = EventStream(maxlen=8)
+        for i in range(3):
+            stream.publish(i)
+
+        self.assertEqual(stream.read(0), ([0, 1, 2], 3, 0))
+        self.assertEqual(stream.read(2), ([2], 3, 0))
+        self.assertEqual(stream.read(3), ([], 3, 0))
+        self.assertEqual(stream.latest(), 2)
+
+    def test_02_bounded(self):
+        stream = EventStream(maxlen=4)
+        for i in range(10):
+            stream.publish(i)
+
+        # a reader at cursor 1 missed events 2..6
+        self.assertEqual(stream.read(1), ([6, 7, 8, 9], 10, 5))
+
+    def test_03_subscription(self):
+        stream = EventStream()
+
+        async def follow():
+            batches = []
+            with stream.subscribe() as subscription:
+                # published from another thread while the subscriber waits
+                threading.Timer(
+                    0.01, lambda: [stream.publish(i) for i in range(5)]
+                ).start()
+                while sum(len(items) for items in batches) < 5:
+                    items, dropped = await subscription.next_batch()
+                    batches.append(items)
+            return batches
+
+        batches = asyncio.run(asyncio.wait_for(follow(), 1))
+        self.assertEqual([i for items in batches for i in items], [0, 1, 2, 3, 4])
+        self.assertEqual(len(stream._subscribers), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
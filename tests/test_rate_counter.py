@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append("./")
+sys.path.append("../")
+import unittest
+
+from lib.rate_counter import RateCounter
+
+
+class TestRateCounter(unittest.TestCase):
+    def test_01_window(self):
+        counter = RateCounter(period=1.0)
+        for i in range(10):
+            counter.add(now=i * 0.1)
+        self.assertEqual(counter.count(now=0.9), 10)
+        # the event at 0.0 expired
+        self.assertEqual(counter.add(3, now=1.05), 12)
+        self.assertEqual(counter.count(now=1.45), 5 + 3)
+        self.assertEqual(counter.rate(now=3.0), 0)
+
+    def test_02_smoothing(self):
+        counter = RateCounter(period=1.0, smoothing=0.5)
+        counter.add(10, now=0.0)
+        self.assertEqual(counter.value(now=0.0), 10)
+        # the raw count drops to 0, the smoothed value decays towards it
+        value = counter.value(now=1.5)
+        self.assertAlmostEqual(value, 10 * 2.718281828**-3, places=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append("./")
+sys.path.append("../")
+import unittest
+import unittest.mock
+from collections import deque
+from types import SimpleNamespace
+
+import mido
+import numpy as np
+
+import config
+from lib.color_mode import ColorMode
+from lib.frame_compositor import FrameCompositor
+from lib.functions import build_note_map, get_note_position
+from lib.LED_drivers import PixelStrip_Emu
+from lib.null_drivers import Color
+from lib.render_engine import RenderEngine
+
+NUM_LEDS = 176
+
+
+class FakeLedStrip:
+    def __init__(self):
+        self.strip = FrameCompositor(PixelStrip_Emu(NUM_LEDS))
+        self.keylist = np.zeros(NUM_LEDS, dtype=np.int32)
+        self.keylist_status = np.zeros(NUM_LEDS, dtype=np.int32)
+        self.keylist_color = np.zeros((NUM_LEDS, 3), dtype=np.uint8)
+        self.keylist_decay = np.zeros(NUM_LEDS, dtype=np.float32)
+        self.shift = 0
+        self.reverse = 0
+        self.leds_per_meter = 144
+        self.led_fps = 60
+        self.note_to_led, self.led_to_note = build_note_map([], 0, 0, 144, NUM_LEDS)
+
+    def num_leds_on_strip(self):
+        return NUM_LEDS
+
+    def set_adjacent_colors(self, note, color, led_turn_off, fading=1):
+        pass
+
+
+class FakeLedSettings(SimpleNamespace):
+    def get_color(self, color):
+        return {"Red": 255, "Green": 0, "Blue": 0}[color]
+
+    def get_backlight_color(self, color):
+        return 0
+
+
+class TestRenderEngine(unittest.TestCase):
+    def setUp(self):
+        self.ledstrip = FakeLedStrip()
+        self.ledsettings = FakeLedSettings(
+            mode="Normal",
+            color_mode="Single",
+            incoming_setting_change=False,
+            fadingspeed=1000,
+            fadepedal_notedrop=0,
+            note_offsets=[],
+            backlight_stopped=False,
+            backlight_brightness_percent=0,
+        )
+        self.midiports = SimpleNamespace(
+            midi_queue=deque(), midifile_queue=deque(), midipending=None
+        )
+        learning = SimpleNamespace(is_started_midi=False)
+        self.engine = RenderEngine(
+            self.ledstrip, self.ledsettings, self.midiports, learning, None
+        )
+        self.position = get_note_position(60, self.ledstrip, self.ledsettings)
+
+    def tearDown(self):
+        self.ledstrip.strip.stop()
+
+    def play(self, *messages, now=0.0):
+        for msg in messages:
+            self.midiports.midi_queue.append((msg, now))
+        return self.engine.tick(now)
+
+    def pixel(self):
+        return self.ledstrip.strip.getPixelColor(self.position)
+
+    def test_01_normal(self):
+        self.assertTrue(self.play(mido.Message("note_on", note=60, velocity=100)))
+        self.assertEqual(self.pixel(), Color(255, 0, 0))
+        self.assertEqual(self.ledstrip.keylist_status[self.position], 1)
+
+        self.play(mido.Message("note_off", note=60))
+        self.assertEqual(self.pixel(), 0)
+        # nothing to do without input
+        self.assertFalse(self.engine.tick(1.0))
+
+    def test_02_fading(self):
+        self.ledsettings.mode = "Fading"
+        self.play(mido.Message("note_on", note=60, velocity=100), now=0.0)
+        self.engine.tick(0.5)
+        self.assertEqual(self.ledstrip.keylist[self.position], 500)
+        self.assertEqual(self.pixel(), Color(127, 0, 0))
+        self.engine.tick(1.0)
+        self.assertEqual(self.pixel(), 0)
+        self.assertFalse(self.engine.animating)
+
+    def test_03_pedal(self):
+        self.ledsettings.mode = "Pedal"
+        self.play(
+            mido.Message("control_change", control=64, value=127),
+            mido.Message("note_on", note=60, velocity=100),
+            mido.Message("note_off", note=60),
+        )
+        # held by the pedal and fading
+        self.engine.tick(0.25)
+        self.assertEqual(self.ledstrip.keylist[self.position], 750)
+
+        self.play(mido.Message("control_change", control=64, value=0), now=0.3)
+        self.assertEqual(self.pixel(), 0)
+
+    def test_04_velocity(self):
+        self.ledsettings.mode = "Velocity"
+        self.play(
+            mido.Message("control_change", control=64, value=127),
+            mido.Message("note_on", note=60, velocity=64),
+            mido.Message("note_on", note=72, velocity=127),
+            mido.Message("note_off", note=60),
+        )
+        soft = self.position
+        loud = get_note_position(72, self.ledstrip, self.ledsettings)
+        self.assertEqual(self.ledstrip.keylist[soft], 503)
+
+        # same decay rate: the soft note dies out first, the pedal keeps it fading
+        self.engine.tick(0.6)
+        self.assertEqual(self.ledstrip.keylist[soft], 0)
+        self.assertEqual(self.ledstrip.keylist[loud], 400)
+        self.assertEqual(self.pixel(), 0)
+
+        self.play(mido.Message("control_change", control=64, value=0), now=0.7)
+        # still held on the keyboard
+        self.assertEqual(self.ledstrip.keylist[loud], 300)
+
+    def test_05_chord(self):
+        chord = [mido.Message("note_on", note=n, velocity=100) for n in (60, 64, 67)]
+        self.engine.update_color_mode()
+        with unittest.mock.patch.object(
+            self.engine.color_mode,
+            "NoteOnBatch",
+            wraps=self.engine.color_mode.NoteOnBatch,
+        ) as batch:
+            self.play(*chord)
+        # one call for the whole chord
+        self.assertEqual(batch.call_count, 1)
+        for msg in chord:
+            position = get_note_position(msg.note, self.ledstrip, self.ledsettings)
+            self.assertEqual(
+                self.ledstrip.strip.getPixelColor(position), Color(255, 0, 0)
+            )
+
+    def test_06_learning_uses_file_queue(self):
+        self.engine.learning.is_started_midi = True
+        self.play(mido.Message("note_on", note=60, velocity=100))
+        self.assertEqual(len(self.midiports.midi_queue), 1)
+        self.assertEqual(self.pixel(), 0)
+
+
+class TestNoteMap(unittest.TestCase):
+    def test_01_positions(self):
+        note_to_led, led_to_note = build_note_map([[92, 2], [55, 1]], 0, 0, 144, 176)
+        self.assertEqual(note_to_led[21:24], [2, 4, 6])
+        # offsets apply above their note, the last matching entry in the list wins
+        self.assertEqual(note_to_led[56], 71)
+        self.assertEqual(note_to_led[93], 145)
+        self.assertEqual(led_to_note[4], 22)
+        self.assertEqual(led_to_note[5], -1)
+
+    def test_02_shift_reverse_calibration(self):
+        calibration = np.full(128, -1)
+        calibration[60] = 10
+        note_to_led, _ = build_note_map([], 3, 1, 144, 176, calibration)
+        self.assertEqual(note_to_led[21], 176 - (2 + 3))
+        self.assertEqual(note_to_led[60], 10)
+
+    def test_03_calibration_table(self):
+        config.CONNECTION_STRING = "sqlite://"  # in-memory database
+        try:
+            mapping = config.MidiToLedMapping()
+        finally:
+            config.CONNECTION_STRING = f"sqlite:///{config.DB_FILENAME}"
+        # URL keys arrive as strings
+        mapping.set_midi_led_row("60", 10, 255, 0, 0, 0, 0)
+        self.assertEqual(mapping.led_index[60], 10)
+        self.assertEqual(mapping.rgb[60].tolist(), [255, 0, 0])
+
+        mapping.load()  # written through to the database
+        self.assertEqual(mapping.get_midi_led_row(60).led_index, 10)
+
+        mapping.delete_midi_led_row(60)
+        self.assertIsNone(mapping.get_midi_led_row(60))
+        self.assertEqual(mapping.led_index[60], -1)
+
+    def test_04_calibration_out_of_range(self):
+        config.CONNECTION_STRING = "sqlite://"  # in-memory database
+        try:
+            mapping = config.MidiToLedMapping()
+        finally:
+            config.CONNECTION_STRING = f"sqlite:///{config.DB_FILENAME}"
+        mapping.set_midi_led_row(60, 10, 255, 0, 0, 0, 0)
+        with self.assertRaises(ValueError):
+            mapping.set_midi_led_row(60, 11, 256, 0, 0, 0, 0)
+        with self.assertRaises(ValueError):
+            mapping.set_midi_led_row(60, 2**31, 0, 0, 0, 0, 0)
+        # neither the database nor the arrays were touched
+        self.assertEqual(mapping.get_midi_led_row(60).led_index, 10)
+        self.assertEqual(mapping.led_index[60], 10)
+        self.assertEqual(mapping.rgb[60].tolist(), [255, 0, 0])
+
+        # a bad row written by an older version is skipped on load
+        with config.Session(mapping._engine) as session:
+            session.add(
+                config.MidiLedMap(
+                    midi_note=61, led_index=12, r=300, g=0, b=0, time_on=0, time_off=0
+                )
+            )
+            session.commit()
+        mapping.load()
+        self.assertEqual(mapping.led_index[61], -1)
+        self.assertEqual(mapping.led_index[60], 10)
+
+
+class TestMulticolor(unittest.TestCase):
+    def test_01_note_table(self):
+        ledsettings = SimpleNamespace(
+            multicolor=[[255, 0, 0], [0, 0, 255]],
+            multicolor_range=[[30, 40], [50, 60]],
+            multicolor_iteration=0,
+        )
+        color_mode = ColorMode("Multicolor", None, ledsettings)
+        colors, valid = color_mode.NoteOnBatch(
+            [35, 45, 20, 127], [100] * 4, [0] * 4, [0] * 4
+        )
+        self.assertTrue(valid.all())
+        # in a range, mixed between two ranges, outside all of them
+        self.assertEqual(
+            colors.tolist(), [[255, 0, 0], [127, 0, 127], [0, 0, 0], [0, 0, 0]]
+        )
+        self.assertEqual(color_mode.get_random_multicolor_in_range(45), [127, 0, 127])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append("./")
+sys.path.append("../")
+import unittest
+import unittest.mock
+
+from lib import scheduler
+from lib.scheduler import DeadlineScheduler
+
+
+class FakeClock:
+    """Stands in for the time module: sleeping moves the clock, oversleep adds to it."""
+
+    def __init__(self, now=100.0):
+        self.now = now
+        self.oversleep = 0.0
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds + self.oversleep
+
+
+class TestDeadlineScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = unittest.mock.patch.object(scheduler, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = DeadlineScheduler()
+
+    def test_01_speed(self):
+        self.scheduler.start(10.0, speed=2.0)
+        # twice as fast: 2 song seconds in 1 second
+        self.assertEqual(self.scheduler.deadline(12.0), 101.0)
+        self.assertEqual(self.scheduler.wait_until(12.0), 0.0)
+        self.assertEqual(self.clock.now, 101.0)
+
+        # the position is kept, only the pace after it changes
+        self.scheduler.set_speed(0.5)
+        self.assertEqual(self.scheduler.song_position(), 12.0)
+        self.scheduler.wait_until(13.0)
+        self.assertEqual(self.clock.now, 103.0)
+        self.assertEqual(self.scheduler.stats()["speed"], 0.5)
+
+    def test_02_resync(self):
+        self.scheduler.start(0.0)
+        self.scheduler.wait_until(1.0)
+        # waiting 5 seconds for the user to press the keys
+        self.clock.now += 5.0
+        self.scheduler.resync(1.0)
+        self.assertEqual(self.scheduler.wait_until(1.5), 0.0)
+        self.assertEqual(self.clock.now, 106.5)
+        stats = self.scheduler.stats()
+        self.assertEqual(stats["events"], 2)
+        self.assertEqual(stats["max_late_ms"], 0.0)
+
+    def test_03_stats(self):
+        self.scheduler.start(0.0)
+        self.clock.oversleep = 0.002
+        self.assertAlmostEqual(self.scheduler.wait_until(1.0), 0.002)
+        # lighting the LEDs took longer than the gap to the next event
+        self.clock.oversleep = 0.0
+        self.clock.now = 101.004
+        self.assertAlmostEqual(self.scheduler.wait_until(1.0), 0.004)
+        self.assertEqual(
+            self.scheduler.stats(),
+            {
+                "events": 2,
+                "drift_ms": 3.0,
+                "jitter_ms": 1.0,
+                "max_late_ms": 4.0,
+                "speed": 1.0,
+            },
+        )
+
+        # a new song starts from empty stats
+        self.scheduler.start(0.0)
+        self.assertEqual(self.scheduler.stats()["events"], 0)
+        self.assertEqual(self.scheduler.stats()["jitter_ms"], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
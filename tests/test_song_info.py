@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import sys
+
+sys.path.append("./")
+sys.path.append("../")
+import base64
+import json
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import mido
+
+import config
+from lib import song_info
+from lib import song_watcher
+from lib.song_analysis import PRIORITY_SCAN, PRIORITY_UPLOAD, SongAnalysisService
+from lib.smf_analyzer import analyze_smf
+
+
+def write_song(path, notes, mtime_ns):
+    mid = mido.MidiFile(ticks_per_beat=480)
+    track = mido.MidiTrack()
+    mid.tracks.append(track)
+    for note in notes:
+        track.append(mido.Message("note_on", note=note, velocity=100, time=0))
+        track.append(mido.Message("note_off", note=note, time=480))
+    mid.save(path)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def slow_analyze(folder, filename):
+    # runs in a worker: the first version of the file takes a while
+    with open(os.path.join(folder, filename)) as f:
+        content = f.read()
+    open(os.path.join(folder, "started"), "w").close()
+    if content == "v1":
+        time.sleep(0.5)
+    return {"content": content}
+
+
+class TestSongLibrary(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.user = os.path.join(self.tmp.name, "user/")
+        self.default = os.path.join(self.tmp.name, "default/")
+        os.mkdir(self.user)
+        os.mkdir(self.default)
+        patcher = unittest.mock.patch.multiple(
+            song_info,
+            DIR_SONGS_USER=self.user,
+            DIR_SONGS_DEFAULT=self.default,
+            SONG_FOLDERS=(self.user, self.default),
+            _library=None,
+            _analysis_service=None,
+            _song_watcher=None,
+        )
+        patcher.start()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: song_info.get_song_watcher().stop())
+        self.addCleanup(lambda: song_info.get_analysis_service().wait())
+        # a file: rows are written from the analysis service's thread
+        config.CONNECTION_STRING = f"sqlite:///{self.tmp.name}/library.sqlite"
+        try:
+            song_info.get_library()
+        finally:
+            config.CONNECTION_STRING = f"sqlite:///{config.DB_FILENAME}"
+
+    def test_01_stale_rows(self):
+        write_song(os.path.join(self.default, "a.mid"), [60, 62], 1_000)
+        write_song(os.path.join(self.user, "b.mid"), [60], 1_000)
+        info, pending = song_info.scan_songs_info()
+        self.assertEqual(pending, ["a.mid", "b.mid"])
+        info = song_info.get_all_songs_info()
+        self.assertEqual(info["a.mid"]["total_notes"], 2)
+        self.assertEqual(info["b.mid"]["total_notes"], 1)
+
+        # unchanged files come from the table
+        self.assertEqual(song_info.scan_songs_info(), (info, []))
+
+        # replaced by an upload
+        write_song(os.path.join(self.user, "b.mid"), [60, 64, 67], 2_000)
+        song_info.notify_song_changed(os.path.join(self.user, "b.mid"))
+        self.assertEqual(song_info.get_song_info("b.mid")["total_notes"], 3)
+
+        # same content under another name is not analyzed again
+        write_song(os.path.join(self.user, "a.mid"), [60, 62], 3_000)
+        os.remove(os.path.join(self.user, "b.mid"))
+        song_info.notify_song_changed(os.path.join(self.user, "a.mid"))
+        song_info.notify_song_changed(os.path.join(self.user, "b.mid"))
+        info, pending = song_info.scan_songs_info()
+        self.assertEqual((list(info), pending), (["a.mid"], []))
+        self.assertEqual(
+            set(song_info.get_library().entries()),
+            {(self.user, "a.mid"), (self.default, "a.mid")},
+        )
+
+    def test_02_search(self):
+        songs = {
+            "Bach, Johann Sebastian - Prelude No. 1 (C major).mid": [60] * 2,
+            "Chopin, Frédéric - Nocturne Op. 9, No. 2 (E♭ major).mid": [60] * 8,
+            "Chopin, Frédéric - Prelude Op. 28, No. 4 (E minor).mid": [60] * 4,
+            "Improvisation.mid": [60, 72],
+            "Arpeggios.mid": [60] * 6,
+        }
+        for filename, notes in songs.items():
+            write_song(os.path.join(self.default, filename), notes, 1_000)
+        song_info.get_all_songs_info()
+
+        def titles(**kwargs):
+            return [song["title"] for song in song_info.search_songs(**kwargs)[0]]
+
+        self.assertEqual(
+            titles(text="PRELUDE"), ["Prelude No. 1", "Prelude Op. 28, No. 4"]
+        )
+        self.assertEqual(
+            titles(text="chop", prefix=True),
+            ["Nocturne Op. 9, No. 2", "Prelude Op. 28, No. 4"],
+        )
+        self.assertEqual(
+            titles(text="frédéric", key="eb major"), ["Nocturne Op. 9, No. 2"]
+        )
+        self.assertEqual(titles(duration=(1.5, 2.5)), ["Prelude Op. 28, No. 4"])
+        with self.assertRaises(ValueError):
+            song_info.search_songs(sort="filename")
+        for position in ([{"a": 1}, "x"], [1.0, None], "x"):
+            cursor = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+            with self.assertRaises(ValueError):
+                song_info.search_songs(cursor=cursor)
+
+        # pages in duration order, then by filename
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = song_info.search_songs(
+                sort="duration", descending=True, limit=3, cursor=cursor
+            )
+            pages.append([song["duration"] for song in page])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [[4.0, 3.0, 2.0], [1.0, 1.0]])
+
+        # songs without a composer are on the pages too, first going up
+        for descending in (False, True):
+            filenames = []
+            cursor = None
+            while True:
+                page, cursor = song_info.search_songs(
+                    sort="composer", descending=descending, limit=2, cursor=cursor
+                )
+                filenames += [song["filename"] for song in page]
+                if cursor is None:
+                    break
+            expected = sorted(
+                songs,
+                key=lambda filename: (
+                    song_info.parse_song_name(filename)[0] or "",
+                    filename,
+                ),
+            )
+            self.assertEqual(filenames, expected[::-1] if descending else expected)
+
+        # an upload of the same name hides the bundled song
+        write_song(os.path.join(self.user, "Improvisation.mid"), [60], 2_000)
+        song_info.notify_song_changed(os.path.join(self.user, "Improvisation.mid"))
+        song_info.get_all_songs_info()
+        songs, _ = song_info.search_songs(text="improv")
+        self.assertEqual([song["duration"] for song in songs], [0.5])
+
+
+class TestSongAnalysisService(unittest.TestCase):
+    def test_01_upload_while_running(self):
+        rows = []
+        library = unittest.mock.Mock(put_entries=rows.extend)
+        service = SongAnalysisService(library, slow_analyze, max_workers=2)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "a.mid")
+            with open(path, "w") as f:
+                f.write("v1")
+            service.submit(folder, "a.mid", PRIORITY_SCAN)
+            deadline = time.monotonic() + 5
+            while not os.path.exists(os.path.join(folder, "started")):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+            # replaced by an upload while the first version is analyzed
+            with open(path, "w") as f:
+                f.write("v2")
+            service.submit(folder, "a.mid", PRIORITY_UPLOAD)
+            self.assertEqual(service.pending(), {(folder, "a.mid")})
+            self.assertTrue(service.wait(timeout=5))
+            time.sleep(0.5)  # a second job would have let the first one finish last
+        # the stale result is dropped, not written over the new one
+        self.assertEqual(rows, [{"content": "v2"}])
+
+
+class TestSongFolderWatcher(unittest.TestCase):
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def watch(self, folder):
+        watcher = song_watcher.SongFolderWatcher(
+            [folder], (".mid",), poll_interval=0.05
+        )
+        changes = []
+        watcher.listeners.append(
+            lambda folder, filename, stat: changes.append((filename, stat is None))
+        )
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        path = os.path.join(folder, "a.mid")
+
+        # renamed into place: writing it in place may be seen before its mtime is set
+        write_song(path + ".tmp", [60], 1_000)
+        os.rename(path + ".tmp", path)
+        self.wait_for(lambda: watcher.names() == ["a.mid"])
+        self.assertEqual(watcher.totals(), (1, os.path.getsize(path)))
+
+        os.remove(path)
+        self.wait_for(lambda: watcher.names() == [])
+        self.assertEqual(watcher.totals(), (0, 0))
+        self.assertEqual(changes, [("a.mid", False), ("a.mid", True)])
+
+    def test_01_inotify(self):
+        with tempfile.TemporaryDirectory() as folder:
+            self.watch(folder)
+
+    def test_02_polling(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with unittest.mock.patch.object(
+                song_watcher, "Inotify", side_effect=OSError("disabled")
+            ):
+                self.watch(folder)
+
+
+class TestSmfAnalyzer(unittest.TestCase):
+    def test_01_two_hands(self):
+        mid = mido.MidiFile(ticks_per_beat=480)
+        right = mido.MidiTrack(
+            [
+                mido.MetaMessage("set_tempo", tempo=1_000_000, time=0),
+                mido.MetaMessage("time_signature", numerator=3, denominator=4),
+                mido.Message("sysex", data=[1, 2, 3]),
+                # a chord, the repeated note on counts once
+                mido.Message("note_on", note=72, velocity=90),
+                mido.Message("note_on", note=76, velocity=90),
+                mido.Message("note_on", note=76, velocity=90),
+                mido.Message("note_on", note=72, velocity=0, time=480),
+                mido.Message("note_off", note=76),
+            ]
+        )
+        left = mido.MidiTrack(
+            [
+                mido.Message("note_on", note=48, velocity=80, time=240),
+                mido.Message("note_off", note=48, time=960),
+            ]
+        )
+        mid.tracks.extend([right, left])
+        with tempfile.TemporaryFile() as f:
+            mid.save(file=f)  # written with running status
+            f.seek(0)
+            stats = analyze_smf(f.read())
+
+        self.assertEqual(stats["end_tick"], 1200)
+        self.assertEqual(stats["tempo_changes"], [(0, 1_000_000)])
+        self.assertEqual(stats["time_signature"], "3/4")
+        self.assertEqual(
+            (stats["total_notes"], stats["unique_pitches"], stats["max_polyphony"]),
+            (4, 3, 3),
+        )
+        self.assertEqual((stats["lowest_note"], stats["highest_note"]), (48, 76))
+        self.assertEqual(
+            stats["right"],
+            {
+                "total_notes": 3,
+                "max_polyphony": 2,
+                "lowest_note": 72,
+                "highest_note": 76,
+            },
+        )
+        self.assertEqual(stats["left"]["total_notes"], 1)
+
+    def test_02_short_meta_events(self):
+        header = b"MThd" + bytes([0, 0, 0, 6, 0, 0, 0, 1, 1, 0xE0])
+        end_of_track = bytes([0, 0xFF, 0x2F, 0])
+        # a set_tempo and a time_signature without all their data bytes
+        for event in (bytes([0, 0xFF, 0x51, 2, 7, 0xA1]), bytes([0, 0xFF, 0x58, 1, 4])):
+            track = event + end_of_track
+            data = header + b"MTrk" + len(track).to_bytes(4, "big") + track
+            with self.assertRaises(ValueError):
+                analyze_smf(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
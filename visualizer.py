@@ -21,6 +21,8 @@ from lib.ledstrip import LedStrip
 from lib.log_setup import logger
 from lib.midiports import MidiPorts
 from lib.platform import PlatformNull, PlatformRasp
+from lib.render_engine import RenderEngine
+from lib.song_info import scan_songs_info
 from lib.rpi_drivers import GPIO, Color, RPiException
 from lib.usersettings import UserSettings
 from webinterface import webinterface
@@ -99,15 +101,21 @@ usersettings = UserSettings()
 midiports = MidiPorts(appconfig, usersettings)
 ledsettings = LedSettings(appconfig, usersettings)
 ledstrip = LedStrip(appconfig, usersettings, ledsettings, args.leddriver)
+ledsettings.ledstrip = ledstrip
+ledstrip.set_midi_led_mapping(appmap)
 
-cmap.gradients.update(cmap.load_colormaps())
-cmap.generate_colormaps(cmap.gradients, ledstrip.led_gamma)
-cmap.update_multicolor(ledsettings.multicolor_range, ledsettings.multicolor)
+cmap.load_colormaps()
+cmap.set_gamma(ledstrip.led_gamma)
+ledsettings.update_multicolor()
 
 t = threading.Thread(target=startup_animation, args=(ledstrip, ledsettings, appconfig))
 t.start()
 
+# index the song folders and analyze new songs in the background
+threading.Thread(target=scan_songs_info, daemon=True).start()
+
 learning = LearnMIDI(usersettings, ledsettings, midiports, ledstrip)
+render_engine = RenderEngine(ledstrip, ledsettings, midiports, learning, appconfig)
 
 z = 0
 display_cycle = 0
@@ -115,11 +123,6 @@ screen_hold_time = 16
 
 midiports.last_activity = time.time()
 
-last_sustain = 0
-pedal_deadzone = 10
-ledshow_timestamp = time.time()
-color_mode_name = ""
-
 
 def start_webserver():
     if not args.port:
@@ -129,6 +132,7 @@ def start_webserver():
     webinterface.ledsettings = ledsettings
     webinterface.ledstrip = ledstrip
     webinterface.learning = learning
+    webinterface.render_engine = render_engine
     webinterface.midiports = midiports
     webinterface.platform = platform
 
@@ -155,20 +159,14 @@ processThread.start()
 # Register the shutdown handler
 atexit.register(web_mod.stop_server, websocket_loop)
 
-# Frame rate counters
-event_loop_stamp = time.perf_counter()
-frame_count = 0
-frame_avg_stamp = time.perf_counter()
-backlight_cleared = False
-# Main event loop
-
 strip = ledstrip.strip
-numPixels = strip.numPixels()
 strip.setBrightness(128)
-for i in range(0, numPixels):
-    strip.setPixelColor(i, Color(0, 0, 0))
+strip.fill(Color(0, 0, 0))
 strip.show()
 
+# Light up keys played on the piano
+render_engine.start()
+
 platform.ensure_hostname("ami")
 platform.manage_hotspot(usersettings, midiports, first_run=True)
 
@@ -186,6 +184,7 @@ def hotspot_watchdog():
 
 threading.Thread(target=hotspot_watchdog, daemon=True).start()
 
+# Main loop
 while True:
     # Save settings if changed
     if (time.time() - usersettings.last_save) > 1:
@@ -196,10 +195,4 @@ while True:
             ledsettings = LedSettings(usersettings)
             ledstrip = LedStrip(usersettings, ledsettings)
 
-    # Prep midi event queue
-    if learning.is_started_midi is False:
-        midiports.midipending = midiports.midi_queue
-    else:
-        midiports.midipending = midiports.midifile_queue
-
     time.sleep(1)
@@ -1,8 +1,12 @@
 import asyncio
 import json
 import websockets
+import numpy as np
 from flask import Flask
+from urllib.parse import parse_qs, urlsplit
+from lib.frame_compositor import unpack_rgb
 from lib.functions import get_ip_address
+from lib.led_stream import encode_delta
 from lib.log_setup import logger
 import os
 
@@ -21,20 +25,24 @@ webinterface.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 webinterface.config["MAX_CONTENT_LENGTH"] = 32 * 1000 * 1000
 webinterface.json.sort_keys = False
 webinterface.socket_input = []
+webinterface.drain_midi_cursor = 0
 
 
 def start_server(loop):
     async def learning(websocket):
-        try:
-            while True:
-                await asyncio.sleep(0.01)
-                for msg in webinterface.learning.socket_send[:]:
-                    await websocket.send(str(msg))
-                    webinterface.learning.socket_send.remove(msg)
-        except Exception:
-            pass
+        # the song position only matters as its latest value: send at most one per
+        # frame, whatever the number of events played since the previous one
+        progress = webinterface.learning.progress
+        with progress.subscribe(cursor=max(0, progress.seq - 1)) as subscription:
+            try:
+                while True:
+                    items, _ = await subscription.next_batch()
+                    await websocket.send(str(items[-1]))
+                    await asyncio.sleep(0.01)
+            except Exception:
+                pass
 
-    async def ledemu_recv(websocket):
+    async def ledemu_recv(websocket, client):
         async for message in websocket:
             try:
                 msg = json.loads(message)
@@ -42,6 +50,8 @@ def start_server(loop):
                     webinterface.ledemu_pause = True
                 elif msg["cmd"] == "resume":
                     webinterface.ledemu_pause = False
+                elif msg["cmd"] == "keyframe":
+                    client["last"] = None
             except websockets.exceptions.ConnectionClosed:
                 pass
             except websockets.exceptions.WebSocketException:
@@ -50,7 +60,7 @@ def start_server(loop):
                 logger.warning(e)
                 return
 
-    async def ledemu(websocket):
+    async def ledemu(websocket, client):
         try:
             await websocket.send(
                 json.dumps(
@@ -67,23 +77,76 @@ def start_server(loop):
         while True:
             try:
                 ledstrip = webinterface.ledstrip
-                await asyncio.sleep(1 / ledstrip.WEBEMU_FPS)
+                await asyncio.sleep(1 / (client["fps"] or ledstrip.WEBEMU_FPS))
                 if webinterface.ledemu_pause:
                     continue
-                await websocket.send(json.dumps({"leds": ledstrip.strip.getPixels()}))
+                pixels = ledstrip.strip.pixels.copy()
+                last = client["last"]
+                if last is not None and np.array_equal(pixels, last):
+                    continue  # nothing changed since the last frame this client got
+                if client["binary"]:
+                    rgb_last = None if last is None else unpack_rgb(last)
+                    message = encode_delta(rgb_last, unpack_rgb(pixels))
+                else:
+                    message = json.dumps({"leds": pixels.tolist()})
+                # send() waits while this client's write buffer is full; frames
+                # rendered meanwhile are skipped and the next delta covers them
+                await websocket.send(message)
+                client["last"] = pixels
             except websockets.exceptions.ConnectionClosed:
-                pass
+                return
             except websockets.exceptions.WebSocketException:
                 pass
             except Exception as e:
                 logger.warning(e)
                 return
 
+    async def midi_events(websocket):
+        # pressed keys first, then every key event as soon as it arrives;
+        # events that queue up while a send is in flight go out as one batch
+        midiports = webinterface.midiports
+        with midiports.frontend_events.subscribe() as subscription:
+            try:
+                await websocket.send(
+                    json.dumps(
+                        {
+                            "seq": subscription.cursor,
+                            "pressed": midiports.get_pressed_keys(),
+                        }
+                    )
+                )
+                while True:
+                    events, dropped = await subscription.next_batch()
+                    await websocket.send(
+                        json.dumps(
+                            {
+                                "seq": subscription.cursor,
+                                "events": events,
+                                "dropped": dropped,
+                            }
+                        )
+                    )
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
     async def handler(websocket):
-        if websocket.path == "/learning":
+        url = urlsplit(websocket.path)
+        if url.path == "/learning":
             await learning(websocket)
-        elif websocket.path == "/ledemu":
-            await asyncio.gather(ledemu(websocket), ledemu_recv(websocket))
+        elif url.path == "/ledemu":
+            # /ledemu?format=binary&fps=30 opts in to the binary delta stream (lib/led_stream.py)
+            query = parse_qs(url.query)
+            fps = query.get("fps", [""])[0]
+            client = {
+                "binary": query.get("format", [""])[0] == "binary",
+                "fps": min(max(int(fps), 1), 60) if fps.isdigit() else None,
+                "last": None,
+            }
+            await asyncio.gather(
+                ledemu(websocket, client), ledemu_recv(websocket, client)
+            )
+        elif url.path == "/midi_events":
+            await midi_events(websocket)
         else:
             return  # no handler for this path — close connection
 
@@ -42,17 +42,13 @@ def upload_file():
                 success=False, error="file already exists", song_name=filename
             )
 
+        from lib.song_info import DIR_SONGS_USER, get_songs_storage
+
         usage = shutil.disk_usage("Songs_User_Upload")
         avg_size = 30000  # 30KB conservative estimate
-        songs_dir = "Songs_User_Upload"
-        if os.path.isdir(songs_dir):
-            sizes = [
-                os.path.getsize(os.path.join(songs_dir, f))
-                for f in os.listdir(songs_dir)
-                if f.lower().endswith((".mid", ".midi"))
-            ]
-            if sizes:
-                avg_size = sum(sizes) / len(sizes)
+        count, total_size = get_songs_storage([DIR_SONGS_USER])
+        if count:
+            avg_size = total_size / count
         remaining = int(usage.free / avg_size)
 
         if (
@@ -84,10 +80,18 @@ def upload_file():
         save_path = os.path.join(webinterface.config["UPLOAD_FOLDER"], filename)
         file.save(save_path)
 
-        from lib.song_info import has_playable_notes
+        from lib.song_info import (
+            has_playable_notes,
+            notify_song_changed,
+            queue_song_analysis,
+        )
 
         if not has_playable_notes(save_path):
             os.remove(save_path)  # delete the empty file so it doesn't clutter the list
+            notify_song_changed(save_path)
             return jsonify(success=False, error="no playable notes", song_name=filename)
 
+        queue_song_analysis(filename)
+        notify_song_changed(save_path)
+
         return jsonify(success=True, reload_songs=True, song_name=filename)
@@ -1,4 +1,6 @@
 import subprocess
+import hashlib
+import struct
 import threading
 import psutil
 import random
@@ -12,17 +14,21 @@ import os
 from flask import jsonify, redirect, request, send_file, send_from_directory, url_for
 
 import lib.colormaps as cmap
+from config import NUM_MIDI_NOTES
 from lib.functions import fastColorWipe, find_between, get_last_logs
 from lib.rpi_drivers import GPIO, Color
 from lib.song_info import (
-    get_all_songs_info,
+    get_analysis_service,
+    get_song_names,
+    get_songs_storage,
+    notify_song_changed,
+    scan_songs_info,
+    search_songs,
     resolve_song_path,
-    DIR_SONGS_DEFAULT,
     DIR_SONGS_USER,
 )
 from lib.log_setup import logger
 from webinterface import webinterface
-from webinterface.views import allowed_file
 
 # IMPORTANT!!! 👇
 # ANY CHANGE HERE, AND THEN ANY UPDATE VIA GIT PULL WILL REQUIRE THE PI TO BE RESTARTED TO WORK!
@@ -244,29 +250,60 @@ function connect(){
 
 @webinterface.route("/api/get_songs", methods=["GET"])
 def get_songs():
-    default_songs = (
-        os.listdir(DIR_SONGS_DEFAULT) if os.path.isdir(DIR_SONGS_DEFAULT) else []
-    )
-    user_songs = os.listdir(DIR_SONGS_USER) if os.path.isdir(DIR_SONGS_USER) else []
-    combined = list(set(filter(allowed_file, default_songs + user_songs)))
-    combined.sort()
-    return jsonify(combined)
+    return jsonify(get_song_names())
 
 
 @webinterface.route("/api/get_songs_info", methods=["GET"])
 def get_songs_info():
-    info = get_all_songs_info()
-    return jsonify(success=True, songs=info)
+    # songs still being analyzed are listed in pending; ask again for them
+    info, pending = scan_songs_info()
+    return jsonify(success=True, songs=info, pending=pending)
+
+
+def _arg_range(name, cast):
+    # name=value for an exact match, name_min and name_max for a range
+    if request.args.get(name):
+        value = cast(request.args[name])
+        return value, value
+    low = request.args.get(f"{name}_min")
+    high = request.args.get(f"{name}_max")
+    return (cast(low) if low else None, cast(high) if high else None)
+
+
+@webinterface.route("/api/search_songs", methods=["GET"])
+def search_songs_page():
+    """One page of songs: ?q=&match=prefix|substring&difficulty=&duration_min=
+    &duration_max=&bpm_min=&bpm_max=&key=&sort=&order=asc|desc&limit=&cursor="""
+    try:
+        songs, next_cursor = search_songs(
+            text=request.args.get("q") or None,
+            prefix=request.args.get("match") == "prefix",
+            difficulty=_arg_range("difficulty", int),
+            duration=_arg_range("duration", float),
+            bpm=_arg_range("bpm", int),
+            key=request.args.get("key") or None,
+            sort=request.args.get("sort", "title"),
+            descending=request.args.get("order") == "desc",
+            cursor=request.args.get("cursor") or None,
+            limit=request.args.get("limit"),
+        )
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    # songs still being analyzed show up in later searches
+    pending = bool(get_analysis_service().pending())
+    return jsonify(success=True, songs=songs, next_cursor=next_cursor, pending=pending)
 
 
 @webinterface.route("/api/get_current_song", methods=["GET"])
 def get_current_song():
-    song_tracks = webinterface.learning.song_tracks
-    song_tracks = [msg.__dict__ for msg in song_tracks]
+    song = webinterface.learning.song
+    song_tracks = song.to_message_dicts() if song is not None else []
+    tempo_map = song.tempo_map.to_list() if song is not None else []
     return jsonify(
         tracks=song_tracks,
         ticks_per_beat=webinterface.learning.ticks_per_beat,
         tempo=webinterface.learning.song_tempo,
+        tempo_map=tempo_map,
     )
 
 
@@ -293,6 +330,7 @@ def delete_song():
     if not path:
         return jsonify(success=False, error="song not found")
     os.remove(path)
+    notify_song_changed(path)
     return jsonify(success=True)
 
 
@@ -380,6 +418,7 @@ def save_recording():
             prev_time_ms = time_ms
 
         mid.save(save_path)
+        notify_song_changed(save_path)
         return jsonify(success=True, filename=filename)
 
     except Exception as e:
@@ -391,16 +430,7 @@ def save_recording():
 @webinterface.route("/api/get_storage_info", methods=["GET"])
 def get_storage_info():
     usage = shutil.disk_usage(DIR_SONGS_USER)
-
-    total_size = 0
-    count = 0
-    for d in [DIR_SONGS_DEFAULT, DIR_SONGS_USER]:
-        if not os.path.isdir(d):
-            continue
-        for f in os.listdir(d):
-            if f.lower().endswith((".mid", ".midi")):
-                total_size += os.path.getsize(os.path.join(d, f))
-                count += 1
+    count, total_size = get_songs_storage()
 
     return jsonify(
         success=True,
@@ -415,19 +445,20 @@ def get_storage_info():
 
 @webinterface.route("/api/currently_pressed_keys", methods=["GET"])
 def currently_pressed_keys():
-    with webinterface.midiports._keys_lock:
-        snapshot = list(webinterface.midiports.currently_pressed_keys)
-    result = [{"note": msg.note, "velocity": msg.velocity} for msg in snapshot]
-    return jsonify(result)
+    return jsonify(webinterface.midiports.get_pressed_keys())
+
+
+@webinterface.route("/api/get_render_stats", methods=["GET"])
+def get_render_stats():
+    return jsonify(webinterface.render_engine.stats())
 
 
 @webinterface.route("/api/drain_midi_events", methods=["GET"])
 def drain_midi_events():
-    events = []
-    while (
-        webinterface.midiports.frontend_events
-    ):  # drain all accumulated events since last poll
-        events.append(webinterface.midiports.frontend_events.popleft())
+    # all accumulated events since last poll; the websocket on /midi_events pushes them instead
+    events, webinterface.drain_midi_cursor, _ = (
+        webinterface.midiports.frontend_events.read(webinterface.drain_midi_cursor)
+    )
     return jsonify(events)
 
 
@@ -539,9 +570,7 @@ def set_all_lights():
     blue = int(color["b"])
     green = int(color["g"])
     color = Color(red, green, blue)
-    cntLed = webinterface.appconfig.num_leds_on_strip()
-    for i in range(cntLed):
-        strip.setPixelColor(i, color)
+    strip.fill(color)
     strip.setBrightness(brightest)
     strip.show()
     return jsonify(success=True)
@@ -685,6 +714,10 @@ def set_config(key):
         return jsonify(success=False, error="no value"), 400
     value = str(value)[:1000]  # cap length to prevent oversized entries
     webinterface.appconfig.set_config(key, value)
+    if key == "num_leds_per_meter":
+        webinterface.ledstrip.change_leds_per_meter()
+    elif key == "num_leds_on_strip":
+        webinterface.ledstrip.update_note_map()
     return jsonify(success=True)
 
 
@@ -711,17 +744,40 @@ def backup_config_file_and_reset_to_factory():
 ### ===== database: map table ===== ###
 
 
+def _midi_note(key):
+    """MIDI note from a map table URL key, None when invalid."""
+    try:
+        midi_note = int(key)
+    except ValueError:
+        return None
+    return midi_note if 0 <= midi_note < NUM_MIDI_NOTES else None
+
+
+def _map_row(mapping):
+    return {
+        "midi_note": mapping.midi_note,
+        "led_index": mapping.led_index,
+        "r": mapping.r,
+        "g": mapping.g,
+        "b": mapping.b,
+        "time_on": mapping.time_on,
+        "time_off": mapping.time_off,
+    }
+
+
 @webinterface.route("/api/get_row/<key>", methods=["GET"])
 def get_row(key):
-    if not key or not _SAFE_CONFIG_KEY.match(key):
+    midi_note = _midi_note(key)
+    if midi_note is None:
         return jsonify(success=False, error="invalid key"), 400
-    value = webinterface.appmap.get_midi_led_row(key)
-    return jsonify(success=True, value=value)
+    value = webinterface.appmap.get_midi_led_row(midi_note)
+    return jsonify(success=True, value=_map_row(value) if value else None)
 
 
 @webinterface.route("/api/set_row/<key>", methods=["POST"])
 def set_row(key):
-    if not key or not _SAFE_CONFIG_KEY.match(key):
+    midi_note = _midi_note(key)
+    if midi_note is None:
         return jsonify(success=False, error="invalid key"), 400
     try:
         led_index = int(request.values.get("led_index"))
@@ -732,40 +788,36 @@ def set_row(key):
         time_off = int(request.values.get("time_off"))
     except (TypeError, ValueError):
         return jsonify(success=False, error="invalid values"), 400
-    webinterface.appmap.set_midi_led_row(key, led_index, r, g, b, time_on, time_off)
+    try:
+        webinterface.appmap.set_midi_led_row(
+            midi_note, led_index, r, g, b, time_on, time_off
+        )
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+    webinterface.ledstrip.update_note_map()
     return jsonify(success=True)
 
 
 @webinterface.route("/api/delete_row/<key>", methods=["DELETE"])
 def delete_row(key):
-    if not key or not _SAFE_CONFIG_KEY.match(key):
+    midi_note = _midi_note(key)
+    if midi_note is None:
         return jsonify(success=False, error="invalid key"), 400
-    webinterface.appmap.delete_midi_led_row(key)
+    webinterface.appmap.delete_midi_led_row(midi_note)
+    webinterface.ledstrip.update_note_map()
     return jsonify(success=True)
 
 
 @webinterface.route("/api/get_map", methods=["GET"])
 def get_map():
     mappings = webinterface.appmap.get_midi_led_map()
-    result = []
-    for mapping in mappings:
-        result.append(
-            {
-                "midi_note": mapping.midi_note,
-                "led_index": mapping.led_index,
-                "r": mapping.r,
-                "g": mapping.g,
-                "b": mapping.b,
-                "time_on": mapping.time_on,
-                "time_off": mapping.time_off,
-            }
-        )
-    return jsonify(success=True, mappings=result)
+    return jsonify(success=True, mappings=[_map_row(mapping) for mapping in mappings])
 
 
 @webinterface.route("/api/delete_all_maps", methods=["POST"])
 def delete_all_maps():
     webinterface.appmap.delete_all_maps()
+    webinterface.ledstrip.update_note_map()
     return jsonify(success=True)
 
 
@@ -834,6 +886,7 @@ def get_learning_status():
         "number_of_mistakes": ast.literal_eval(
             webinterface.usersettings.get_setting_value("number_of_mistakes")
         ),
+        "timing": webinterface.learning.get_timing_stats(),
     }
     return jsonify(response)
 
@@ -889,6 +942,46 @@ def get_logs():
     return get_last_logs(last_logs)
 
 
+# rendered colormap previews: format -> (version, body, mimetype, etag)
+_colormap_previews = {}
+
+
+def _render_colormap_previews(previews, format):
+    if format == "binary":
+        # u2 count, u2 entries, then per colormap: u1 name length, utf-8 name, entries * r, g, b
+        parts = [struct.pack("<HH", len(previews), cmap.PREVIEW_ENTRIES)]
+        for name, preview in previews.items():
+            name_bytes = name.encode("utf-8")
+            parts.append(struct.pack("<B", len(name_bytes)) + name_bytes)
+            parts.append(preview.tobytes())
+        return b"".join(parts), "application/octet-stream"
+    # sorted like the jsonify response this replaces
+    body = json.dumps(
+        {name: preview.tolist() for name, preview in previews.items()}, sort_keys=True
+    )
+    return body.encode("utf-8"), "application/json"
+
+
 @webinterface.route("/api/get_colormap_gradients", methods=["GET"])
 def get_colormap_gradients():
-    return jsonify(cmap.colormaps_preview)
+    """Colormap previews as JSON, or packed with ?format=binary.
+
+    Rendered once per colormap set and served with an ETag, so browsers
+    revalidate with If-None-Match and get a 304 while nothing changed. The
+    ETag is a hash of the body: it has to survive restarts, which the
+    colormap versions don't.
+    """
+    format = "binary" if request.args.get("format") == "binary" else "json"
+    cached = _colormap_previews.get(format)
+    if cached is None or cached[0] != cmap.previews_version():
+        previews, version = cmap.get_colormap_previews()
+        body, mimetype = _render_colormap_previews(previews, format)
+        etag = hashlib.sha1(body).hexdigest()[:16]
+        cached = (version, body, mimetype, etag)
+        _colormap_previews[format] = cached
+    _, body, mimetype, etag = cached
+
+    response = webinterface.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
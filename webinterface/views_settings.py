@@ -10,7 +10,6 @@ import webcolors as wc
 from flask import jsonify, request, send_file
 from werkzeug.security import safe_join
 
-import lib.colormaps as cmap
 from lib.functions import clamp, fastColorWipe, play_midi
 from lib.log_setup import logger
 from webinterface import webinterface
@@ -201,7 +200,13 @@ def change_setting():
         return jsonify(success=True, reload=True)
 
     if setting_name == "note_offsets":
+        try:
+            note_offsets = json.loads(value)
+        except (TypeError, ValueError):
+            return jsonify(success=False, error="invalid JSON"), 400
         webinterface.usersettings.change_setting_value("note_offsets", value)
+        webinterface.ledsettings.note_offsets = note_offsets
+        webinterface.ledsettings.update_note_map()
 
     if setting_name == "update_note_offset":
         webinterface.ledsettings.update_note_offset(int(value) + 1, second_value)
@@ -253,19 +258,12 @@ def change_setting():
             "multicolor_range", webinterface.ledsettings.multicolor_range
         )
 
-        cmap.update_multicolor(
-            webinterface.ledsettings.multicolor_range,
-            webinterface.ledsettings.multicolor,
-        )
+        webinterface.ledsettings.update_multicolor()
 
         return jsonify(success=True)
 
     if setting_name == "remove_multicolor":
         webinterface.ledsettings.deletecolor(int(value) + 1)
-        cmap.update_multicolor(
-            webinterface.ledsettings.multicolor_range,
-            webinterface.ledsettings.multicolor,
-        )
         return jsonify(success=True, reload=True)
 
     if setting_name == "multicolor":
@@ -278,10 +276,7 @@ def change_setting():
             "multicolor", webinterface.ledsettings.multicolor
         )
 
-        cmap.update_multicolor(
-            webinterface.ledsettings.multicolor_range,
-            webinterface.ledsettings.multicolor,
-        )
+        webinterface.ledsettings.update_multicolor()
 
         return jsonify(success=True, reload_sequence=reload_sequence)
 
@@ -291,10 +286,7 @@ def change_setting():
             "multicolor_range", webinterface.ledsettings.multicolor_range
         )
 
-        cmap.update_multicolor(
-            webinterface.ledsettings.multicolor_range,
-            webinterface.ledsettings.multicolor,
-        )
+        webinterface.ledsettings.update_multicolor()
 
         return jsonify(success=True, reload_sequence=reload_sequence)
 
@@ -304,10 +296,7 @@ def change_setting():
             "multicolor_range", webinterface.ledsettings.multicolor_range
         )
 
-        cmap.update_multicolor(
-            webinterface.ledsettings.multicolor_range,
-            webinterface.ledsettings.multicolor,
-        )
+        webinterface.ledsettings.update_multicolor()
 
         return jsonify(success=True, reload_sequence=reload_sequence)
 
@@ -321,6 +310,7 @@ def change_setting():
         webinterface.usersettings.change_setting_value(
             "multicolor_range", webinterface.ledsettings.multicolor_range
         )
+        webinterface.ledsettings.update_multicolor()
         return jsonify(success=True)
 
     if setting_name == "rainbow_offset":
@@ -1263,7 +1253,7 @@ def change_setting():
         return jsonify(success=True)
 
     if setting_name == "stop_learning_song":
-        webinterface.learning.is_started_midi = False
+        webinterface.learning.stop_learning()
         fastColorWipe(webinterface.ledstrip.strip, True, webinterface.ledsettings)
 
         return jsonify(success=True)
@@ -1478,6 +1468,11 @@ def change_setting():
 
         return jsonify(success=True)
 
+    if setting_name == "led_fps":
+        webinterface.ledstrip.change_fps(value)
+
+        return jsonify(success=True)
+
     return jsonify(success=True)
 
 
@@ -1522,6 +1517,7 @@ def get_settings():
     response["backlight_color"] = backlight_color
     response["disable_backlight_on_idle"] = disable_backlight_on_idle
     response["led_gamma"] = webinterface.usersettings.get_setting_value("led_gamma")
+    response["led_fps"] = webinterface.usersettings.get_setting_value("led_fps")
 
     response["sides_color_mode"] = webinterface.usersettings.get_setting_value(
         "adjacent_mode"